@@ -1,15 +1,1636 @@
 from datetime import datetime, timedelta, timezone
+import bisect
+import heapq
+import itertools
+import json
+import math
 import os
+import pickle
+import queue
+import re
+import struct
+import threading
+from collections import OrderedDict, deque
 
 from flask import Flask, jsonify, request, send_from_directory
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 
+# Package import under gunicorn (backend_flask.app:app), plain import when run from this directory
+try:
+    from .ids import id_field, id_filter, id_floor, ids_filter, is_legacy_id, new_id, storage_key
+    from .partitions import PartitionedDatabase
+    from .records import RECORD_TYPES, Record
+    from .reports import memory_report, mongo_report, period_bounds
+except ImportError:
+    from ids import id_field, id_filter, id_floor, ids_filter, is_legacy_id, new_id, storage_key
+    from partitions import PartitionedDatabase
+    from records import RECORD_TYPES, Record
+    from reports import memory_report, mongo_report, period_bounds
+
+
+DATA_DIR = os.environ.get('DATA_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'))
+
+
+class ApiJSONProvider(DefaultJSONProvider):
+    # Typed fields (startAt/endAt, ObjectIds) are serialized the way the API has
+    # always shown them: ISO-8601 UTC strings and plain string ids.
+
+    def default(self, o):
+        if isinstance(o, datetime):
+            if o.tzinfo is None:
+                o = o.replace(tzinfo=timezone.utc)
+            return o.astimezone(timezone.utc).isoformat().replace('+00:00', 'Z')
+        if type(o).__name__ == 'ObjectId':
+            return str(o)
+        if isinstance(o, Record):
+            return o.to_dict()
+        return super().default(o)
+
+
+TIME_FORMATS = ('%I:%M %p', '%I:%M%p', '%I %p', '%H:%M', '%H:%M:%S')
+# Derived by appointment_window from date/time/duration; never taken from a request body
+WINDOW_FIELDS = ('startAt', 'endAt')
+
+
+def appointment_window(date_value, time_value=None, duration=None) -> dict:
+    # Canonical UTC startAt/endAt from the display fields ('2025-01-15' or a full
+    # ISO timestamp, plus '3:00 PM'-style time text and duration in minutes).
+    # Returns {} when the date cannot be parsed.
+    if isinstance(date_value, datetime):
+        start = date_value
+    else:
+        text = str(date_value or '').strip()
+        if not text:
+            return {}
+        try:
+            start = datetime.fromisoformat(text.replace('Z', '+00:00'))
+        except ValueError:
+            try:
+                start = datetime.strptime(text[:10], '%Y-%m-%d')
+            except ValueError:
+                return {}
+    if start.tzinfo is None:
+        start = start.replace(tzinfo=timezone.utc)
+    start = start.astimezone(timezone.utc)
+    time_text = str(time_value or '').strip().upper()
+    for fmt in TIME_FORMATS:
+        try:
+            t = datetime.strptime(time_text, fmt)
+        except ValueError:
+            continue
+        start = start.replace(hour=t.hour, minute=t.minute, second=0, microsecond=0)
+        break
+    try:
+        minutes = int(duration) if duration not in (None, '') else 30
+    except (TypeError, ValueError):
+        minutes = 30
+    return {'startAt': start, 'endAt': start + timedelta(minutes=minutes)}
+
+
+RRULE_WEEKDAYS = ('MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU')
+# Bounds on expansion work per request: occurrences a COUNT may ask for, and
+# how far past dtstart a rule is ever walked (~20 years)
+MAX_RRULE_COUNT = 1000
+MAX_RRULE_SPAN_DAYS = 7305
+
+
+def parse_rrule(text: str) -> dict:
+    # Subset of RFC 5545 RRULE: FREQ=DAILY|WEEKLY, INTERVAL, BYDAY, COUNT, UNTIL.
+    # Raises ValueError with a user-facing message.
+    parts = {}
+    for item in str(text or '').upper().replace('RRULE:', '').split(';'):
+        if not item.strip():
+            continue
+        if '=' not in item:
+            raise ValueError(f'Invalid RRULE part: {item}')
+        k, v = item.split('=', 1)
+        parts[k.strip()] = v.strip()
+    freq = parts.get('FREQ')
+    if freq not in ('DAILY', 'WEEKLY'):
+        raise ValueError('FREQ must be DAILY or WEEKLY')
+    rule = {'freq': freq, 'interval': 1, 'byday': None, 'count': None, 'until': None}
+    try:
+        rule['interval'] = max(int(parts.get('INTERVAL', 1)), 1)
+        if 'COUNT' in parts:
+            rule['count'] = max(int(parts['COUNT']), 1)
+    except ValueError:
+        raise ValueError('INTERVAL and COUNT must be integers')
+    if rule['count'] is not None and rule['count'] > MAX_RRULE_COUNT:
+        raise ValueError(f'COUNT must be at most {MAX_RRULE_COUNT}')
+    if 'BYDAY' in parts:
+        days = [d.strip() for d in parts['BYDAY'].split(',') if d.strip()]
+        if not days or any(d not in RRULE_WEEKDAYS for d in days):
+            raise ValueError('BYDAY must list MO,TU,WE,TH,FR,SA,SU')
+        rule['byday'] = sorted(RRULE_WEEKDAYS.index(d) for d in set(days))
+    if 'UNTIL' in parts:
+        try:
+            rule['until'] = datetime.strptime(parts['UNTIL'][:8], '%Y%m%d').date()
+        except ValueError:
+            raise ValueError('UNTIL must be YYYYMMDD')
+    return rule
+
+
+def check_rrule(rule: dict, dtstart):
+    # Raises ValueError for a rule that can never produce an occurrence
+    if rule['freq'] == 'DAILY' and rule['byday'] is not None:
+        reachable = {(dtstart.weekday() + k * rule['interval']) % 7 for k in range(7)}
+        if not reachable & set(rule['byday']):
+            raise ValueError('INTERVAL never lands on a BYDAY weekday from dtstart')
+
+
+def recurrence_dates(rule: dict, dtstart, from_date=None, to_date=None):
+    # Lazily yields occurrence dates in ascending order, stopping after to_date,
+    # UNTIL or MAX_RRULE_SPAN_DAYS past dtstart even if nothing matched. Without
+    # COUNT the walk jumps straight to from_date instead of stepping from dtstart.
+    step = rule['interval']
+    start_from = dtstart if rule['count'] is not None or from_date is None else max(dtstart, from_date)
+    stop = dtstart + timedelta(days=MAX_RRULE_SPAN_DAYS)
+    for limit in (rule['until'], to_date):
+        if limit is not None:
+            stop = min(stop, limit)
+    produced = 0
+    if rule['freq'] == 'DAILY':
+        k = -(-(start_from - dtstart).days // step)
+        day = dtstart + timedelta(days=k * step)
+        while True:
+            if day > stop:
+                return
+            if rule['byday'] is None or day.weekday() in rule['byday']:
+                yield day
+                produced += 1
+                if rule['count'] is not None and produced >= rule['count']:
+                    return
+            day += timedelta(days=step)
+    week_start = dtstart - timedelta(days=dtstart.weekday())
+    byday = rule['byday'] if rule['byday'] is not None else [dtstart.weekday()]
+    week = ((start_from - week_start).days // 7) // step * step
+    while True:
+        for wd in byday:
+            day = week_start + timedelta(days=week * 7 + wd)
+            if day < dtstart:
+                continue
+            if day > stop:
+                return
+            yield day
+            produced += 1
+            if rule['count'] is not None and produced >= rule['count']:
+                return
+        week += step
+
+
+def rule_occurrences(rule_doc: dict, window_start: datetime, window_end: datetime):
+    # (start, end) UTC datetimes of a stored schedule rule overlapping the window
+    parsed = parse_rrule(rule_doc['rrule'])
+    dtstart = datetime.strptime(rule_doc['dtstart'][:10], '%Y-%m-%d').date()
+    exdates = set(rule_doc.get('exdates') or [])
+    for day in recurrence_dates(parsed, dtstart, window_start.date() - timedelta(days=1), window_end.date()):
+        if day.isoformat() in exdates:
+            continue
+        window = appointment_window(day.isoformat(), rule_doc.get('startTime'), rule_doc.get('duration'))
+        if rule_doc.get('endTime'):
+            end = appointment_window(day.isoformat(), rule_doc['endTime'])['startAt']
+            if end > window['startAt']:
+                window['endAt'] = end
+        if window['endAt'] > window_start and window['startAt'] < window_end:
+            yield window['startAt'], window['endAt']
+
+
+def slot_label(dt: datetime) -> str:
+    # Display form used by the dashboards' slot grids, e.g. '9:00 AM'
+    return dt.strftime('%I:%M %p').lstrip('0')
+
+
+class WriteBehindBuffer:
+    # Accepts documents into an fsync'd append-only log and flushes them to the
+    # backend in background batches. The log is a series of numbered segments
+    # (wal_path.1, wal_path.2, ...): a flush seals the current segment and starts
+    # a new one, then delivers the sealed documents and deletes their segments
+    # without holding the append lock. Anything still logged at startup (a crash
+    # between accept and flush) is replayed. flush_fn must tolerate re-delivery.
+
+    def __init__(self, wal_path: str, flush_fn, batch_size: int = 100, interval: float = 1.0):
+        self.wal_path = wal_path
+        self.flush_fn = flush_fn
+        self.batch_size = batch_size
+        self.interval = interval
+        self._pending = []
+        # Sealed segment paths, and how many of the oldest pending documents they hold
+        self._sealed = []
+        self._sealed_count = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        os.makedirs(os.path.dirname(wal_path) or '.', exist_ok=True)
+        self._replay()
+        self._open_segment(max(self._segments() + [0]) + 1)
+        self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self._thread.start()
+
+    def _segments(self) -> list:
+        directory, base = os.path.split(self.wal_path)
+        found = []
+        for name in os.listdir(directory or '.'):
+            if name.startswith(base + '.') and name[len(base) + 1:].isdigit():
+                found.append(int(name[len(base) + 1:]))
+        return sorted(found)
+
+    def _open_segment(self, n: int):
+        self._segment = n
+        self._wal = open(f'{self.wal_path}.{n}', 'a', encoding='utf-8')
+
+    def _replay(self):
+        # Unsegmented log from before rotation existed, then the segments in order
+        paths = [self.wal_path] if os.path.exists(self.wal_path) else []
+        paths += [f'{self.wal_path}.{n}' for n in self._segments()]
+        for path in paths:
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        self._pending.append(json.loads(line))
+                    except ValueError:
+                        # Torn final write from a crash; everything before it is intact
+                        break
+            self._sealed.append(path)
+        self._sealed_count = len(self._pending)
+        if self._pending:
+            self._wake.set()
+
+    def append(self, doc: dict):
+        line = json.dumps(doc, separators=(',', ':'), default=str)
+        with self._lock:
+            self._wal.write(line + '\n')
+            self._wal.flush()
+            os.fsync(self._wal.fileno())
+            self._pending.append(doc)
+            if len(self._pending) >= self.batch_size:
+                self._wake.set()
+
+    def pending(self, predicate=None) -> list:
+        with self._lock:
+            return [d for d in self._pending if predicate is None or predicate(d)]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                if not self._sealed:
+                    if not self._pending:
+                        return
+                    # Everything pending is now in a sealed segment; new appends go to a fresh one
+                    self._wal.close()
+                    self._sealed.append(f'{self.wal_path}.{self._segment}')
+                    self._open_segment(self._segment + 1)
+                    self._sealed_count = len(self._pending)
+            # After a failed batch the sealed backlog is retried before sealing again
+            while self._sealed_count:
+                with self._lock:
+                    batch = list(self._pending[:min(self.batch_size, self._sealed_count)])
+                self.flush_fn(batch)
+                with self._lock:
+                    del self._pending[:len(batch)]
+                self._sealed_count -= len(batch)
+            for path in self._sealed:
+                os.remove(path)
+            self._sealed = []
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                # Backend unavailable; documents stay in the log and are retried next tick
+                pass
+
+
+class MemoryStorePersistence:
+    # Durability for the in-memory backend: periodic snapshots of every store plus
+    # an append-only change log between them. Both files are sequences of
+    # length-prefixed pickle frames, so loading streams row chunks instead of
+    # reading the whole file into memory. Replay is idempotent (inserts are
+    # de-duplicated by id, updates are field sets), so a change that lands in both
+    # a snapshot and the following log segment is applied once.
+
+    FRAME = struct.Struct('>I')
+    CHUNK_ROWS = 10000
+
+    def __init__(self, directory: str, stores: dict, users: dict, interval: float = 300.0):
+        self.directory = directory
+        self.stores = stores
+        self.users = users
+        self.interval = interval
+        self.snapshot_path = os.path.join(directory, 'memory.snapshot')
+        self._lock = threading.Lock()
+        self._log = None
+        self._segment = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _segments(self) -> list:
+        found = []
+        for name in os.listdir(self.directory):
+            if name.startswith('changes-') and name.endswith('.log'):
+                try:
+                    found.append(int(name[8:-4]))
+                except ValueError:
+                    pass
+        return sorted(found)
+
+    def _segment_path(self, n: int) -> str:
+        return os.path.join(self.directory, f'changes-{n}.log')
+
+    @classmethod
+    def _read_frames(cls, path: str):
+        with open(path, 'rb') as f:
+            while True:
+                header = f.read(cls.FRAME.size)
+                if len(header) < cls.FRAME.size:
+                    return
+                (size,) = cls.FRAME.unpack(header)
+                data = f.read(size)
+                if len(data) < size:
+                    # Torn tail from a crash mid-append
+                    return
+                yield pickle.loads(data)
+
+    @classmethod
+    def _write_frame(cls, f, obj):
+        data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+        f.write(cls.FRAME.pack(len(data)))
+        f.write(data)
+
+    def load(self) -> bool:
+        # Restores snapshot + change log into the (empty) stores; False if nothing saved.
+        first_segment = 0
+        restored = False
+        if os.path.exists(self.snapshot_path):
+            frames = self._read_frames(self.snapshot_path)
+            header = next(frames, None)
+            if header and header.get('format') == 1:
+                first_segment = header['nextSegment']
+                for kind, name, payload in frames:
+                    if kind == 'users':
+                        self.users[name].update(payload)
+                    elif kind == 'rows':
+                        self.stores[name].extend(payload)
+                restored = True
+        segments = [n for n in self._segments() if n >= first_segment]
+        if segments:
+            by_id = {name: {d.get('id'): d for d in rows} for name, rows in self.stores.items()}
+            deleted = {name: set() for name in self.stores}
+            for n in segments:
+                for op, name, payload in self._read_frames(self._segment_path(n)):
+                    self._apply(op, name, payload, by_id, deleted)
+            for name, ids in deleted.items():
+                if ids:
+                    self.stores[name][:] = [d for d in self.stores[name] if d.get('id') not in ids]
+            restored = True
+        self._segment = max(self._segments() + [first_segment - 1]) + 1
+        self._log = open(self._segment_path(self._segment), 'ab')
+        return restored
+
+    def _apply(self, op: str, name: str, payload, by_id: dict, deleted: dict):
+        if op == 'user':
+            self.users[name][payload['email']] = payload
+        elif op == 'insert':
+            if payload.get('id') not in by_id[name]:
+                self.stores[name].append(payload)
+                by_id[name][payload.get('id')] = payload
+            deleted[name].discard(payload.get('id'))
+        elif op == 'delete':
+            # Applied in one pass at the end of replay
+            if by_id[name].pop(payload, None) is not None:
+                deleted[name].add(payload)
+        elif op == 'update':
+            doc_id, fields = payload
+            doc = by_id[name].get(doc_id)
+            if doc is not None:
+                doc.update(fields)
+                if 'id' in fields:
+                    # Re-keyed row (legacy id migration); later entries use the new id
+                    by_id[name][fields['id']] = doc
+
+    def log(self, op: str, name: str, payload):
+        with self._lock:
+            if self._log is None:
+                return
+            self._write_frame(self._log, (op, name, payload))
+            self._log.flush()
+
+    def snapshot(self):
+        # Rotate the log first, then copy rows (cheap dict copies) and serialize the
+        # copies; writes keep flowing into the new segment meanwhile.
+        with self._lock:
+            previous = self._segment
+            self._segment += 1
+            if self._log is not None:
+                self._log.close()
+            self._log = open(self._segment_path(self._segment), 'ab')
+            next_segment = self._segment
+        users_copy = {role: {email: dict(u) for email, u in list(by_email.items())} for role, by_email in self.users.items()}
+        rows_copy = {name: [dict(d) for d in list(rows)] for name, rows in self.stores.items()}
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            self._write_frame(f, {'format': 1, 'nextSegment': next_segment, 'createdAt': datetime.now(timezone.utc)})
+            for role, by_email in users_copy.items():
+                self._write_frame(f, ('users', role, by_email))
+            for name, rows in rows_copy.items():
+                for i in range(0, len(rows), self.CHUNK_ROWS):
+                    self._write_frame(f, ('rows', name, rows[i:i + self.CHUNK_ROWS]))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        for n in self._segments():
+            if n <= previous:
+                os.remove(self._segment_path(n))
+
+    def start(self):
+        def run():
+            import time
+            while True:
+                time.sleep(self.interval)
+                try:
+                    self.snapshot()
+                except Exception:
+                    # Disk trouble; keep appending to the change log and retry next interval
+                    pass
+        threading.Thread(target=run, name='memory-snapshots', daemon=True).start()
+
+
+class SingleFlight:
+    # Coalesces concurrent identical computations: the first caller for a key runs
+    # fn, callers arriving while it is in flight wait and share its result (or
+    # exception). Nothing is cached once the call completes.
+
+    class _Call:
+        __slots__ = ('event', 'result', 'error')
+
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.stats = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            route_stats = self.stats.setdefault(key[0], {'requests': 0, 'executions': 0, 'coalesced': 0})
+            route_stats['requests'] += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+                route_stats['executions'] += 1
+            else:
+                route_stats['coalesced'] += 1
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {route: dict(counts) for route, counts in self.stats.items()}
+
+
+class CircuitBreaker:
+    # Consecutive-failure breaker for a backing service. After `threshold`
+    # failures in a row it opens and allow() fails fast; once `reset_timeout`
+    # has passed one caller runs `probe` (half-open) and its outcome closes or
+    # re-opens the breaker.
+
+    def __init__(self, threshold: int = 5, reset_timeout: float = 30.0, probe=None):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.probe = probe
+        self.state = 'closed'
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        self._stats = {'trips': 0, 'rejected': 0}
+
+    def allow(self) -> bool:
+        import time
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self._probing or time.monotonic() - self._opened_at < self.reset_timeout:
+                self._stats['rejected'] += 1
+                return False
+            self.state = 'half_open'
+            self._probing = True
+        try:
+            ok = self.probe() is not False if self.probe else True
+        except Exception:
+            ok = False
+        with self._lock:
+            self._probing = False
+        if ok:
+            self.record_success()
+        else:
+            self.record_failure()
+            with self._lock:
+                self._stats['rejected'] += 1
+        return ok
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self.state = 'closed'
+
+    def record_failure(self):
+        import time
+        with self._lock:
+            self._failures += 1
+            if self.state == 'half_open' or (self.state == 'closed' and self._failures >= self.threshold):
+                self.state = 'open'
+                self._opened_at = time.monotonic()
+                self._stats['trips'] += 1
+
+    def snapshot(self) -> dict:
+        import time
+        with self._lock:
+            snap = dict(self._stats, state=self.state, consecutiveFailures=self._failures)
+            if self.state == 'open':
+                snap['retryIn'] = round(max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at)), 1)
+            return snap
+
+
+class MemoryRateLimitStore:
+    # Token buckets in process memory: exact per worker, independent across workers.
+    # Each bucket remembers when it will be full again under its own rate and
+    # capacity; a sweep at most every `prune_interval` seconds drops full ones.
+
+    def __init__(self, prune_interval: float = 60):
+        import time
+        self.prune_interval = prune_interval
+        self._buckets = {}
+        self._next_prune = time.monotonic() + prune_interval
+        self._lock = threading.Lock()
+
+    def consume(self, key: str, cost: float, rate: float, capacity: float) -> tuple:
+        # Returns (allowed, seconds until `cost` tokens are available)
+        import time
+        now = time.monotonic()
+        with self._lock:
+            tokens, ts, _ = self._buckets.get(key, (capacity, now, now))
+            tokens = min(capacity, tokens + (now - ts) * rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._buckets[key] = (tokens, now, now + (capacity - tokens) / rate)
+            if now >= self._next_prune:
+                # Full buckets carry no state; a new one starts full anyway
+                self._buckets = {k: v for k, v in self._buckets.items() if v[2] > now}
+                self._next_prune = now + self.prune_interval
+        return allowed, 0 if allowed else (cost - tokens) / rate
+
+
+class MongoRateLimitStore:
+    # Token buckets shared by every worker, updated atomically with one
+    # pipeline-style findOneAndUpdate per check (MongoDB 4.2+).
+
+    def __init__(self, collection):
+        self.collection = collection
+        try:
+            collection.create_index('updatedAt', expireAfterSeconds=3600)
+        except Exception:
+            pass
+
+    def consume(self, key: str, cost: float, rate: float, capacity: float) -> tuple:
+        from pymongo import ReturnDocument
+        from pymongo.errors import DuplicateKeyError
+        now = datetime.now(timezone.utc)
+        refilled = {'$min': [capacity, {'$add': [
+            {'$ifNull': ['$tokens', capacity]},
+            {'$multiply': [{'$divide': [{'$subtract': [now, {'$ifNull': ['$updatedAt', now]}]}, 1000]}, rate]},
+        ]}]}
+        pipeline = [
+            {'$set': {'tokens': refilled, 'updatedAt': now}},
+            {'$set': {
+                'allowed': {'$gte': ['$tokens', cost]},
+                'tokens': {'$cond': [{'$gte': ['$tokens', cost]}, {'$subtract': ['$tokens', cost]}, '$tokens']},
+            }},
+        ]
+        try:
+            doc = self.collection.find_one_and_update({'_id': key}, pipeline, upsert=True,
+                                                      return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            # Two first hits raced to insert the bucket; the other one won, so update it
+            doc = self.collection.find_one_and_update({'_id': key}, pipeline, upsert=True,
+                                                      return_document=ReturnDocument.AFTER)
+        if doc['allowed']:
+            return True, 0
+        return False, (cost - doc['tokens']) / rate
+
+
+class MemoryIdempotencyStore:
+    # Idempotency-Key results with a TTL. begin() returns ('new', None) for the
+    # first request, ('done', record) for a replay (waiting for an in-flight
+    # original to finish first) or ('mismatch', None) if the key was used with a
+    # different request body.
+
+    def __init__(self, ttl: float = 86400, wait_timeout: float = 30):
+        self.ttl = ttl
+        self.wait_timeout = wait_timeout
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def begin(self, key: str, fingerprint: str) -> tuple:
+        import time
+        with self._lock:
+            now = time.monotonic()
+            if len(self._entries) > 10000:
+                self._entries = {k: e for k, e in self._entries.items() if e['expires'] > now}
+            entry = self._entries.get(key)
+            if entry is None or entry['expires'] <= now:
+                self._entries[key] = {'fingerprint': fingerprint, 'event': threading.Event(),
+                                      'record': None, 'expires': now + self.ttl}
+                return 'new', None
+        if entry['fingerprint'] != fingerprint:
+            return 'mismatch', None
+        if not entry['event'].wait(self.wait_timeout):
+            return 'busy', None
+        if entry['record'] is None:
+            # Original failed and released the key; this request runs it instead
+            return self.begin(key, fingerprint)
+        return 'done', entry['record']
+
+    def complete(self, key: str, record: dict):
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None:
+            entry['record'] = record
+            entry['event'].set()
+
+    def abort(self, key: str):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        if entry is not None:
+            entry['event'].set()
+
+
+class MongoIdempotencyStore:
+    # Same contract as MemoryIdempotencyStore, shared across workers. The unique
+    # _id claims the key; duplicates poll until the original stores its result.
+    # A claim is a lease: if its worker dies, a duplicate takes the key over once
+    # pendingUntil has passed, and the owner token stops the old worker from
+    # overwriting the new result if it was only slow.
+
+    def __init__(self, collection, ttl: float = 86400, wait_timeout: float = 30, lease: float = 60):
+        self.collection = collection
+        self.wait_timeout = wait_timeout
+        self.lease = lease
+        self._owners = {}
+        self._lock = threading.Lock()
+        try:
+            collection.create_index('createdAt', expireAfterSeconds=int(ttl))
+        except Exception:
+            pass
+
+    def _claimed(self, key: str, owner: str) -> tuple:
+        with self._lock:
+            self._owners[key] = owner
+        return 'new', None
+
+    def begin(self, key: str, fingerprint: str) -> tuple:
+        import time
+        import uuid
+        from pymongo.errors import DuplicateKeyError
+        owner = uuid.uuid4().hex
+        now = datetime.now(timezone.utc)
+        try:
+            self.collection.insert_one({'_id': key, 'fingerprint': fingerprint, 'state': 'pending', 'owner': owner,
+                                        'pendingUntil': now + timedelta(seconds=self.lease), 'createdAt': now})
+            return self._claimed(key, owner)
+        except DuplicateKeyError:
+            pass
+        deadline = time.monotonic() + self.wait_timeout
+        while time.monotonic() < deadline:
+            doc = self.collection.find_one({'_id': key})
+            if doc is None:
+                # Original failed and released the key
+                return self.begin(key, fingerprint)
+            if doc['fingerprint'] != fingerprint:
+                return 'mismatch', None
+            if doc['state'] == 'done':
+                return 'done', doc['record']
+            now = datetime.now(timezone.utc)
+            expires = doc.get('pendingUntil') or doc['createdAt'] + timedelta(seconds=self.lease)
+            if expires <= now:
+                # Lease ran out: the original worker died or hung. Conditional on
+                # the owner we saw, so only one duplicate takes over.
+                taken = self.collection.update_one(
+                    {'_id': key, 'state': 'pending', 'owner': doc.get('owner')},
+                    {'$set': {'owner': owner, 'pendingUntil': now + timedelta(seconds=self.lease)}})
+                if taken.modified_count:
+                    return self._claimed(key, owner)
+                continue
+            time.sleep(0.05)
+        return 'busy', None
+
+    def complete(self, key: str, record: dict):
+        with self._lock:
+            owner = self._owners.pop(key, None)
+        self.collection.update_one({'_id': key, 'owner': owner}, {'$set': {'state': 'done', 'record': record}})
+
+    def abort(self, key: str):
+        with self._lock:
+            owner = self._owners.pop(key, None)
+        self.collection.delete_one({'_id': key, 'state': 'pending', 'owner': owner})
+
+
+class BreakerGuardedStore:
+    # Fronts a Mongo-backed rate-limit or idempotency store with the circuit
+    # breaker and a per-call deadline. While the breaker is open, or when a call
+    # hits an outage, the in-memory fallback answers instead (per worker only).
+    # An idempotency key finishes on the store that claimed it.
+
+    def __init__(self, primary, fallback, breaker, timeout: float):
+        self.primary = primary
+        self.fallback = fallback
+        self.breaker = breaker
+        self.timeout = timeout
+        self._owners = {}
+        self._lock = threading.Lock()
+
+    def _call_primary(self, method: str, *args):
+        # Returns (True, result), or (False, None) when Mongo is unavailable
+        import pymongo
+        from pymongo.errors import ConnectionFailure, PyMongoError
+        if not self.breaker.allow():
+            return False, None
+        try:
+            with pymongo.timeout(self.timeout):
+                return True, getattr(self.primary, method)(*args)
+        except PyMongoError as e:
+            if not (isinstance(e, ConnectionFailure) or getattr(e, 'timeout', False)):
+                raise
+            self.breaker.record_failure()
+            return False, None
+
+    def consume(self, key: str, cost: float, rate: float, capacity: float) -> tuple:
+        ok, result = self._call_primary('consume', key, cost, rate, capacity)
+        return result if ok else self.fallback.consume(key, cost, rate, capacity)
+
+    def begin(self, key: str, fingerprint: str) -> tuple:
+        ok, result = self._call_primary('begin', key, fingerprint)
+        store = self.primary if ok else self.fallback
+        if not ok:
+            result = self.fallback.begin(key, fingerprint)
+        if result[0] == 'new':
+            with self._lock:
+                self._owners[key] = store
+        return result
+
+    def complete(self, key: str, record: dict):
+        self._finish('complete', key, record)
+
+    def abort(self, key: str):
+        self._finish('abort', key)
+
+    def _finish(self, method: str, key: str, *args):
+        with self._lock:
+            store = self._owners.pop(key, self.primary)
+        if store is self.fallback:
+            getattr(store, method)(key, *args)
+        else:
+            # If Mongo is down now, the pending claim's lease lets a retry take over
+            self._call_primary(method, key, *args)
+
+
+def tokenize(text) -> list:
+    return re.findall(r'[a-z0-9]+', str(text or '').lower())
+
+
+class InvertedIndex:
+    # Term -> {doc_id: weighted term frequency}, updated incrementally as documents
+    # are added or removed. fields maps a callable(doc) -> text to its weight.
+
+    def __init__(self, fields: dict):
+        self.fields = fields
+        self.postings = {}
+        self.doc_terms = {}
+        self.docs = {}
+        self._lock = threading.Lock()
+
+    def add(self, doc_id: str, doc: dict):
+        weights = {}
+        for extract, weight in self.fields.items():
+            for term in tokenize(extract(doc)):
+                weights[term] = weights.get(term, 0) + weight
+        with self._lock:
+            self._remove(doc_id)
+            for term, w in weights.items():
+                self.postings.setdefault(term, {})[doc_id] = w
+            self.doc_terms[doc_id] = list(weights)
+            self.docs[doc_id] = doc
+
+    def remove(self, doc_id: str):
+        with self._lock:
+            self._remove(doc_id)
+
+    def _remove(self, doc_id: str):
+        for term in self.doc_terms.pop(doc_id, ()):
+            posting = self.postings.get(term)
+            if posting is not None:
+                posting.pop(doc_id, None)
+                if not posting:
+                    del self.postings[term]
+        self.docs.pop(doc_id, None)
+
+    def search(self, query: str, predicate=None) -> list:
+        # Returns [(score, doc)] ranked by tf-idf; every query term must match.
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return []
+        with self._lock:
+            postings = [self.postings.get(t, {}) for t in terms]
+            if not all(postings):
+                return []
+            total = max(len(self.docs), 1)
+            postings.sort(key=len)
+            scored = []
+            for doc_id in postings[0]:
+                if not all(doc_id in p for p in postings[1:]):
+                    continue
+                doc = self.docs[doc_id]
+                if predicate is not None and not predicate(doc):
+                    continue
+                score = sum(p[doc_id] * math.log(1 + total / len(p)) for p in postings)
+                scored.append((round(score, 4), doc))
+        scored.sort(key=lambda x: x[0], reverse=True)
+        return scored
+
+
+class DoctorDirectory:
+    # Precomputed listing index for the booking page: specialty -> doctors sorted
+    # by name, plus a prefix index over name tokens. Holds only listing fields.
+
+    MAX_PREFIX = 20
+
+    def __init__(self):
+        self.by_id = {}
+        self.by_specialty = {}
+        self.sorted_all = []
+        self.prefixes = {}
+        self.loaded_at = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _name_tokens(name: str) -> list:
+        return [t for t in tokenize(name) if t != 'dr']
+
+    def add(self, doctor_id: str, name: str, specialty: str):
+        listing = {'id': doctor_id, 'name': name, 'specialty': specialty}
+        key = ((name or '').lower(), doctor_id)
+        with self._lock:
+            self._remove(doctor_id)
+            self.by_id[doctor_id] = listing
+            bisect.insort(self.by_specialty.setdefault((specialty or '').lower(), []), key)
+            bisect.insort(self.sorted_all, key)
+            for token in self._name_tokens(name):
+                for i in range(1, min(len(token), self.MAX_PREFIX) + 1):
+                    self.prefixes.setdefault(token[:i], set()).add(doctor_id)
+
+    def _remove(self, doctor_id: str):
+        old = self.by_id.pop(doctor_id, None)
+        if old is None:
+            return
+        key = ((old['name'] or '').lower(), doctor_id)
+        for bucket in (self.by_specialty.get((old['specialty'] or '').lower(), []), self.sorted_all):
+            i = bisect.bisect_left(bucket, key)
+            if i < len(bucket) and bucket[i] == key:
+                del bucket[i]
+        for token in self._name_tokens(old['name']):
+            for i in range(1, min(len(token), self.MAX_PREFIX) + 1):
+                ids = self.prefixes.get(token[:i])
+                if ids is not None:
+                    ids.discard(doctor_id)
+
+    def replace_all(self, doctors: list):
+        # doctors: [(id, name, specialty)]. Built off to the side and swapped in
+        # under the lock, so searches see the old index or the new one, never a
+        # partial one.
+        by_id, by_specialty, sorted_all, prefixes = {}, {}, [], {}
+        for doctor_id, name, specialty in doctors:
+            by_id[doctor_id] = {'id': doctor_id, 'name': name, 'specialty': specialty}
+            key = ((name or '').lower(), doctor_id)
+            by_specialty.setdefault((specialty or '').lower(), []).append(key)
+            sorted_all.append(key)
+            for token in self._name_tokens(name):
+                for i in range(1, min(len(token), self.MAX_PREFIX) + 1):
+                    prefixes.setdefault(token[:i], set()).add(doctor_id)
+        sorted_all.sort()
+        for bucket in by_specialty.values():
+            bucket.sort()
+        with self._lock:
+            self.by_id, self.by_specialty, self.sorted_all, self.prefixes = by_id, by_specialty, sorted_all, prefixes
+            self.loaded_at = datetime.now(timezone.utc)
+
+    def search(self, specialty: str = '', q: str = '', limit: int = 20) -> list:
+        with self._lock:
+            ordered = self.by_specialty.get(specialty.lower(), []) if specialty else self.sorted_all
+            matches = None
+            for token in self._name_tokens(q):
+                ids = self.prefixes.get(token[:self.MAX_PREFIX], set())
+                matches = ids if matches is None else matches & ids
+                if not matches:
+                    return []
+            results = []
+            for _, doctor_id in ordered:
+                if matches is None or doctor_id in matches:
+                    results.append(dict(self.by_id[doctor_id]))
+                    if len(results) >= limit:
+                        break
+            return results
+
+
+class EventBus:
+    # In-process pub/sub keyed by channel (e.g. "doctor:<id>"). Each subscriber gets
+    # its own bounded queue; a short history lets reconnecting clients resume from
+    # Last-Event-ID without re-querying full lists.
+
+    def __init__(self, history: int = 256, queue_size: int = 100):
+        self.queue_size = queue_size
+        self._subscribers = {}
+        self._history = deque(maxlen=history)
+        self._next_id = 1
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def listen(self, fn):
+        # In-process hook called with every published event (cache invalidation)
+        self._listeners.append(fn)
+
+    def subscribe(self, channel: str, last_event_id: int | None = None):
+        q = queue.Queue(maxsize=self.queue_size)
+        with self._lock:
+            self._subscribers.setdefault(channel, []).append(q)
+            if last_event_id is not None:
+                for event in self._history:
+                    if event['id'] > last_event_id and channel in event['channels']:
+                        q.put_nowait(event)
+        return q
+
+    def unsubscribe(self, channel: str, q):
+        with self._lock:
+            subs = self._subscribers.get(channel, [])
+            if q in subs:
+                subs.remove(q)
+            if not subs:
+                self._subscribers.pop(channel, None)
+
+    def publish(self, channels: list, event_type: str, data: dict):
+        with self._lock:
+            event = {'id': self._next_id, 'type': event_type, 'data': data, 'channels': set(channels)}
+            self._next_id += 1
+            self._history.append(event)
+            targets = [q for ch in event['channels'] for q in self._subscribers.get(ch, [])]
+        for q in targets:
+            try:
+                q.put_nowait(event)
+            except queue.Full:
+                # Slow consumer; it will resync from the full lists on reconnect
+                pass
+        for fn in self._listeners:
+            fn(event)
+
+
+class MemoryJobQueue:
+    # Min-heap of (due, seq, key, name, payload). Pushing an existing key
+    # reschedules that job; the superseded entry is skipped when it surfaces.
+    # With a path, pushes and pops are appended to a log (the same length-prefixed
+    # pickle frames as MemoryStorePersistence) so pending jobs survive restarts;
+    # the log is rewritten with just the pending jobs once it is mostly history.
+
+    COMPACT_MIN_FRAMES = 1000
+
+    def __init__(self, path: str | None = None):
+        self.path = path
+        self._heap = []
+        self._live = {}
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._log = None
+        self._frames = 0
+        if path:
+            if os.path.exists(path):
+                for frame in MemoryStorePersistence._read_frames(path):
+                    self._replay(frame)
+            self._log = open(path, 'ab')
+            # Start from a clean file: drops history and any torn tail left by a crash mid-append
+            self._compact()
+
+    def _replay(self, frame: tuple):
+        if frame[0] == 'push':
+            _, due, key, name, payload = frame
+            self._push(due, name, payload, key)
+        elif frame[0] == 'pop':
+            for key in frame[1]:
+                self._live.pop(key, None)
+
+    def _push(self, due: datetime, name: str, payload, key: str):
+        seq = next(self._seq)
+        self._live[key] = seq
+        heapq.heappush(self._heap, (due, seq, key, name, payload))
+
+    def _pending(self) -> list:
+        return [e for e in self._heap if self._live.get(e[2]) == e[1]]
+
+    def _append(self, frame: tuple):
+        if len(self._heap) > 2 * len(self._live) + 100:
+            self._heap = self._pending()
+            heapq.heapify(self._heap)
+        if self._log is None:
+            return
+        MemoryStorePersistence._write_frame(self._log, frame)
+        self._log.flush()
+        self._frames += 1
+        if self._frames > 2 * len(self._live) + self.COMPACT_MIN_FRAMES:
+            self._compact()
+
+    def _compact(self):
+        # Amortized: runs once per COMPACT_MIN_FRAMES appends at most
+        tmp = self.path + '.tmp'
+        pending = self._pending()
+        with open(tmp, 'wb') as f:
+            for due, _, key, name, payload in pending:
+                MemoryStorePersistence._write_frame(f, ('push', due, key, name, payload))
+        self._log.close()
+        os.replace(tmp, self.path)
+        self._log = open(self.path, 'ab')
+        self._frames = len(pending)
+
+    def push(self, due: datetime, name: str, payload=None, key: str | None = None):
+        # Unkeyed jobs get a random key so log entries stay unambiguous across restarts
+        key = key or f'#{os.urandom(8).hex()}'
+        with self._lock:
+            self._push(due, name, payload, key)
+            self._append(('push', due, key, name, payload))
+
+    def pop_due(self, now: datetime, limit: int) -> list:
+        jobs, keys = [], []
+        with self._lock:
+            while self._heap and len(jobs) < limit and self._heap[0][0] <= now:
+                _, seq, key, name, payload = heapq.heappop(self._heap)
+                if self._live.get(key) != seq:
+                    continue
+                del self._live[key]
+                jobs.append((name, payload))
+                keys.append(key)
+            if keys:
+                self._append(('pop', keys))
+        return jobs
+
+    def __len__(self) -> int:
+        return len(self._live)
+
+
+class MongoJobQueue:
+    # Same contract as MemoryJobQueue, shared by all workers. Keyed jobs use the
+    # key as _id; find_one_and_delete claims each due job for exactly one worker.
+
+    def __init__(self, collection):
+        self.collection = collection
+        try:
+            collection.create_index('dueAt')
+        except Exception:
+            pass
+
+    def push(self, due: datetime, name: str, payload=None, key: str | None = None):
+        doc = {'dueAt': due, 'name': name, 'payload': payload}
+        if key:
+            self.collection.replace_one({'_id': key}, doc, upsert=True)
+        else:
+            self.collection.insert_one(doc)
+
+    def pop_due(self, now: datetime, limit: int) -> list:
+        jobs = []
+        while len(jobs) < limit:
+            doc = self.collection.find_one_and_delete({'dueAt': {'$lte': now}}, sort=[('dueAt', 1)])
+            if doc is None:
+                break
+            jobs.append((doc['name'], doc.get('payload')))
+        return jobs
+
+    def __len__(self) -> int:
+        return self.collection.estimated_document_count()
+
+
+class JobScheduler:
+    # Runs due jobs from a job queue on a background thread. A handler receives
+    # every payload due under its name at once, so transitions run in batches;
+    # a failing batch is re-queued retry_delay seconds later.
+
+    def __init__(self, job_queue, poll_interval: float = 5.0, batch_size: int = 500, retry_delay: float = 60.0):
+        self.queue = job_queue
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self._handlers = {}
+        self._lock = threading.Lock()
+        self._stats = {'ran': 0, 'failed': 0}
+
+    def register(self, name: str, handler):
+        self._handlers[name] = handler
+
+    def schedule(self, due: datetime, name: str, payload=None, key: str | None = None):
+        self.queue.push(due, name, payload, key)
+
+    def every(self, name: str, seconds: float, fn):
+        # Recurring job under a fixed key: first run is due now, then every `seconds`
+        def run(_payloads):
+            try:
+                fn()
+            except Exception:
+                pass
+            finally:
+                self.schedule(datetime.now(timezone.utc) + timedelta(seconds=seconds), name, key=name)
+        self.register(name, run)
+        self.schedule(datetime.now(timezone.utc), name, key=name)
+
+    def run_due(self, now: datetime | None = None) -> int:
+        now = now or datetime.now(timezone.utc)
+        jobs = self.queue.pop_due(now, self.batch_size)
+        batches = {}
+        for name, payload in jobs:
+            batches.setdefault(name, []).append(payload)
+        for name, payloads in batches.items():
+            handler = self._handlers.get(name)
+            if handler is None:
+                continue
+            try:
+                handler(payloads)
+                ok = True
+            except Exception:
+                ok = False
+                for payload in payloads:
+                    self.queue.push(now + timedelta(seconds=self.retry_delay), name, payload)
+            with self._lock:
+                self._stats['ran' if ok else 'failed'] += len(payloads)
+        return len(jobs)
+
+    def start(self):
+        threading.Thread(target=self._run, name='job-scheduler', daemon=True).start()
+
+    def _run(self):
+        import time
+        while True:
+            try:
+                while self.run_due() >= self.batch_size:
+                    pass
+            except Exception:
+                pass
+            time.sleep(self.poll_interval)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        try:
+            stats['pending'] = len(self.queue)
+        except Exception:
+            stats['pending'] = None
+        return stats
+
+
+class ChangeCapture:
+    # Change-data capture. emit() appends an event to an in-memory ring of
+    # recent changes and to a bounded pending queue; a background thread drains
+    # the queue into the audit store in batches, so writers never wait on the
+    # audit write. A failed batch goes back to the head of the queue. If the
+    # store stays down long enough to fill the queue, the oldest pending events
+    # are dropped and counted.
+
+    def __init__(self, store, capacity: int = 10000, batch_size: int = 500, interval: float = 1.0):
+        self.store = store
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.interval = interval
+        self._recent = deque(maxlen=capacity)
+        self._pending = deque()
+        self._writing = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stats = {'captured': 0, 'written': 0, 'dropped': 0, 'batches': 0, 'writeErrors': 0}
+
+    def emit(self, collection: str, op: str, key=None, changes=None, filt=None, actor=None, count: int = 1):
+        with self._lock:
+            # Minted under the lock so the ring and the audit batch stay in id
+            # order, which recent() and the feed cursor rely on
+            event = {'id': new_id('change'), 'at': datetime.now(timezone.utc), 'collection': collection, 'op': op,
+                     'key': key, 'changes': changes, 'filter': filt, 'count': count, 'actor': actor}
+            self._recent.append(event)
+            self._stats['captured'] += 1
+            if self.store is not None:
+                if len(self._pending) >= self.capacity:
+                    self._pending.popleft()
+                    self._stats['dropped'] += 1
+                self._pending.append(event)
+                if len(self._pending) >= self.batch_size:
+                    self._wake.set()
+        return event
+
+    def recent(self, since: str, limit: int, collection: str | None = None) -> tuple:
+        # (events after `since` from the ring, whether the ring still reaches back to `since`)
+        with self._lock:
+            complete = not self._recent or self._stats['captured'] == len(self._recent) or since >= self._recent[0]['id']
+            rows = [e for e in self._recent if e['id'] > since and (collection is None or e['collection'] == collection)]
+        return rows[:limit], complete
+
+    def oldest_pending(self) -> str:
+        # Id of the oldest event not yet in the audit store (the batch being
+        # written counts), None when everything is written
+        with self._lock:
+            return self._writing or (self._pending[0]['id'] if self._pending else None)
+
+    def flush(self):
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    batch = [self._pending.popleft() for _ in range(min(self.batch_size, len(self._pending)))]
+                    self._writing = batch[0]['id'] if batch else None
+                if not batch:
+                    return
+                try:
+                    self.store.append(batch)
+                except Exception:
+                    with self._lock:
+                        self._pending.extendleft(reversed(batch))
+                        self._writing = None
+                        self._stats['writeErrors'] += 1
+                    raise
+                with self._lock:
+                    self._writing = None
+                    self._stats['written'] += len(batch)
+                    self._stats['batches'] += 1
+
+    def start(self):
+        if self.store is not None:
+            threading.Thread(target=self._run, name='change-capture', daemon=True).start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                # Store unavailable; the batch was re-queued and is retried next tick
+                pass
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self._stats, pending=len(self._pending), buffered=len(self._recent))
+
+
+class FileAuditStore:
+    # Append-only JSON-lines segments named after their first event id, so
+    # segment order is event order; a new segment starts every segment_size events.
+
+    def __init__(self, directory: str, segment_size: int = 10000):
+        self.directory = directory
+        self.segment_size = segment_size
+        os.makedirs(directory, exist_ok=True)
+        self._segment = None
+        self._count = 0
+        segments = self._segments()
+        if segments:
+            self._segment = segments[-1]
+            with open(self._segment, encoding='utf-8') as f:
+                self._count = sum(1 for _ in f)
+
+    def _segments(self) -> list:
+        return sorted(os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                      if name.startswith('audit-') and name.endswith('.jsonl'))
+
+    def append(self, events: list):
+        while events:
+            if self._segment is None or self._count >= self.segment_size:
+                self._segment = os.path.join(self.directory, f"audit-{events[0]['id']}.jsonl")
+                self._count = 0
+            chunk, events = events[:self.segment_size - self._count], events[self.segment_size - self._count:]
+            with open(self._segment, 'a', encoding='utf-8') as f:
+                for event in chunk:
+                    f.write(json.dumps(event, separators=(',', ':'), default=self._json_default) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self._count += len(chunk)
+
+    @staticmethod
+    def _json_default(o):
+        if isinstance(o, datetime):
+            o = o if o.tzinfo else o.replace(tzinfo=timezone.utc)
+            return o.astimezone(timezone.utc).isoformat().replace('+00:00', 'Z')
+        if isinstance(o, Record):
+            return o.to_dict()
+        return str(o)
+
+    def read(self, since: str, limit: int, collection: str | None = None, until: str | None = None) -> list:
+        segments = self._segments()
+        # Skip segments that end before the cursor (the next one starts at or before it)
+        starts = [os.path.basename(p)[len('audit-'):-len('.jsonl')] for p in segments]
+        first = max([i for i, start in enumerate(starts) if start <= since] or [0])
+        rows = []
+        for path in segments[first:]:
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        # Torn final write; the event was re-queued and written again
+                        continue
+                    if event['id'] <= since or (collection and event['collection'] != collection):
+                        continue
+                    if until and event['id'] >= until:
+                        return rows
+                    rows.append(event)
+                    if len(rows) >= limit:
+                        return rows
+        return rows
+
+
+class MongoAuditStore:
+    # Change events in one collection keyed by event id; batches re-sent after a
+    # failure may hit duplicate keys, which are ignored. Updates and filters are
+    # stored as JSON text because they contain '$' field names.
+    ENCODED_FIELDS = ('changes', 'filter')
+
+    def __init__(self, collection):
+        self.collection = collection
+        try:
+            self.collection.create_index([('collection', 1), ('_id', 1)])
+        except Exception:
+            pass
+
+    def append(self, events: list):
+        from pymongo.errors import BulkWriteError
+        try:
+            self.collection.insert_many([dict(e, _id=e['id'], **{
+                f: json.dumps(e[f], default=FileAuditStore._json_default)
+                for f in self.ENCODED_FIELDS if e.get(f) is not None
+            }) for e in events], ordered=False)
+        except BulkWriteError as e:
+            if any(err.get('code') != 11000 for err in e.details.get('writeErrors', [])):
+                raise
+
+    def read(self, since: str, limit: int, collection: str | None = None, until: str | None = None) -> list:
+        id_range = {'$gt': since}
+        if until:
+            id_range['$lt'] = until
+        filt = {'_id': id_range}
+        if collection:
+            filt['collection'] = collection
+        rows = list(self.collection.find(filt).sort('_id', 1).limit(limit))
+        for row in rows:
+            row.pop('_id', None)
+            for f in self.ENCODED_FIELDS:
+                if isinstance(row.get(f), str):
+                    row[f] = json.loads(row[f])
+        return rows
+
+
+class CapturedCollection:
+    # Wraps a collection (or partition router) so each successful write also
+    # emits a change event. Single-document writes carry the document key;
+    # multi-document writes carry their filter and the number of rows touched.
+
+    def __init__(self, collection, name: str, emit):
+        self._collection = collection
+        self._name = name
+        self._emit = emit
+
+    def __getattr__(self, attr: str):
+        return getattr(self._collection, attr)
+
+    @staticmethod
+    def _key(filt: dict):
+        filt = filt or {}
+        for field in ('_id', 'legacyId', 'id'):
+            if field in filt and not isinstance(filt[field], dict):
+                return str(filt[field])
+        return None
+
+    @staticmethod
+    def _doc_key(doc: dict) -> str:
+        # The id the API shows for this row, as record_change keys in-memory events
+        return doc.get('id') or str(doc.get('_id'))
+
+    @staticmethod
+    def _changes(update):
+        return update if isinstance(update, dict) else {'pipeline': update}
+
+    def insert_one(self, doc: dict, *args, **kwargs):
+        result = self._collection.insert_one(doc, *args, **kwargs)
+        self._emit(self._name, 'insert', self._doc_key(doc), dict(doc))
+        return result
+
+    def _inserted(self, docs: list, failed: set):
+        for pos, doc in enumerate(docs):
+            if pos not in failed:
+                self._emit(self._name, 'insert', self._doc_key(doc), dict(doc))
+
+    def insert_many(self, docs, ordered: bool = True, **kwargs):
+        from pymongo.errors import BulkWriteError
+        docs = list(docs)
+        try:
+            result = self._collection.insert_many(docs, ordered=ordered, **kwargs)
+        except BulkWriteError as e:
+            failed = {err['index'] for err in e.details.get('writeErrors', [])}
+            if ordered:
+                # An ordered insert stops at its first error
+                failed = set(range(min(failed, default=0), len(docs)))
+            self._inserted(docs, failed)
+            raise
+        self._inserted(docs, set())
+        return result
+
+    def find_one_and_update(self, filt: dict, update, *args, **kwargs):
+        doc = self._collection.find_one_and_update(filt, update, *args, **kwargs)
+        if doc is not None:
+            self._emit(self._name, 'update', self._doc_key(doc), self._changes(update))
+        return doc
+
+    def update_one(self, filt: dict, update, *args, **kwargs):
+        result = self._collection.update_one(filt, update, *args, **kwargs)
+        if result.matched_count:
+            key = self._key(filt)
+            self._emit(self._name, 'update', key, self._changes(update), filt=None if key else filt)
+        return result
+
+    def update_many(self, filt: dict, update, *args, **kwargs):
+        result = self._collection.update_many(filt, update, *args, **kwargs)
+        if result.matched_count:
+            self._emit(self._name, 'update', None, self._changes(update), filt=filt, count=result.matched_count)
+        return result
+
+    def delete_one(self, filt: dict, *args, **kwargs):
+        result = self._collection.delete_one(filt, *args, **kwargs)
+        if result.deleted_count:
+            key = self._key(filt)
+            self._emit(self._name, 'delete', key, None, filt=None if key else filt)
+        return result
+
+    def delete_many(self, filt: dict, *args, **kwargs):
+        result = self._collection.delete_many(filt, *args, **kwargs)
+        if result.deleted_count:
+            self._emit(self._name, 'delete', None, None, filt=filt, count=result.deleted_count)
+        return result
+
+    def bulk_write(self, requests: list, *args, **kwargs):
+        # Recorded as one summary event (bulk writes are startup migrations)
+        result = self._collection.bulk_write(requests, *args, **kwargs)
+        touched = sum(getattr(result, attr, 0) or 0 for attr in ('inserted_count', 'matched_count', 'deleted_count'))
+        if touched:
+            self._emit(self._name, 'bulk', None, None, count=touched)
+        return result
+
+
+class CapturedDatabase:
+    # Drop-in for the app's db that returns CapturedCollection for the audited collections
+
+    def __init__(self, database, names: tuple, emit):
+        self._database = database
+        self._names = names
+        self._emit = emit
+
+    def __getitem__(self, name: str):
+        collection = self._database[name]
+        return CapturedCollection(collection, name, self._emit) if name in self._names else collection
+
+    get_collection = __getitem__
+
+    def __getattr__(self, attr: str):
+        return getattr(self._database, attr)
+
+
+def normalize_prompt(text) -> str:
+    # Case, spacing and trailing punctuation don't change an FAQ-style question
+    return re.sub(r'\s+', ' ', str(text or '')).strip().lower().rstrip('?!. ')
+
+
+class ChatResponseCache:
+    # LRU of normalized prompt -> complete reply, with in-flight deduplication:
+    # claim() returns ('hit', reply), ('lead', flight) for the caller that must
+    # ask upstream (and later finish() the key), or ('wait', flight) for an
+    # identical prompt that is already being answered.
+
+    def __init__(self, max_entries: int = 1000, ttl: float = 86400):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'coalesced': 0}
+
+    def claim(self, key: str) -> tuple:
+        import time
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+                return 'hit', entry[1]
+            flight = self._inflight.get(key)
+            if flight is not None:
+                self._stats['coalesced'] += 1
+                return 'wait', flight
+            flight = {'event': threading.Event(), 'reply': None}
+            self._inflight[key] = flight
+            self._stats['misses'] += 1
+            return 'lead', flight
+
+    def finish(self, key: str, reply: str | None):
+        # reply=None releases waiters without caching (upstream failed)
+        import time
+        with self._lock:
+            flight = self._inflight.pop(key, None)
+            if reply:
+                self._entries[key] = (time.monotonic() + self.ttl, reply)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        if flight is not None:
+            flight['reply'] = reply
+            flight['event'].set()
+
+    @staticmethod
+    def wait(flight: dict, timeout: float) -> str | None:
+        flight['event'].wait(timeout)
+        return flight['reply']
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries), inFlight=len(self._inflight))
+
+
+def stream_chat_completion(url: str, api_key: str | None, payload: dict, timeout: float = 60):
+    # Yields text deltas from an OpenAI-compatible chat completions endpoint,
+    # streamed (SSE) when the upstream supports it, else from the full reply.
+    import urllib.request
+    headers = {'Content-Type': 'application/json', 'Accept': 'text/event-stream'}
+    if api_key:
+        headers['Authorization'] = f'Bearer {api_key}'
+    req = urllib.request.Request(url, data=json.dumps(dict(payload, stream=True)).encode('utf-8'),
+                                 headers=headers, method='POST')
+    with urllib.request.urlopen(req, timeout=timeout) as resp:
+        if 'text/event-stream' not in resp.headers.get('Content-Type', ''):
+            for choice in json.loads(resp.read().decode('utf-8')).get('choices') or []:
+                text = (choice.get('message') or {}).get('content')
+                if text:
+                    yield text
+            return
+        for raw in resp:
+            line = raw.decode('utf-8').strip()
+            if not line.startswith('data:'):
+                continue
+            data = line[5:].strip()
+            if data == '[DONE]':
+                return
+            try:
+                chunk = json.loads(data)
+            except ValueError:
+                continue
+            for choice in chunk.get('choices') or []:
+                text = (choice.get('delta') or {}).get('content')
+                if text:
+                    yield text
+
 
 def create_app() -> Flask:
     app = Flask(__name__)
+    app.json = ApiJSONProvider(app)
 
     app.config['JSON_SORT_KEYS'] = False
 
+    # Behind a reverse proxy (Render, nginx) remote_addr is the proxy itself;
+    # trust that many X-Forwarded-* hops so per-IP limits see the real client
+    TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', '0'))
+    if TRUSTED_PROXY_HOPS > 0:
+        from werkzeug.middleware.proxy_fix import ProxyFix
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS, x_proto=TRUSTED_PROXY_HOPS,
+                                x_host=TRUSTED_PROXY_HOPS)
+
     frontend_url = os.environ.get('FRONTEND_URL', 'http://localhost:8080')
     CORS(app, resources={r"/api/*": {"origins": [frontend_url, "http://localhost:8080", "http://127.0.0.1:8080"]}}, supports_credentials=True)
 
@@ -35,10 +1656,38 @@ def create_app() -> Flask:
     # Health check
     @app.get('/api/health')
     def health() -> tuple:
-        return jsonify({
+        if not use_db:
+            database = 'Disconnected'
+        else:
+            database = 'Connected' if mongo_breaker.state == 'closed' else 'Degraded'
+        body = {
             'status': 'OK',
             'message': 'Vaidya API is running (Flask)',
-            'database': 'Connected' if use_db else 'Disconnected'
+            'database': database
+        }
+        if use_db:
+            body['circuitBreaker'] = mongo_breaker.snapshot()
+        return jsonify(body)
+
+    # Runtime metrics
+    @app.get('/api/metrics')
+    def metrics() -> tuple:
+        with admission_lock:
+            admission = dict(admission_stats, maxConcurrent=MAX_CONCURRENT_REQUESTS)
+        return jsonify({
+            'singleFlight': single_flight.snapshot(),
+            'admission': admission,
+            'jobs': scheduler.snapshot(),
+            'chat': chat_cache.snapshot(),
+            'events': dict(stream_stats, maxStreams=SSE_MAX_STREAMS),
+            'changes': change_capture.snapshot(),
+            'mongo': {
+                'enabled': use_db,
+                'circuitBreaker': mongo_breaker.snapshot(),
+                'pool': dict(MONGO_POOL, timeoutMS=MONGO_TIMEOUT_MS),
+                'staleCache': dict(stale_stats, entries=len(stale_responses)),
+                'partitions': db.snapshot() if use_db else None,
+            }
         })
 
     # API info
@@ -62,24 +1711,108 @@ def create_app() -> Flask:
         'doctor': {}
     }
     appointments = []
+    appointments_archive = []
+    # Held for structural changes to the appointment lists (appends, the
+    # archiver's rewrite); field updates on a row don't need it
+    appointments_lock = threading.Lock()
+    schedule_rules = []
     vitals = []
     health_records = []
     prescriptions = []
 
-    # Optional MongoDB connection (fallback to in-memory if unavailable)
+    # Optional MongoDB connection (fallback to in-memory if unavailable). Pool
+    # size and timeouts are bounded so a slow or vanished server makes requests
+    # fail within MONGO_TIMEOUT_MS instead of piling up workers; the breaker
+    # below stops sending requests to it after repeated failures.
     use_db = False
     db = None
+    MONGO_POOL = {
+        'maxPoolSize': int(os.environ.get('MONGO_MAX_POOL_SIZE', '50')),
+        'minPoolSize': int(os.environ.get('MONGO_MIN_POOL_SIZE', '0')),
+        'serverSelectionTimeoutMS': int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', '2000')),
+        'connectTimeoutMS': int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS', '2000')),
+    }
+    MONGO_TIMEOUT_MS = int(os.environ.get('MONGO_TIMEOUT_MS', '5000'))
+    mongo_breaker = CircuitBreaker(
+        threshold=int(os.environ.get('MONGO_BREAKER_THRESHOLD', '5')),
+        reset_timeout=float(os.environ.get('MONGO_BREAKER_RESET_SECONDS', '30')),
+    )
     try:
-        from pymongo import MongoClient
+        from pymongo import MongoClient, monitoring
+
+        class BreakerCommandListener(monitoring.CommandListener):
+            # Any completed command proves the server is reachable again
+            def started(self, event):
+                pass
+
+            def succeeded(self, event):
+                mongo_breaker.record_success()
+
+            def failed(self, event):
+                pass
+
         mongo_uri = os.environ.get('MONGODB_URI', 'mongodb://localhost:27017/vaidya')
-        client = MongoClient(mongo_uri, serverSelectionTimeoutMS=2000)
+        client = MongoClient(mongo_uri, event_listeners=[BreakerCommandListener()], tz_aware=True,
+                             **MONGO_POOL)
         client.admin.command('ping')
+        mongo_breaker.probe = lambda: client.admin.command('ping')
         database_name = (mongo_uri.rsplit('/', 1)[-1] or 'vaidya').split('?')[0]
-        db = client.get_database(database_name if database_name else 'vaidya')
+        main_db = client.get_database(database_name if database_name else 'vaidya')
+        # Appointments, prescriptions and records may be spread over several
+        # databases or mongod instances (partitions.py); one client per server
+        from pymongo.uri_parser import parse_uri
+        partitions, partition_clients = [], {}
+        for uri in [u.strip() for u in os.environ.get('PARTITION_URIS', '').split(',') if u.strip()]:
+            parsed = parse_uri(uri)
+            server = (tuple(parsed['nodelist']), parsed['username'])
+            if server not in partition_clients:
+                partition_clients[server] = MongoClient(uri, event_listeners=[BreakerCommandListener()],
+                                                        tz_aware=True, **MONGO_POOL)
+                partition_clients[server].admin.command('ping')
+            partitions.append((uri, partition_clients[server].get_database(parsed['database'] or main_db.name)))
+        db = PartitionedDatabase(main_db, partitions or [(mongo_uri, main_db)])
         use_db = True
     except Exception:
         use_db = False
 
+    # Change-data capture for appointments, prescriptions and health records.
+    # Every write emits an event into an in-process ring buffer; a background
+    # writer appends them in batches to the audit store (the change_log
+    # collection, or JSON-lines segments when running in memory with
+    # snapshots), and /api/admin/changes serves them as a cursor feed.
+    CAPTURED_COLLECTIONS = ('appointments', 'appointments_archive', 'prescriptions', 'health_records')
+    CDC_STORE = os.environ.get('CDC_STORE') or ('mongo' if use_db else 'file' if os.environ.get(
+        'MEMORY_SNAPSHOTS', '').lower() in ('1', 'true', 'yes') else 'none')
+    CDC_SETTLE_SECONDS = float(os.environ.get('CDC_SETTLE_SECONDS', '5'))
+    if CDC_STORE == 'mongo' and use_db:
+        audit_store = MongoAuditStore(db['change_log'])
+    elif CDC_STORE == 'file':
+        audit_store = FileAuditStore(os.environ.get('CDC_DIR', os.path.join(DATA_DIR, 'audit')))
+    else:
+        audit_store = None
+    change_capture = ChangeCapture(
+        audit_store,
+        capacity=int(os.environ.get('CDC_BUFFER_SIZE', '10000')),
+        batch_size=int(os.environ.get('CDC_BATCH_SIZE', '500')),
+        interval=float(os.environ.get('CDC_FLUSH_INTERVAL', '1.0')),
+    )
+
+    def capture_change(collection: str, op: str, key=None, changes=None, filt=None, count: int = 1):
+        # Attributes the change to the signed-in user and route when there is a request
+        from flask import has_request_context
+        actor = None
+        if has_request_context():
+            user = getattr(request, 'user', None) or {}
+            actor = {'userId': user.get('userId'), 'role': user.get('role'), 'route': request.endpoint}
+        return change_capture.emit(collection, op, key, changes, filt, actor, count)
+
+    if use_db:
+        db = CapturedDatabase(db, CAPTURED_COLLECTIONS, capture_change)
+    change_capture.start()
+    if audit_store is not None:
+        import atexit
+        atexit.register(change_capture.flush)
+
     # Time helpers
     def now_utc() -> datetime:
         return datetime.now(timezone.utc)
@@ -139,7 +1872,7 @@ def create_app() -> Flask:
         # Scheduled
         appointments.extend([
             {
-                'id': 'apt_1', 'patientId': p1, 'doctorId': d1, 'patientName': 'John Smith',
+                'id': new_id('appointment'), 'patientId': p1, 'doctorId': d1, 'patientName': 'John Smith',
                 'doctorName': 'Dr. Sarah Johnson', 'specialty': 'Cardiology',
                 'date': iso(today), 'time': '3:00 PM', 'type': 'Video Consultation',
                 'status': 'scheduled', 'priority': 'normal',
@@ -147,7 +1880,7 @@ def create_app() -> Flask:
                 'meetingLink': 'https://meet.vaidya.com/room123', 'duration': 30
             },
             {
-                'id': 'apt_2', 'patientId': p2, 'doctorId': d2, 'patientName': 'Emma Wilson',
+                'id': new_id('appointment'), 'patientId': p2, 'doctorId': d2, 'patientName': 'Emma Wilson',
                 'doctorName': 'Dr. David Chen', 'specialty': 'General Physician',
                 'date': iso(tomorrow), 'time': '10:00 AM', 'type': 'Initial',
                 'status': 'scheduled', 'priority': 'high',
@@ -155,7 +1888,7 @@ def create_app() -> Flask:
                 'meetingLink': 'https://meet.vaidya.com/room124', 'duration': 45
             },
             {
-                'id': 'apt_3', 'patientId': p3, 'doctorId': d3, 'patientName': 'Michael Brown',
+                'id': new_id('appointment'), 'patientId': p3, 'doctorId': d3, 'patientName': 'Michael Brown',
                 'doctorName': 'Dr. Priya Patel', 'specialty': 'Endocrinology',
                 'date': iso(next_week), 'time': '2:00 PM', 'type': 'Follow-up',
                 'status': 'scheduled', 'priority': 'normal',
@@ -166,14 +1899,14 @@ def create_app() -> Flask:
         # Completed
         appointments.extend([
             {
-                'id': 'apt_4', 'patientId': p1, 'doctorId': d1, 'patientName': 'John Smith',
+                'id': new_id('appointment'), 'patientId': p1, 'doctorId': d1, 'patientName': 'John Smith',
                 'doctorName': 'Dr. Sarah Johnson', 'specialty': 'Cardiology',
                 'date': '2025-01-15T11:00:00Z', 'time': '11:00 AM', 'type': 'Video Consultation',
                 'status': 'completed', 'priority': 'normal', 'symptoms': ['Regular checkup'],
                 'notes': 'Annual cardiac evaluation completed', 'duration': 30
             },
             {
-                'id': 'apt_5', 'patientId': p2, 'doctorId': d2, 'patientName': 'Emma Wilson',
+                'id': new_id('appointment'), 'patientId': p2, 'doctorId': d2, 'patientName': 'Emma Wilson',
                 'doctorName': 'Dr. David Chen', 'specialty': 'General Physician',
                 'date': '2025-01-10T15:30:00Z', 'time': '3:30 PM', 'type': 'Video Consultation',
                 'status': 'completed', 'priority': 'normal', 'symptoms': ['Asthma symptoms'],
@@ -183,29 +1916,29 @@ def create_app() -> Flask:
 
         # Vitals (latest 4 used by UI)
         vitals.extend([
-            {'id': 'v_1', 'patientId': p1, 'label': 'Heart Rate', 'value': '72 bpm', 'status': 'normal', 'unit': 'bpm', 'createdAt': iso(today)},
-            {'id': 'v_2', 'patientId': p1, 'label': 'Blood Pressure', 'value': '120/80', 'status': 'normal', 'unit': 'mmHg', 'createdAt': iso(today)},
-            {'id': 'v_3', 'patientId': p1, 'label': 'Temperature', 'value': '98.6°F', 'status': 'normal', 'unit': '°F', 'createdAt': iso(today)},
-            {'id': 'v_4', 'patientId': p1, 'label': 'Oxygen', 'value': '98%', 'status': 'normal', 'unit': '%', 'createdAt': iso(today)},
-            {'id': 'v_5', 'patientId': p2, 'label': 'Heart Rate', 'value': '78 bpm', 'status': 'normal', 'unit': 'bpm', 'createdAt': iso(today)},
+            {'id': new_id('vital'), 'patientId': p1, 'label': 'Heart Rate', 'value': '72 bpm', 'status': 'normal', 'unit': 'bpm', 'createdAt': iso(today)},
+            {'id': new_id('vital'), 'patientId': p1, 'label': 'Blood Pressure', 'value': '120/80', 'status': 'normal', 'unit': 'mmHg', 'createdAt': iso(today)},
+            {'id': new_id('vital'), 'patientId': p1, 'label': 'Temperature', 'value': '98.6°F', 'status': 'normal', 'unit': '°F', 'createdAt': iso(today)},
+            {'id': new_id('vital'), 'patientId': p1, 'label': 'Oxygen', 'value': '98%', 'status': 'normal', 'unit': '%', 'createdAt': iso(today)},
+            {'id': new_id('vital'), 'patientId': p2, 'label': 'Heart Rate', 'value': '78 bpm', 'status': 'normal', 'unit': 'bpm', 'createdAt': iso(today)},
         ])
 
         # Health Records
         health_records.extend([
             {
-                'id': 'rec_1', 'patientId': p1, 'doctorId': d1, 'title': 'Cardiac Stress Test Results',
+                'id': new_id('health_record'), 'patientId': p1, 'doctorId': d1, 'title': 'Cardiac Stress Test Results',
                 'type': 'Lab Results', 'doctor': 'Dr. Sarah Johnson', 'date': '2025-01-15',
                 'description': 'Normal cardiac stress test. No significant abnormalities detected.',
                 'fileUrl': 'https://storage.vaidya.com/records/cardiac-test-001.pdf'
             },
             {
-                'id': 'rec_2', 'patientId': p1, 'doctorId': d1, 'title': 'Blood Pressure Medication',
+                'id': new_id('health_record'), 'patientId': p1, 'doctorId': d1, 'title': 'Blood Pressure Medication',
                 'type': 'Prescription', 'doctor': 'Dr. Sarah Johnson', 'date': '2025-01-10',
                 'description': 'Lisinopril 10mg - Once daily for hypertension',
                 'fileUrl': 'https://storage.vaidya.com/records/prescription-001.pdf'
             },
             {
-                'id': 'rec_3', 'patientId': p2, 'doctorId': d2, 'title': 'Pulmonary Function Test',
+                'id': new_id('health_record'), 'patientId': p2, 'doctorId': d2, 'title': 'Pulmonary Function Test',
                 'type': 'Lab Results', 'doctor': 'Dr. David Chen', 'date': '2025-01-12',
                 'description': 'Asthma well controlled. FEV1 within normal range.',
                 'fileUrl': 'https://storage.vaidya.com/records/pulmonary-test-001.pdf'
@@ -215,7 +1948,7 @@ def create_app() -> Flask:
         # Prescriptions
         prescriptions.extend([
             {
-                'id': 'pr_1', 'patientId': p1, 'patientName': 'John Smith', 'doctorId': d1,
+                'id': new_id('prescription'), 'patientId': p1, 'patientName': 'John Smith', 'doctorId': d1,
                 'medications': [
                     {'name': 'Lisinopril', 'dosage': '10mg', 'frequency': 'Once daily', 'duration': '90 days', 'instructions': 'Take in the morning with water'},
                     {'name': 'Aspirin', 'dosage': '81mg', 'frequency': 'Once daily', 'duration': '90 days', 'instructions': 'Take with food'},
@@ -225,7 +1958,7 @@ def create_app() -> Flask:
                 'date': '2025-01-15', 'validUntil': '2025-04-15', 'status': 'active'
             },
             {
-                'id': 'pr_2', 'patientId': p2, 'patientName': 'Emma Wilson', 'doctorId': d2,
+                'id': new_id('prescription'), 'patientId': p2, 'patientName': 'Emma Wilson', 'doctorId': d2,
                 'medications': [
                     {'name': 'Albuterol Inhaler', 'dosage': '90mcg', 'frequency': 'As needed', 'duration': '30 days'},
                     {'name': 'Fluticasone Inhaler', 'dosage': '110mcg', 'frequency': 'Twice daily', 'duration': '30 days'},
@@ -236,39 +1969,561 @@ def create_app() -> Flask:
             },
         ])
 
-    seed_demo_data()
+    # Optional persistence for the in-memory backend (snapshots + change log)
+    persistence = None
+    if not use_db and os.environ.get('MEMORY_SNAPSHOTS', '').lower() in ('1', 'true', 'yes'):
+        persistence = MemoryStorePersistence(
+            os.environ.get('SNAPSHOT_DIR', DATA_DIR),
+            {'appointments': appointments, 'appointments_archive': appointments_archive,
+             'schedule_rules': schedule_rules, 'vitals': vitals,
+             'health_records': health_records, 'prescriptions': prescriptions},
+            users,
+            interval=float(os.environ.get('SNAPSHOT_INTERVAL', '300')),
+        )
+        if not persistence.load():
+            seed_demo_data()
+            persistence.snapshot()
+        persistence.start()
+        import atexit
+        atexit.register(persistence.snapshot)
+    else:
+        seed_demo_data()
+
+    def compact(store_name: str, doc):
+        # In-memory rows are stored as slotted records (records.py) where a type exists
+        record_type = RECORD_TYPES.get(store_name)
+        return record_type.from_dict(doc) if record_type else doc
+
+    # Seeded rows and rows restored from older snapshots are plain dicts
+    for store_name, store in (('appointments', appointments), ('appointments_archive', appointments_archive),
+                              ('vitals', vitals), ('prescriptions', prescriptions)):
+        store[:] = [compact(store_name, d) for d in store]
+
+    def record_change(op: str, store_name: str, payload):
+        # Called after every in-memory write ('insert' doc, 'update' (id, fields), 'delete' id, 'user' doc)
+        if persistence is not None:
+            persistence.log(op, store_name, payload)
+        if store_name in CAPTURED_COLLECTIONS:
+            if op == 'insert':
+                capture_change(store_name, 'insert', payload.get('id'), dict(payload))
+            elif op == 'update':
+                capture_change(store_name, 'update', payload[0], {'$set': dict(payload[1])})
+            elif op == 'delete':
+                capture_change(store_name, 'delete', payload)
+
+    # Appointments carry typed startAt/endAt (UTC) derived from date/time/duration so
+    # "today"/"upcoming"/range queries run as index range scans. Documents written
+    # before these fields existed are backfilled once here; the filter keeps it a
+    # no-op after the first run.
+    def migrate_appointment_times() -> int:
+        if use_db:
+            from pymongo import UpdateOne
+            ops = []
+            for a in db['appointments'].find({'startAt': {'$exists': False}, 'date': {'$exists': True}},
+                                             {'date': 1, 'time': 1, 'duration': 1}):
+                window = appointment_window(a.get('date'), a.get('time'), a.get('duration'))
+                if window:
+                    ops.append(UpdateOne({'_id': a['_id']}, {'$set': window}))
+            for i in range(0, len(ops), 1000):
+                db['appointments'].bulk_write(ops[i:i + 1000], ordered=False)
+            return len(ops)
+        migrated = 0
+        for a in appointments:
+            if 'startAt' not in a and a.get('date'):
+                window = appointment_window(a.get('date'), a.get('time'), a.get('duration'))
+                if window:
+                    a.update(window)
+                    migrated += 1
+        return migrated
+
+    if use_db:
+        try:
+            db['appointments'].create_index([('doctorId', 1), ('status', 1), ('startAt', 1)])
+            db['appointments'].create_index([('patientId', 1), ('status', 1), ('startAt', 1)])
+        except Exception:
+            pass
+    migrate_appointment_times()
+
+    # Record ids are typed, sortable strings (ids.py). Rows still carrying a
+    # counter id such as 'apt_12' are re-keyed once; the old value is kept in
+    # legacyId so links and queued jobs that hold it keep resolving.
+    ID_STORES = (('appointments', 'appointment'), ('appointments_archive', 'appointment'),
+                 ('vitals', 'vital'), ('health_records', 'health_record'),
+                 ('prescriptions', 'prescription'), ('schedule_rules', 'schedule_rule'))
+
+    def migrate_legacy_ids() -> int:
+        migrated = 0
+        if use_db:
+            for coll_name, kind in ID_STORES:
+                coll = db[coll_name]
+                for doc in coll.find({'id': {'$regex': r'^[a-z]+_\d+$'}}):
+                    old_key = doc['_id']
+                    doc['legacyId'] = doc.pop('id')
+                    # ObjectId keys know when the row was written; keep that order
+                    doc['_id'] = new_id(kind, at=getattr(old_key, 'generation_time', None))
+                    if not coll.find_one({'legacyId': doc['legacyId']}, {'_id': 1}):
+                        coll.insert_one(doc)
+                    coll.delete_one({'_id': old_key})
+                    migrated += 1
+                try:
+                    coll.create_index('legacyId', sparse=True)
+                except Exception:
+                    pass
+            return migrated
+        stores = {'appointments': appointments, 'appointments_archive': appointments_archive, 'vitals': vitals,
+                  'health_records': health_records, 'prescriptions': prescriptions, 'schedule_rules': schedule_rules}
+        for store_name, kind in ID_STORES:
+            for row in stores[store_name]:
+                if is_legacy_id(row.get('id')):
+                    old_id = row['id']
+                    row.update(id=new_id(kind), legacyId=old_id)
+                    record_change('update', store_name, (old_id, {'id': row['id'], 'legacyId': old_id}))
+                    migrated += 1
+        return migrated
+
+    migrate_legacy_ids()
+
+    def find_row(rows: list, row_id: str, **match):
+        # In-memory counterpart of ids.id_filter: compare the one field that can hold row_id
+        field = id_field(row_id)
+        return next((r for r in rows if r.get(field) == row_id
+                     and all(r.get(k) == v for k, v in match.items())), None)
+
+    def start_of_day(dt: datetime) -> datetime:
+        return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    # Hot/cold tiering: completed and cancelled appointments older than
+    # ARCHIVE_AFTER_DAYS move to appointments_archive so the working set that
+    # dashboard queries scan stays small. History views read both tiers. Off by
+    # default: the first run moves everything older than the cutoff at once.
+    ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', '0'))
+    ARCHIVE_INTERVAL = float(os.environ.get('ARCHIVE_INTERVAL', '3600'))
+    ARCHIVE_BATCH = 1000
+    ARCHIVED_STATUSES = ('completed', 'cancelled', 'missed')
+
+    def archive_appointments() -> int:
+        cutoff = now_utc() - timedelta(days=ARCHIVE_AFTER_DAYS)
+        moved = 0
+        due = {'status': {'$in': list(ARCHIVED_STATUSES)}, 'startAt': {'$lt': cutoff}}
+        if use_db:
+            from pymongo.errors import BulkWriteError
+            while True:
+                batch = list(db['appointments'].find(due).limit(ARCHIVE_BATCH))
+                if not batch:
+                    return moved
+                ids = [a['_id'] for a in batch]
+                try:
+                    db['appointments_archive'].insert_many(batch, ordered=False)
+                except BulkWriteError as e:
+                    # Already archived by an earlier run that died before deleting
+                    if any(err.get('code') != 11000 for err in e.details.get('writeErrors', [])):
+                        raise
+                # Same predicate as the find: a row rescheduled or reopened since
+                # the copy stays live, and its stale archive copy is dropped
+                deleted = db['appointments'].delete_many({'_id': {'$in': ids}, **due}).deleted_count
+                if deleted < len(batch):
+                    live = [a['_id'] for a in db['appointments'].find({'_id': {'$in': ids}}, {'_id': 1})]
+                    db['appointments_archive'].delete_many({'_id': {'$in': live}})
+                moved += deleted
+        moving = []
+        with appointments_lock:
+            keep = []
+            for a in appointments:
+                if a.get('status') in ARCHIVED_STATUSES and a.get('startAt') and a['startAt'] < cutoff:
+                    moving.append(a)
+                else:
+                    keep.append(a)
+            if moving:
+                # Both lists change together under the lock appointment_history
+                # reads with, so a row is never seen in both tiers
+                appointments[:] = keep
+                appointments_archive.extend(moving)
+        for a in moving:
+            record_change('insert', 'appointments_archive', a)
+            record_change('delete', 'appointments', a['id'])
+        return len(moving)
+
+    if use_db:
+        try:
+            db['appointments_archive'].create_index([('patientId', 1), ('date', -1)])
+            db['appointments_archive'].create_index([('doctorId', 1), ('date', -1)])
+        except Exception:
+            pass
+
+    def appointment_history(filt: dict, sort_field: str = 'date'):
+        # Both tiers, newest first. Mongo: lazy merge of two sorted cursors, so
+        # callers that stop early (recent patients) never drain the archive.
+        if use_db:
+            return heapq.merge(
+                db['appointments'].find(filt).sort(sort_field, -1),
+                db['appointments_archive'].find(filt).sort(sort_field, -1),
+                key=lambda a: a.get(sort_field) or '',
+                reverse=True,
+            )
+        with appointments_lock:
+            rows = [a for a in itertools.chain(appointments, appointments_archive)
+                    if all(a.get(k) == v for k, v in filt.items())]
+        rows.sort(key=lambda a: a.get(sort_field) or '', reverse=True)
+        return rows
+
+    # Full-text search: Mongo text indexes when connected, in-memory inverted
+    # indexes (kept up to date on every insert) otherwise.
+    record_search_fields = {
+        lambda d: d.get('title'): 3,
+        lambda d: d.get('type'): 1,
+        lambda d: d.get('description'): 1,
+    }
+    prescription_search_fields = {
+        lambda d: ' '.join(m.get('name', '') for m in d.get('medications') or [] if isinstance(m, dict)): 3,
+        lambda d: d.get('diagnosis'): 2,
+        lambda d: d.get('notes'): 1,
+    }
+    search_indexes = {
+        'health_records': InvertedIndex(record_search_fields),
+        'prescriptions': InvertedIndex(prescription_search_fields),
+    }
+    text_search_available = {'health_records': False, 'prescriptions': False}
+    if use_db:
+        for coll_name, keys, weights in (
+            ('health_records', ['title', 'type', 'description'], {'title': 3, 'type': 1, 'description': 1}),
+            ('prescriptions', ['medications.name', 'diagnosis', 'notes'], {'medications.name': 3, 'diagnosis': 2, 'notes': 1}),
+        ):
+            try:
+                db[coll_name].create_index([(k, 'text') for k in keys], weights=weights, name=f'{coll_name}_text')
+                text_search_available[coll_name] = True
+            except Exception:
+                text_search_available[coll_name] = False
+    else:
+        for r in health_records:
+            search_indexes['health_records'].add(r['id'], r)
+        for p in prescriptions:
+            search_indexes['prescriptions'].add(p['id'], p)
+
+    def index_docs(collection_name: str, docs: list):
+        index = search_indexes.get(collection_name)
+        if index is not None and not use_db:
+            for d in docs:
+                index.add(d['id'], d)
+
+    def run_search(collection_name: str, scope: dict, query: str, page: int, limit: int):
+        # Returns (total, [(score, doc)]) for one page of ranked results within scope.
+        if not use_db:
+            ranked = search_indexes[collection_name].search(
+                query, lambda d: all(d.get(k) == v for k, v in scope.items()))
+            start = (page - 1) * limit
+            return len(ranked), ranked[start:start + limit]
+        coll = db[collection_name]
+        if text_search_available[collection_name]:
+            filt = dict(scope, **{'$text': {'$search': query}})
+            total = coll.count_documents(filt)
+            cur = coll.find(filt, {'score': {'$meta': 'textScore'}}) \
+                .sort([('score', {'$meta': 'textScore'})]).skip((page - 1) * limit).limit(limit)
+            hits = []
+            for d in cur:
+                score = d.pop('score', 0)
+                hits.append((round(score, 4), d))
+            return total, hits
+        # No text index: match every term in any searchable field
+        fields = ['title', 'type', 'description'] if collection_name == 'health_records' \
+            else ['medications.name', 'diagnosis', 'notes']
+        clauses = [{'$or': [{f: {'$regex': re.escape(t), '$options': 'i'}} for f in fields]} for t in tokenize(query)]
+        if not clauses:
+            return 0, []
+        filt = dict(scope, **{'$and': clauses})
+        total = coll.count_documents(filt)
+        cur = coll.find(filt).sort('date', -1).skip((page - 1) * limit).limit(limit)
+        return total, [(0, d) for d in cur]
+
+    def search_response(collection_name: str, scope: dict):
+        query = (request.args.get('q') or '').strip()
+        if not query:
+            return jsonify({'error': 'Query parameter q is required'}), 400
+        try:
+            page = max(int(request.args.get('page', 1)), 1)
+            limit = min(max(int(request.args.get('limit', 20)), 1), 100)
+        except ValueError:
+            return jsonify({'error': 'page and limit must be integers'}), 400
+        total, hits = run_search(collection_name, scope, query, page, limit)
+        results = []
+        for score, doc in hits:
+            item = dict(doc)
+            if '_id' in item:
+                item['id'] = str(item.pop('_id'))
+            item['score'] = score
+            results.append(item)
+        return jsonify({'query': query, 'total': total, 'page': page, 'limit': limit, 'results': results})
+
+    import jwt
+    from werkzeug.security import generate_password_hash, check_password_hash
+
+    JWT_SECRET = os.environ.get('JWT_SECRET', 'dev-secret')
+
+    def generate_token(user_id: str, role: str) -> str:
+        payload = {
+            'userId': user_id,
+            'role': role,
+            'exp': now_utc() + timedelta(days=7)
+        }
+        return jwt.encode(payload, JWT_SECRET, algorithm='HS256')
+
+    def auth_required(fn, allow_query_token: bool = False):
+        from functools import wraps
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            auth_header = request.headers.get('Authorization', '')
+            token = auth_header.replace('Bearer ', '') if auth_header.startswith('Bearer ') else None
+            if not token and allow_query_token:
+                token = request.args.get('token')
+            if not token:
+                return jsonify({'error': 'Unauthorized'}), 401
+            try:
+                payload = jwt.decode(token, JWT_SECRET, algorithms=['HS256'])
+            except Exception:
+                return jsonify({'error': 'Unauthorized'}), 401
+            request.user = {'userId': payload.get('userId'), 'role': payload.get('role')}
+            return fn(*args, **kwargs)
+
+        return wrapper
+
+    # Admission control: token-bucket rate limits per JWT user and per client IP
+    # (route cost weights below), plus a global cap on in-flight requests that
+    # sheds load with 503 instead of queueing on sync workers.
+    RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', '1').lower() not in ('0', 'false', 'no')
+    USER_RATE = float(os.environ.get('RATE_LIMIT_USER_RATE', '5'))
+    USER_BURST = float(os.environ.get('RATE_LIMIT_USER_BURST', '60'))
+    IP_RATE = float(os.environ.get('RATE_LIMIT_IP_RATE', '10'))
+    IP_BURST = float(os.environ.get('RATE_LIMIT_IP_BURST', '120'))
+    MAX_CONCURRENT_REQUESTS = int(os.environ.get('MAX_CONCURRENT_REQUESTS', '64'))
+    ADMISSION_WAIT_SECONDS = float(os.environ.get('ADMISSION_WAIT_SECONDS', '0.05'))
+    ROUTE_COSTS = {
+        # Password hashing
+        'signin': 5, 'signup': 5,
+        # Per-patient lookups (N+1) and full-history lists
+        'doctor_patients': 5,
+        'patient_appointments': 3, 'patient_records': 3, 'patient_prescriptions': 3, 'patient_consultations': 3,
+        'patient_timeline': 3, 'doctor_patient_timeline': 3, 'doctor_schedule': 3, 'doctor_consultations': 3,
+        'doctor_prescriptions': 3, 'patient_search_records': 2, 'doctor_search_prescriptions': 2,
+        # Bulk writes
+        'patient_add_vitals_batch': 10, 'patient_add_records_batch': 10,
+        # Report generation (served from cache when fresh)
+        'doctor_report': 5,
+        # Upstream AI call (cache hits are cheap, but the bucket is charged up front)
+        'chat': 5,
+    }
+    # Long-lived streams and liveness checks never take a concurrency slot; chat
+    # streams are bounded by their own per-user cap instead
+    UNLIMITED_ENDPOINTS = {'health', 'metrics', 'serve_index', 'serve_static', 'doctor_events', 'patient_events', 'chat'}
+
+    if use_db and os.environ.get('RATE_LIMIT_STORE', 'memory') == 'mongo':
+        # admit_request runs before guard_database, so these calls carry their
+        # own breaker check and deadline
+        rate_limit_store = BreakerGuardedStore(MongoRateLimitStore(db['rate_limits']), MemoryRateLimitStore(),
+                                               mongo_breaker, MONGO_TIMEOUT_MS / 1000)
+    else:
+        rate_limit_store = MemoryRateLimitStore()
+    concurrency_slots = threading.BoundedSemaphore(MAX_CONCURRENT_REQUESTS)
+    admission_stats = {'rateLimited': 0, 'shed': 0, 'inFlight': 0}
+    admission_lock = threading.Lock()
+
+    def count_admission(field: str, delta: int = 1):
+        with admission_lock:
+            admission_stats[field] += delta
+
+    def too_busy(status: int, message: str, retry_after: float):
+        response = jsonify({'error': message})
+        response.status_code = status
+        response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+        return response
+
+    @app.before_request
+    def admit_request():
+        from flask import g
+        if not RATE_LIMIT_ENABLED or not request.path.startswith('/api') or request.method == 'OPTIONS':
+            return None
+        endpoint = request.endpoint or ''
+        if endpoint in ('health', 'metrics'):
+            return None
+        cost = ROUTE_COSTS.get(endpoint, 1)
+        buckets = [(f"ip:{request.remote_addr}", IP_RATE, IP_BURST)]
+        auth_header = request.headers.get('Authorization', '')
+        token = auth_header[7:] if auth_header.startswith('Bearer ') else request.args.get('token')
+        if token:
+            try:
+                user_id = jwt.decode(token, JWT_SECRET, algorithms=['HS256']).get('userId')
+                buckets.insert(0, (f"user:{user_id}", USER_RATE, USER_BURST))
+            except Exception:
+                pass
+        for key, rate, burst in buckets:
+            allowed, retry_after = rate_limit_store.consume(key, cost, rate, burst)
+            if not allowed:
+                count_admission('rateLimited')
+                return too_busy(429, 'Too many requests', retry_after)
+        if endpoint in UNLIMITED_ENDPOINTS:
+            return None
+        if not concurrency_slots.acquire(timeout=ADMISSION_WAIT_SECONDS):
+            count_admission('shed')
+            return too_busy(503, 'Server busy, please retry', 1)
+        g.holds_concurrency_slot = True
+        count_admission('inFlight')
+        return None
+
+    @app.teardown_request
+    def release_request(exc=None):
+        from flask import g
+        if g.pop('holds_concurrency_slot', False):
+            count_admission('inFlight', -1)
+            concurrency_slots.release()
+
+    # MongoDB resilience. Each request runs under a pymongo deadline (every
+    # operation gets maxTimeMS from the time left). Connection failures and
+    # timeouts feed the circuit breaker; while it is open, requests fail fast
+    # and GETs are answered from the last good response with a Warning header.
+    STALE_CACHE_SIZE = int(os.environ.get('STALE_CACHE_SIZE', '2000'))
+    STALE_MAX_BODY = 256 * 1024
+    stale_responses = OrderedDict()
+    stale_lock = threading.Lock()
+    stale_stats = {'served': 0, 'failedFast': 0}
+    # Streams and local-only routes never touch the database
+    BREAKER_EXEMPT = UNLIMITED_ENDPOINTS
+    # Authorized by something other than a JWT, so a cached copy could not be re-checked
+    STALE_EXEMPT = {'admin_changes'}
+
+    def request_identity() -> str:
+        auth_header = request.headers.get('Authorization', '')
+        token = auth_header[7:] if auth_header.startswith('Bearer ') else request.args.get('token')
+        if not token:
+            return ''
+        try:
+            return jwt.decode(token, JWT_SECRET, algorithms=['HS256']).get('userId') or ''
+        except Exception:
+            return ''
+
+    def stale_or_unavailable():
+        import time
+        from flask import Response
+        if request.method == 'GET':
+            with stale_lock:
+                entry = stale_responses.get((request_identity(), request.full_path))
+                if entry is not None:
+                    stale_stats['served'] += 1
+            if entry is not None:
+                body, mimetype, stored_at = entry
+                return Response(body, mimetype=mimetype, headers={
+                    'Warning': '110 - "Response is Stale"',
+                    'Age': str(int(time.monotonic() - stored_at)),
+                })
+        with stale_lock:
+            stale_stats['failedFast'] += 1
+        return too_busy(503, 'Database temporarily unavailable', mongo_breaker.reset_timeout)
+
+    def is_outage(e: Exception) -> bool:
+        from pymongo.errors import ConnectionFailure
+        return isinstance(e, ConnectionFailure) or getattr(e, 'timeout', False)
+
+    if use_db:
+        import pymongo
+        from pymongo.errors import PyMongoError
+
+        @app.before_request
+        def guard_database():
+            from flask import g
+            if not request.path.startswith('/api') or request.endpoint in BREAKER_EXEMPT \
+                    or request.method == 'OPTIONS':
+                return None
+            if not mongo_breaker.allow():
+                return stale_or_unavailable()
+            g.mongo_deadline = pymongo.timeout(MONGO_TIMEOUT_MS / 1000)
+            g.mongo_deadline.__enter__()
+            return None
 
-    import jwt
-    from werkzeug.security import generate_password_hash, check_password_hash
+        @app.after_request
+        def remember_response(response):
+            import time
+            if request.method == 'GET' and response.status_code == 200 and response.mimetype == 'application/json' \
+                    and not response.is_streamed and request.endpoint not in BREAKER_EXEMPT \
+                    and request.endpoint not in STALE_EXEMPT \
+                    and 'Warning' not in response.headers:
+                body = response.get_data()
+                if len(body) <= STALE_MAX_BODY:
+                    with stale_lock:
+                        key = (request_identity(), request.full_path)
+                        stale_responses[key] = (body, response.mimetype, time.monotonic())
+                        stale_responses.move_to_end(key)
+                        while len(stale_responses) > STALE_CACHE_SIZE:
+                            stale_responses.popitem(last=False)
+            return response
 
-    JWT_SECRET = os.environ.get('JWT_SECRET', 'dev-secret')
+        @app.teardown_request
+        def clear_database_deadline(exc=None):
+            from flask import g
+            deadline = g.pop('mongo_deadline', None)
+            if deadline is not None:
+                deadline.__exit__(None, None, None)
 
-    def generate_token(user_id: str, role: str) -> str:
-        payload = {
-            'userId': user_id,
-            'role': role,
-            'exp': now_utc() + timedelta(days=7)
-        }
-        return jwt.encode(payload, JWT_SECRET, algorithm='HS256')
+        @app.errorhandler(PyMongoError)
+        def database_error(e):
+            if not is_outage(e):
+                raise e
+            mongo_breaker.record_failure()
+            return stale_or_unavailable()
 
-    def auth_required(fn):
+    # Idempotency-Key support for create endpoints: a retried request with the same
+    # key (per user and route) gets the original response without re-running the
+    # write; concurrent duplicates wait for the first one to finish.
+    IDEMPOTENCY_TTL = float(os.environ.get('IDEMPOTENCY_TTL', '86400'))
+    if use_db and os.environ.get('IDEMPOTENCY_STORE', 'memory') == 'mongo':
+        idempotency_store = BreakerGuardedStore(MongoIdempotencyStore(db['idempotency_keys'], ttl=IDEMPOTENCY_TTL),
+                                                MemoryIdempotencyStore(ttl=IDEMPOTENCY_TTL),
+                                                mongo_breaker, MONGO_TIMEOUT_MS / 1000)
+    else:
+        idempotency_store = MemoryIdempotencyStore(ttl=IDEMPOTENCY_TTL)
+
+    def idempotent(fn):
         from functools import wraps
+        import hashlib
 
         @wraps(fn)
         def wrapper(*args, **kwargs):
-            auth_header = request.headers.get('Authorization', '')
-            token = auth_header.replace('Bearer ', '') if auth_header.startswith('Bearer ') else None
-            if not token:
-                return jsonify({'error': 'Unauthorized'}), 401
+            from flask import Response
+            client_key = request.headers.get('Idempotency-Key')
+            if not client_key:
+                return fn(*args, **kwargs)
+            if len(client_key) > 255:
+                return jsonify({'error': 'Idempotency-Key too long'}), 400
+            key = f"{request.user['userId']}:{request.endpoint}:{request.path}:{client_key}"
+            fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+            state, record = idempotency_store.begin(key, fingerprint)
+            if state == 'mismatch':
+                return jsonify({'error': 'Idempotency-Key was already used with a different request body'}), 422
+            if state == 'busy':
+                return jsonify({'error': 'A request with this Idempotency-Key is still in progress'}), 409
+            if state == 'done':
+                replay = Response(record['body'], status=record['status'], mimetype=record['mimetype'])
+                replay.headers['Idempotent-Replayed'] = 'true'
+                return replay
             try:
-                payload = jwt.decode(token, JWT_SECRET, algorithms=['HS256'])
+                response = app.make_response(fn(*args, **kwargs))
             except Exception:
-                return jsonify({'error': 'Unauthorized'}), 401
-            request.user = {'userId': payload.get('userId'), 'role': payload.get('role')}
-            return fn(*args, **kwargs)
+                idempotency_store.abort(key)
+                raise
+            if response.status_code >= 500:
+                # Server errors are not final; allow the client to retry for real
+                idempotency_store.abort(key)
+            else:
+                idempotency_store.complete(key, {
+                    'status': response.status_code,
+                    'body': response.get_data(as_text=True),
+                    'mimetype': response.mimetype,
+                })
+            return response
 
         return wrapper
 
+    def stream_auth_required(fn):
+        # EventSource cannot set headers, so streams also accept ?token=
+        return auth_required(fn, allow_query_token=True)
+
     # Auth routes
     @app.post('/api/auth/signup')
     def signup():
@@ -314,6 +2569,12 @@ def create_app() -> Flask:
                 'email': email,
                 'password': generate_password_hash(password)
             }
+            if role == 'doctor':
+                users[role][email]['specialty'] = body.get('specialty', 'General Physician')
+            record_change('user', role, users[role][email])
+
+        if role == 'doctor':
+            doctor_directory.add(user_id, name, body.get('specialty', 'General Physician'))
 
         token = generate_token(user_id, role)
         return jsonify({
@@ -380,6 +2641,41 @@ def create_app() -> Flask:
         safe.setdefault('phone', '0000000000')
         return jsonify(safe)
 
+    # Optional write-behind buffering for vitals: readings are made durable in a
+    # local log and acknowledged with 202, then flushed to the store in batches.
+    vitals_buffer = None
+    if os.environ.get('VITALS_WRITE_BEHIND', '').lower() in ('1', 'true', 'yes'):
+        def flush_vitals(batch: list):
+            if use_db:
+                from pymongo.errors import BulkWriteError
+                docs = []
+                for entry in batch:
+                    doc = {k: v for k, v in entry.items() if k != 'id'}
+                    doc['_id'] = storage_key(entry['id'])
+                    docs.append(doc)
+                try:
+                    db['vitals'].insert_many(docs, ordered=False)
+                except BulkWriteError as e:
+                    # Duplicate keys mean the batch was already written before a crash
+                    if any(err.get('code') != 11000 for err in e.details.get('writeErrors', [])):
+                        raise
+            else:
+                known = {v['id'] for v in vitals}
+                for entry in batch:
+                    if entry['id'] not in known:
+                        entry = compact('vitals', entry)
+                        vitals.append(entry)
+                        record_change('insert', 'vitals', entry)
+
+        vitals_buffer = WriteBehindBuffer(
+            os.environ.get('VITALS_WAL_PATH', os.path.join(DATA_DIR, 'vitals.wal')),
+            flush_vitals,
+            batch_size=int(os.environ.get('VITALS_FLUSH_BATCH', '100')),
+            interval=float(os.environ.get('VITALS_FLUSH_INTERVAL', '1.0')),
+        )
+        import atexit
+        atexit.register(lambda: vitals_buffer.flush())
+
     @app.get('/api/patient/vitals/latest')
     @auth_required
     def patient_vitals_latest():
@@ -389,41 +2685,168 @@ def create_app() -> Flask:
             for v in vs:
                 v['id'] = str(v.get('_id'))
                 v.pop('_id', None)
-            return jsonify(vs)
         else:
             vs = [v for v in vitals if v['patientId'] == user_id]
-            vs.sort(key=lambda x: x['createdAt'], reverse=True)
-            return jsonify(vs[:4])
+        if vitals_buffer is not None:
+            # Read through the buffer so users see readings that are not flushed yet
+            seen = {v['id'] for v in vs}
+            vs.extend(v for v in vitals_buffer.pending(lambda d: d['patientId'] == user_id) if v['id'] not in seen)
+        vs.sort(key=lambda x: x.get('createdAt') or '', reverse=True)
+        return jsonify(vs[:4])
 
     @app.post('/api/patient/vitals')
     @auth_required
+    @idempotent
     def patient_add_vitals():
         body = request.get_json(force=True, silent=True) or {}
+        if vitals_buffer is not None:
+            entry_id = new_id('vital')
+            entry = {
+                'id': entry_id,
+                'patientId': request.user['userId'],
+                'createdAt': iso_utc()
+            }
+            entry.update(body)
+            entry['id'] = entry_id
+            vitals_buffer.append(entry)
+            return jsonify(entry), 202
         if use_db:
             doc = {
                 'patientId': request.user['userId'],
                 'createdAt': iso_utc()
             }
             doc.update(body)
-            result = db['vitals'].insert_one(doc)
-            doc['id'] = str(result.inserted_id)
+            doc['_id'] = new_id('vital')
+            db['vitals'].insert_one(doc)
+            doc['id'] = doc.pop('_id')
             return jsonify(doc), 201
         else:
             entry = {
-                'id': f"v_{len(vitals)+1}",
+                'id': new_id('vital'),
                 'patientId': request.user['userId'],
                 'createdAt': iso_utc()
             }
             entry.update(body)
+            entry = compact('vitals', entry)
             vitals.append(entry)
+            record_change('insert', 'vitals', entry)
             return jsonify(entry), 201
 
+    # Bulk ingestion (device uploads / EHR sync)
+    MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', '500'))
+
+    def parse_batch_body():
+        # Accepts a JSON array, {"items": [...]}, or an NDJSON stream (one object per line).
+        # Returns (items, error); unparseable NDJSON lines are kept as exceptions so they
+        # are reported per item instead of failing the whole batch.
+        content_type = (request.content_type or '').split(';')[0].strip().lower()
+        if content_type in ('application/x-ndjson', 'application/ndjson', 'application/jsonl'):
+            import json
+            items = []
+            for line in request.get_data(as_text=True).splitlines():
+                if not line.strip():
+                    continue
+                try:
+                    items.append(json.loads(line))
+                except ValueError as e:
+                    items.append(ValueError(f'Invalid JSON: {e}'))
+        else:
+            body = request.get_json(force=True, silent=True)
+            if isinstance(body, dict):
+                body = body.get('items')
+            if not isinstance(body, list):
+                return None, 'Expected a JSON array, {"items": [...]} or NDJSON body'
+            items = body
+        if not items:
+            return None, 'Batch is empty'
+        if len(items) > MAX_BATCH_SIZE:
+            return None, f'Batch too large (max {MAX_BATCH_SIZE} items)'
+        return items, None
+
+    def validate_batch_item(item, required: tuple) -> str | None:
+        if isinstance(item, Exception):
+            return str(item)
+        if not isinstance(item, dict):
+            return 'Item must be an object'
+        missing = [f for f in required if item.get(f) in (None, '')]
+        if missing:
+            return f"Missing required field(s): {', '.join(missing)}"
+        return None
+
+    def insert_batch(collection_name: str, store: list, kind: str, docs: list) -> dict:
+        # Writes validated docs in one round trip; returns {position_in_docs: id or error}.
+        outcome = {}
+        if use_db:
+            for doc in docs:
+                doc['_id'] = new_id(kind)
+            from pymongo.errors import BulkWriteError
+            failed = {}
+            try:
+                db[collection_name].insert_many(docs, ordered=False)
+            except BulkWriteError as e:
+                for err in e.details.get('writeErrors', []):
+                    failed[err['index']] = err.get('errmsg', 'Write failed')
+            for pos, doc in enumerate(docs):
+                if pos in failed:
+                    outcome[pos] = {'error': failed[pos]}
+                else:
+                    doc['id'] = str(doc.pop('_id'))
+                    outcome[pos] = {'id': doc['id']}
+        else:
+            docs = [compact(collection_name, doc) for doc in docs]
+            for pos, doc in enumerate(docs):
+                doc['id'] = new_id(kind)
+                outcome[pos] = {'id': doc['id']}
+            store.extend(docs)
+            for doc in docs:
+                record_change('insert', collection_name, doc)
+            index_docs(collection_name, docs)
+        return outcome
+
+    def ingest_batch(collection_name: str, store: list, kind: str, required: tuple, defaults):
+        items, error = parse_batch_body()
+        if error:
+            return jsonify({'error': error}), 400
+        results = [None] * len(items)
+        docs = []
+        doc_index = []
+        for idx, item in enumerate(items):
+            problem = validate_batch_item(item, required)
+            if problem:
+                results[idx] = {'index': idx, 'status': 'error', 'error': problem}
+                continue
+            doc = defaults()
+            doc.update(item)
+            doc['patientId'] = request.user['userId']
+            doc.pop('_id', None)
+            doc.pop('id', None)
+            docs.append(doc)
+            doc_index.append(idx)
+        outcome = insert_batch(collection_name, store, kind, docs) if docs else {}
+        for pos, idx in enumerate(doc_index):
+            res = outcome[pos]
+            if 'error' in res:
+                results[idx] = {'index': idx, 'status': 'error', 'error': res['error']}
+            else:
+                results[idx] = {'index': idx, 'status': 'created', 'id': res['id']}
+        inserted = sum(1 for r in results if r['status'] == 'created')
+        status = 201 if inserted == len(items) else (207 if inserted else 400)
+        return jsonify({'inserted': inserted, 'failed': len(items) - inserted, 'results': results}), status
+
+    @app.post('/api/patient/vitals/batch')
+    @auth_required
+    @idempotent
+    def patient_add_vitals_batch():
+        return ingest_batch('vitals', vitals, 'vital', ('label', 'value'), lambda: {'createdAt': iso_utc()})
+
     @app.get('/api/patient/appointments/upcoming')
     @auth_required
     def patient_upcoming_appointment():
         user_id = request.user['userId']
         if use_db:
-            cur = db['appointments'].find({'patientId': user_id, 'status': 'scheduled', 'date': {'$exists': True}}).sort('date', 1).limit(1)
+            cur = db['appointments'].find({
+                'patientId': user_id, 'status': 'scheduled', 'startAt': {'$gte': start_of_day(now_utc())}
+            }).sort('startAt', 1).limit(1)
             arr = list(cur)
             if not arr:
                 return jsonify(None)
@@ -438,8 +2861,9 @@ def create_app() -> Flask:
                 'meetingLink': a.get('meetingLink')
             })
         else:
-            future = [a for a in appointments if a['patientId'] == user_id and a.get('status') == 'scheduled' and a.get('date')]
-            future.sort(key=lambda x: x['date'])
+            day_start = start_of_day(now_utc())
+            future = [a for a in appointments if a.get('patientId') == user_id and a.get('status') == 'scheduled' and a.get('startAt') and a['startAt'] >= day_start]
+            future.sort(key=lambda x: x['startAt'])
             if not future:
                 return jsonify(None)
             a = future[0]
@@ -458,7 +2882,7 @@ def create_app() -> Flask:
     def patient_appointments():
         user_id = request.user['userId']
         if use_db:
-            apts = list(db['appointments'].find({'patientId': user_id}).sort('date', -1))
+            apts = appointment_history({'patientId': user_id})
             formatted = []
             for a in apts:
                 apt_id = a.get('id') or str(a.get('_id'))
@@ -473,8 +2897,7 @@ def create_app() -> Flask:
                 })
             return jsonify(formatted)
         else:
-            apts = [a for a in appointments if a['patientId'] == user_id]
-            apts.sort(key=lambda x: (x.get('date') or ''), reverse=True)
+            apts = appointment_history({'patientId': user_id})
             formatted = [{
                 'id': a['id'],
                 'doctorName': a.get('doctorName', 'Unknown Doctor'),
@@ -488,8 +2911,10 @@ def create_app() -> Flask:
 
     @app.post('/api/patient/appointments')
     @auth_required
+    @idempotent
     def patient_book_appointment():
         body = request.get_json(force=True, silent=True) or {}
+        body = {k: v for k, v in body.items() if k not in WINDOW_FIELDS}
         user_id = request.user['userId']
         
         # Get patient name from database/memory if not provided
@@ -516,18 +2941,28 @@ def create_app() -> Flask:
             }
             doc.update(body)
             doc.setdefault('status', 'scheduled')
-            result = db['appointments'].insert_one(doc)
-            doc['id'] = str(result.inserted_id)
+            doc.update(appointment_window(doc.get('date'), doc.get('time'), doc.get('duration')))
+            doc['_id'] = new_id('appointment')
+            db['appointments'].insert_one(doc)
+            doc['id'] = doc.pop('_id')
+            publish_appointment_event('appointment.booked', doc)
+            schedule_reminder(doc)
             return jsonify(doc), 201
         else:
             new_apt = {
-                'id': f"apt_{len(appointments)+1}",
+                'id': new_id('appointment'),
                 'patientId': user_id,
                 'patientName': patient_name,
             }
             new_apt.update(body)
             new_apt.setdefault('status', 'scheduled')
-            appointments.append(new_apt)
+            new_apt.update(appointment_window(new_apt.get('date'), new_apt.get('time'), new_apt.get('duration')))
+            new_apt = compact('appointments', new_apt)
+            with appointments_lock:
+                appointments.append(new_apt)
+            record_change('insert', 'appointments', new_apt)
+            publish_appointment_event('appointment.booked', new_apt)
+            schedule_reminder(new_apt)
             return jsonify(new_apt), 201
 
     @app.get('/api/patient/records/recent')
@@ -569,18 +3004,32 @@ def create_app() -> Flask:
                 'patientId': request.user['userId']
             }
             doc.update(body)
-            result = db['health_records'].insert_one(doc)
-            doc['id'] = str(result.inserted_id)
+            doc['_id'] = new_id('health_record')
+            db['health_records'].insert_one(doc)
+            doc['id'] = doc.pop('_id')
             return jsonify(doc), 201
         else:
             record = {
-                'id': f"rec_{len(health_records)+1}",
+                'id': new_id('health_record'),
                 'patientId': request.user['userId']
             }
             record.update(body)
             health_records.append(record)
+            record_change('insert', 'health_records', record)
+            index_docs('health_records', [record])
             return jsonify(record), 201
 
+    @app.post('/api/patient/records/batch')
+    @auth_required
+    @idempotent
+    def patient_add_records_batch():
+        return ingest_batch('health_records', health_records, 'health_record', ('title',), dict)
+
+    @app.get('/api/patient/records/search')
+    @auth_required
+    def patient_search_records():
+        return search_response('health_records', {'patientId': request.user['userId']})
+
     @app.get('/api/patient/prescriptions')
     @auth_required
     def patient_prescriptions():
@@ -601,7 +3050,7 @@ def create_app() -> Flask:
     def patient_consultations():
         user_id = request.user['userId']
         if use_db:
-            cons = list(db['appointments'].find({'patientId': user_id, 'status': 'completed'}).sort('date', -1))
+            cons = appointment_history({'patientId': user_id, 'status': 'completed'})
             formatted = [{
                 'id': str(a.get('_id')),
                 'doctorName': a.get('doctorName', 'Unknown Doctor'),
@@ -614,8 +3063,7 @@ def create_app() -> Flask:
             } for a in cons]
             return jsonify(formatted)
         else:
-            cons = [a for a in appointments if a['patientId'] == user_id and a.get('status') == 'completed']
-            cons.sort(key=lambda x: x.get('date') or '', reverse=True)
+            cons = appointment_history({'patientId': user_id, 'status': 'completed'})
             formatted = [{
                 'id': a['id'],
                 'doctorName': a.get('doctorName', 'Unknown Doctor'),
@@ -628,6 +3076,80 @@ def create_app() -> Flask:
             } for a in cons]
             return jsonify(formatted)
 
+    # Merged medical timeline: each source is already sorted newest-first (index
+    # backed in Mongo), and a heap merge pulls from them lazily until the page is
+    # full, so no source is read past what is shown.
+    TIMELINE_SOURCES = (
+        # kind, collection, date field
+        ('appointment', 'appointments', 'date'),
+        ('record', 'health_records', 'date'),
+        ('prescription', 'prescriptions', 'date'),
+        ('vital', 'vitals', 'createdAt'),
+    )
+
+    def timeline_title(kind: str, doc: dict) -> str:
+        if kind == 'appointment':
+            return f"{doc.get('type') or 'Appointment'} with {doc.get('doctorName') or 'doctor'}"
+        if kind == 'record':
+            return doc.get('title') or 'Health record'
+        if kind == 'prescription':
+            meds = ', '.join(m.get('name', '') for m in doc.get('medications') or [] if isinstance(m, dict))
+            return doc.get('diagnosis') or meds or 'Prescription'
+        return f"{doc.get('label', 'Vital')}: {doc.get('value', '')}".strip()
+
+    def timeline_source(kind: str, collection_name: str, date_field: str, patient_id: str, before: str | None, limit: int):
+        # Yields (date, kind, doc) newest first, at or before the cursor date
+        if use_db:
+            filt = {'patientId': patient_id, date_field: {'$lte': before} if before else {'$exists': True}}
+            if kind == 'appointment':
+                rows = appointment_history(filt, date_field)
+            else:
+                rows = db[collection_name].find(filt).sort([(date_field, -1), ('_id', -1)]).limit(limit).batch_size(limit)
+        else:
+            if kind == 'appointment':
+                rows = appointment_history({'patientId': patient_id}, date_field)
+            else:
+                store = {'health_records': health_records, 'prescriptions': prescriptions, 'vitals': vitals}[collection_name]
+                rows = sorted((d for d in store if d.get('patientId') == patient_id),
+                              key=lambda d: str(d.get(date_field) or ''), reverse=True)
+        for doc in rows:
+            date_key = str(doc.get(date_field) or '')
+            if not date_key or (before and date_key > before):
+                continue
+            yield date_key, kind, doc
+
+    def build_timeline(patient_id: str):
+        # Keyset pagination: (before, skip) = date of the last item shown and how
+        # many items with exactly that date were already returned.
+        try:
+            limit = min(max(int(request.args.get('limit', 20)), 1), 100)
+            skip = max(int(request.args.get('skip', 0)), 0)
+        except ValueError:
+            return jsonify({'error': 'limit and skip must be integers'}), 400
+        before = request.args.get('before') or None
+        sources = [timeline_source(kind, coll, field, patient_id, before, limit + skip) for kind, coll, field in TIMELINE_SOURCES]
+        to_skip = skip if before else 0
+        items = []
+        for date_key, kind, doc in heapq.merge(*sources, key=lambda x: x[0], reverse=True):
+            if to_skip and date_key == before:
+                to_skip -= 1
+                continue
+            data = {k: v for k, v in doc.items() if k != '_id'}
+            data['id'] = doc.get('id') or str(doc.get('_id'))
+            items.append({'kind': kind, 'date': date_key, 'id': data['id'], 'title': timeline_title(kind, doc), 'data': data})
+            if len(items) >= limit:
+                break
+        next_before = next_skip = None
+        if len(items) == limit:
+            next_before = items[-1]['date']
+            next_skip = sum(1 for i in items if i['date'] == next_before) + (skip if next_before == before else 0)
+        return jsonify({'items': items, 'nextBefore': next_before, 'nextSkip': next_skip})
+
+    @app.get('/api/patient/timeline')
+    @auth_required
+    def patient_timeline():
+        return build_timeline(request.user['userId'])
+
     # Doctor routes
     @app.get('/api/doctor/profile')
     @auth_required
@@ -657,22 +3179,23 @@ def create_app() -> Flask:
     @auth_required
     def doctor_stats():
         user_id = request.user['userId']
-        today = now_utc().date()
-        def is_today(date_str: str) -> bool:
-            try:
-                return datetime.fromisoformat(date_str.replace('Z','')).date() == today
-            except Exception:
-                return False
+        day_start = start_of_day(now_utc())
+        day_end = day_start + timedelta(days=1)
         if use_db:
-            today_appointments = db['appointments'].count_documents({'doctorId': user_id, 'status': 'scheduled'})
+            today_appointments = db['appointments'].count_documents({
+                'doctorId': user_id, 'status': 'scheduled', 'startAt': {'$gte': day_start, '$lt': day_end}
+            })
             waiting_patients = db['appointments'].count_documents({'doctorId': user_id, 'status': 'scheduled'})
-            total_patients = len(set([a['patientId'] for a in db['appointments'].find({'doctorId': user_id}, {'patientId': 1})]))
-            total_consultations = db['appointments'].count_documents({'doctorId': user_id, 'status': 'completed'})
+            total_patients = len(set(db['appointments'].distinct('patientId', {'doctorId': user_id}))
+                                 | set(db['appointments_archive'].distinct('patientId', {'doctorId': user_id})))
+            total_consultations = db['appointments'].count_documents({'doctorId': user_id, 'status': 'completed'}) \
+                + db['appointments_archive'].count_documents({'doctorId': user_id, 'status': 'completed'})
         else:
-            today_appointments = len([a for a in appointments if a.get('doctorId') == user_id and a.get('status') == 'scheduled' and a.get('date') and is_today(a['date'])])
+            today_appointments = len([a for a in appointments if a.get('doctorId') == user_id and a.get('status') == 'scheduled' and a.get('startAt') and day_start <= a['startAt'] < day_end])
             waiting_patients = len([a for a in appointments if a.get('doctorId') == user_id and a.get('status') == 'scheduled'])
-            total_patients = len({a['patientId'] for a in appointments if a.get('doctorId') == user_id})
-            total_consultations = len([a for a in appointments if a.get('doctorId') == user_id and a.get('status') == 'completed'])
+            history = list(itertools.chain(appointments, appointments_archive))
+            total_patients = len({a['patientId'] for a in history if a.get('doctorId') == user_id and a.get('patientId')})
+            total_consultations = len([a for a in history if a.get('doctorId') == user_id and a.get('status') == 'completed'])
         stats = [
             { 'label': "Today's Appointments", 'value': str(today_appointments), 'icon': 'Calendar', 'color': 'text-primary' },
             { 'label': 'Waiting Patients', 'value': str(waiting_patients), 'icon': 'Clock', 'color': 'text-warning' },
@@ -685,19 +3208,13 @@ def create_app() -> Flask:
     @auth_required
     def doctor_upcoming_consultations():
         user_id = request.user['userId']
-        today = now_utc().date()
-        def is_today_or_future(date_str: str) -> bool:
-            try:
-                apt_date = datetime.fromisoformat(date_str.replace('Z','')).date()
-                return apt_date >= today
-            except Exception:
-                return False
+        day_start = start_of_day(now_utc())
         if use_db:
-            cons = list(db['appointments'].find({'doctorId': user_id, 'status': 'scheduled'}).sort('time', 1))
+            cons = list(db['appointments'].find({
+                'doctorId': user_id, 'status': 'scheduled', 'startAt': {'$gte': day_start}
+            }).sort('startAt', 1))
             formatted = []
             for a in cons:
-                if not is_today_or_future(a.get('date', '')):
-                    continue
                 patient_name = a.get('patientName', 'Unknown Patient')
                 if patient_name == 'Unknown Patient':
                     try:
@@ -719,8 +3236,8 @@ def create_app() -> Flask:
                 })
             return jsonify(formatted)
         else:
-            cons = [a for a in appointments if a.get('doctorId') == user_id and a.get('status') == 'scheduled' and a.get('date') and is_today_or_future(a['date'])]
-            cons.sort(key=lambda x: x.get('time') or '')
+            cons = [a for a in appointments if a.get('doctorId') == user_id and a.get('status') == 'scheduled' and a.get('startAt') and a['startAt'] >= day_start]
+            cons.sort(key=lambda x: x['startAt'])
             formatted = []
             for a in cons:
                 patient_name = a.get('patientName', 'Unknown Patient')
@@ -746,7 +3263,7 @@ def create_app() -> Flask:
     def doctor_recent_patients():
         user_id = request.user['userId']
         if use_db:
-            cons = list(db['appointments'].find({'doctorId': user_id, 'status': 'completed'}).sort('date', -1))
+            cons = appointment_history({'doctorId': user_id, 'status': 'completed'})
             formatted = []
             seen = set()
             for a in cons:
@@ -765,8 +3282,7 @@ def create_app() -> Flask:
                     break
             return jsonify(formatted)
         else:
-            cons = [a for a in appointments if a.get('doctorId') == user_id and a.get('status') == 'completed']
-            cons.sort(key=lambda x: x.get('date') or '', reverse=True)
+            cons = appointment_history({'doctorId': user_id, 'status': 'completed'})
             formatted = []
             seen = set()
             for a in cons:
@@ -789,8 +3305,16 @@ def create_app() -> Flask:
     @auth_required
     def doctor_schedule():
         user_id = request.user['userId']
+        try:
+            start, end = schedule_window()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        rule_entries = rule_schedule_entries(user_id, start, end)
         if use_db:
-            sched = list(db['appointments'].find({'doctorId': user_id, 'status': {'$ne': 'cancelled'}}).sort([('date', 1), ('time', 1)]))
+            sched = list(db['appointments'].find({
+                'doctorId': user_id, 'status': {'$ne': 'cancelled'}, 'startAt': {'$gte': start, '$lt': end},
+            }).sort('startAt', 1))
+            sched = list(heapq.merge(sched, rule_entries, key=schedule_sort_key))
             formatted = [{
                 'id': str(a.get('_id')),
                 'patientName': a.get('patientName', 'Unknown Patient'),
@@ -803,8 +3327,10 @@ def create_app() -> Flask:
             } for a in sched]
             return jsonify(formatted)
         else:
-            sched = [a for a in appointments if a.get('doctorId') == user_id and a.get('status') != 'cancelled']
-            sched.sort(key=lambda x: (x.get('date') or '', x.get('time') or ''))
+            sched = [a for a in appointments if a.get('doctorId') == user_id and a.get('status') != 'cancelled'
+                     and a.get('startAt') and start <= a['startAt'] < end]
+            sched.extend(rule_entries)
+            sched.sort(key=schedule_sort_key)
             formatted = [{
                 'id': a['id'],
                 'patientName': a.get('patientName', 'Unknown Patient'),
@@ -823,7 +3349,7 @@ def create_app() -> Flask:
         user_id = request.user['userId']
         if use_db:
             pts = {}
-            for a in db['appointments'].find({'doctorId': user_id}):
+            for a in appointment_history({'doctorId': user_id}):
                 pid = a.get('patientId')
                 if pid and pid not in pts:
                     # Try to get patient details from patients collection
@@ -863,7 +3389,7 @@ def create_app() -> Flask:
             return jsonify(list(pts.values()))
         else:
             pts = {}
-            for a in appointments:
+            for a in itertools.chain(appointments, appointments_archive):
                 if a.get('doctorId') == user_id:
                     pid = a.get('patientId')
                     if pid and pid not in pts:
@@ -884,14 +3410,22 @@ def create_app() -> Flask:
                         }
             return jsonify(list(pts.values()))
 
+    @app.get('/api/doctor/patients/<patient_id>/timeline')
+    @auth_required
+    def doctor_patient_timeline(patient_id):
+        user_id = request.user['userId']
+        # Doctors only see patients they have (or had) appointments with
+        if not next(iter(appointment_history({'doctorId': user_id, 'patientId': patient_id})), None):
+            return jsonify({'error': 'Patient not found'}), 404
+        return build_timeline(patient_id)
+
     @app.get('/api/doctor/consultations')
     @auth_required
     def doctor_consultations():
         user_id = request.user['userId']
-        cons = [a for a in appointments if a.get('doctorId') == user_id and a.get('status') == 'completed']
-        cons.sort(key=lambda x: x.get('date') or '', reverse=True)
+        cons = appointment_history({'doctorId': user_id, 'status': 'completed'})
         formatted = [{
-            'id': a['id'],
+            'id': a.get('id') or str(a.get('_id')),
             'patientName': a.get('patientName', 'Unknown Patient'),
             'patientId': a.get('patientId'),
             'date': a.get('date'),
@@ -934,160 +3468,426 @@ def create_app() -> Flask:
 
     @app.post('/api/doctor/prescriptions')
     @auth_required
+    @idempotent
     def doctor_create_prescription():
         body = request.get_json(force=True, silent=True) or {}
         if use_db:
             doc = {'doctorId': request.user['userId']}
             doc.update(body)
-            result = db['prescriptions'].insert_one(doc)
-            return jsonify({'message': 'Prescription created successfully', 'id': str(result.inserted_id)}), 201
+            doc['_id'] = new_id('prescription')
+            db['prescriptions'].insert_one(doc)
+            publish_prescription_event(doc, doc['_id'])
+            return jsonify({'message': 'Prescription created successfully', 'id': doc['_id']}), 201
         else:
             p = {
-                'id': f"pr_{len(prescriptions)+1}",
+                'id': new_id('prescription'),
                 'doctorId': request.user['userId']
             }
             p.update(body)
+            p = compact('prescriptions', p)
             prescriptions.append(p)
+            record_change('insert', 'prescriptions', p)
+            index_docs('prescriptions', [p])
+            publish_prescription_event(p, p['id'])
             return jsonify({'message': 'Prescription created successfully', 'id': p['id']}), 201
 
+    @app.get('/api/doctor/prescriptions/search')
+    @auth_required
+    def doctor_search_prescriptions():
+        return search_response('prescriptions', {'doctorId': request.user['userId']})
+
     @app.get('/api/doctor/messages')
     @auth_required
     def doctor_messages():
         return jsonify([])
 
+    # Single-flight for hot shared reads: concurrent identical requests (same
+    # route, params and visibility scope) share one backend call and one
+    # serialized body. Only use for responses that do not depend on the caller.
+    single_flight = SingleFlight()
+
+    def coalesced_json(route: str, params: tuple, compute, scope: str = 'authenticated'):
+        from flask import Response
+        body = single_flight.do((route, scope, params), lambda: app.json.dumps(compute()))
+        return Response(body, mimetype='application/json')
+
     # Get all doctors for appointment booking
     @app.get('/api/doctors')
     @auth_required
     def get_all_doctors():
-        if use_db:
-            doctors = list(db['doctors'].find({}, {'password': 0}).sort('name', 1))
-            for d in doctors:
-                d['id'] = str(d.get('_id'))
-                d.pop('_id', None)
-            return jsonify(doctors)
-        else:
+        def compute():
+            if use_db:
+                doctors = list(db['doctors'].find({}, {'password': 0}).sort('name', 1))
+                for d in doctors:
+                    d['id'] = str(d.get('_id'))
+                    d.pop('_id', None)
+                return doctors
             doctors = []
             for email, doctor in users['doctor'].items():
                 safe_doctor = {k: v for k, v in doctor.items() if k != 'password'}
                 safe_doctor['id'] = doctor['_id']
                 safe_doctor['email'] = email
                 doctors.append(safe_doctor)
-            return jsonify(sorted(doctors, key=lambda x: x.get('name', '')))
+            return sorted(doctors, key=lambda x: x.get('name', ''))
+        return coalesced_json('doctors', (), compute)
+
+    # Doctor directory search (compact listings; full profile via /api/doctors/<id>)
+    doctor_directory = DoctorDirectory()
+    DOCTOR_INDEX_TTL = int(os.environ.get('DOCTOR_INDEX_TTL', '300'))
+
+    def load_doctor_directory():
+        if use_db:
+            rows = db['doctors'].find({}, {'name': 1, 'specialty': 1})
+            doctor_directory.replace_all([
+                (str(d['_id']), d.get('name', ''), d.get('specialty', 'General Physician')) for d in rows
+            ])
+        else:
+            doctor_directory.replace_all([
+                (d['_id'], d.get('name', ''), d.get('specialty', 'General Physician')) for d in users['doctor'].values()
+            ])
+
+    load_doctor_directory()
+
+    @app.get('/api/doctors/search')
+    @auth_required
+    def search_doctors():
+        # Other workers' signups only reach this worker's index on refresh
+        if use_db and (now_utc() - doctor_directory.loaded_at).total_seconds() > DOCTOR_INDEX_TTL:
+            # Requests that all see a stale index share one reload
+            single_flight.do(('doctors.directory', 'reload', ()), load_doctor_directory)
+        try:
+            limit = min(max(int(request.args.get('limit', 20)), 1), 100)
+        except ValueError:
+            return jsonify({'error': 'limit must be an integer'}), 400
+        specialty = (request.args.get('specialty') or '').strip()
+        q = (request.args.get('q') or '').strip()
+        return coalesced_json('doctors.search', (specialty.lower(), q.lower(), limit),
+                              lambda: doctor_directory.search(specialty, q, limit))
+
+    @app.get('/api/doctors/<doctor_id>')
+    @auth_required
+    def get_doctor(doctor_id):
+        if use_db:
+            try:
+                from bson import ObjectId
+                doctor = db['doctors'].find_one({'_id': ObjectId(doctor_id)}, {'password': 0})
+            except Exception:
+                doctor = None
+            if not doctor:
+                return jsonify({'error': 'Doctor not found'}), 404
+            doctor['id'] = str(doctor.pop('_id'))
+        else:
+            found = next((u for u in users['doctor'].values() if u['_id'] == doctor_id), None)
+            if not found:
+                return jsonify({'error': 'Doctor not found'}), 404
+            doctor = {k: v for k, v in found.items() if k != 'password'}
+            doctor['id'] = doctor['_id']
+        doctor.setdefault('specialty', 'General Physician')
+        return jsonify(doctor)
 
     # Get doctor's available slots for a week
     @app.get('/api/doctors/<doctor_id>/availability')
     @auth_required
     def get_doctor_availability(doctor_id):
-        # Get all appointments for this doctor
-        if use_db:
-            booked = list(db['appointments'].find({'doctorId': doctor_id, 'status': 'scheduled'}))
-        else:
-            booked = [a for a in appointments if a.get('doctorId') == doctor_id and a.get('status') == 'scheduled']
-        
-        # Create booked slots map
-        booked_slots = {}
-        for apt in booked:
-            date_str = apt.get('date', '')[:10] if apt.get('date') else ''
-            time_str = apt.get('time', '')
-            if date_str and time_str:
-                key = f"{date_str}_{time_str}"
-                booked_slots[key] = True
-        
-        return jsonify({'bookedSlots': booked_slots})
+        try:
+            start, end = schedule_window()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        def compute():
+            # Get all appointments (and one-off blocks) for this doctor
+            if use_db:
+                booked = list(db['appointments'].find({'doctorId': doctor_id, 'status': {'$in': ['scheduled', 'blocked']}},
+                                                      {'date': 1, 'time': 1}))
+            else:
+                booked = [a for a in appointments
+                          if a.get('doctorId') == doctor_id and a.get('status') in ('scheduled', 'blocked')]
+
+            # Create booked slots map
+            booked_slots = {}
+            for apt in booked:
+                date_str = apt.get('date', '')[:10] if apt.get('date') else ''
+                time_str = apt.get('time', '')
+                if date_str and time_str:
+                    key = f"{date_str}_{time_str}"
+                    booked_slots[key] = True
+
+            # Recurring rules are expanded for the requested window only
+            rules = load_schedule_rules(doctor_id)
+            for slot_start, _ in rule_slots([r for r in rules if r.get('kind') == 'block'], start, end):
+                booked_slots[f"{slot_start.date().isoformat()}_{slot_label(slot_start)}"] = True
+            result = {'bookedSlots': booked_slots}
+            open_rules = [r for r in rules if r.get('kind') == 'availability']
+            if open_rules:
+                result['availableSlots'] = {f"{slot_start.date().isoformat()}_{slot_label(slot_start)}": True
+                                            for slot_start, _ in rule_slots(open_rules, start, end)}
+            return result
+
+        return coalesced_json('doctors.availability', (doctor_id, start, end), compute)
 
     @app.route('/api/patient/appointments/<appointment_id>/cancel', methods=['POST', 'PUT'])
     @auth_required
     def cancel_appointment(appointment_id):
         user_id = request.user['userId']
         if use_db:
-            try:
-                from bson import ObjectId
-                result = db['appointments'].update_one(
-                    {'$or': [{'_id': ObjectId(appointment_id)}, {'id': appointment_id}], 'patientId': user_id},
-                    {'$set': {'status': 'cancelled'}}
-                )
-                if result.matched_count == 0:
-                    return jsonify({'error': 'Appointment not found'}), 404
-                return jsonify({'message': 'Appointment cancelled successfully'})
-            except Exception as e:
-                result = db['appointments'].update_one(
-                    {'id': appointment_id, 'patientId': user_id},
-                    {'$set': {'status': 'cancelled'}}
-                )
-                if result.matched_count == 0:
-                    return jsonify({'error': 'Appointment not found'}), 404
-                return jsonify({'message': 'Appointment cancelled successfully'})
+            from pymongo import ReturnDocument
+            apt = db['appointments'].find_one_and_update(
+                dict(id_filter(appointment_id), patientId=user_id),
+                {'$set': {'status': 'cancelled'}},
+                return_document=ReturnDocument.AFTER
+            )
+            if not apt:
+                return jsonify({'error': 'Appointment not found'}), 404
         else:
-            apt = next((a for a in appointments if a['id'] == appointment_id and a['patientId'] == user_id), None)
+            apt = find_row(appointments, appointment_id, patientId=user_id)
             if not apt:
                 return jsonify({'error': 'Appointment not found'}), 404
             apt['status'] = 'cancelled'
-            return jsonify({'message': 'Appointment cancelled successfully'})
+            record_change('update', 'appointments', (apt['id'], {'status': 'cancelled'}))
+        publish_appointment_event('appointment.cancelled', apt)
+        return jsonify({'message': 'Appointment cancelled successfully'})
 
     @app.route('/api/doctor/appointments/<appointment_id>', methods=['PUT'])
     @auth_required
     def doctor_update_appointment(appointment_id):
         user_id = request.user['userId']
         body = request.get_json(force=True, silent=True) or {}
+        # Identity and ownership are not editable (doctorId also picks the partition);
+        # startAt/endAt follow date/time/duration
+        body = {k: v for k, v in body.items() if k not in ('_id', 'id', 'doctorId', 'patientId') + WINDOW_FIELDS}
         if use_db:
-            try:
-                from bson import ObjectId
-                result = db['appointments'].update_one(
-                    {'$or': [{'_id': ObjectId(appointment_id)}, {'id': appointment_id}], 'doctorId': user_id},
-                    {'$set': body}
-                )
-                if result.matched_count == 0:
-                    return jsonify({'error': 'Appointment not found'}), 404
-                return jsonify({'message': 'Appointment updated successfully'})
-            except Exception:
-                result = db['appointments'].update_one(
-                    {'id': appointment_id, 'doctorId': user_id},
-                    {'$set': body}
-                )
-                if result.matched_count == 0:
-                    return jsonify({'error': 'Appointment not found'}), 404
-                return jsonify({'message': 'Appointment updated successfully'})
+            from pymongo import ReturnDocument
+            apt = db['appointments'].find_one_and_update(
+                dict(id_filter(appointment_id), doctorId=user_id),
+                {'$set': body},
+                return_document=ReturnDocument.AFTER
+            )
+            if not apt:
+                return jsonify({'error': 'Appointment not found'}), 404
+            if {'date', 'time', 'duration'} & body.keys():
+                window = appointment_window(apt.get('date'), apt.get('time'), apt.get('duration'))
+                if window:
+                    db['appointments'].update_one({'_id': apt['_id']}, {'$set': window})
+                    apt.update(window)
         else:
-            apt = next((a for a in appointments if a['id'] == appointment_id and a['doctorId'] == user_id), None)
+            apt = find_row(appointments, appointment_id, doctorId=user_id)
             if not apt:
                 return jsonify({'error': 'Appointment not found'}), 404
             apt.update(body)
-            return jsonify({'message': 'Appointment updated successfully'})
+            changes = dict(body)
+            if {'date', 'time', 'duration'} & body.keys():
+                changes.update(appointment_window(apt.get('date'), apt.get('time'), apt.get('duration')))
+                apt.update(changes)
+            record_change('update', 'appointments', (apt['id'], changes))
+        publish_appointment_event('appointment.updated', apt, changes=body)
+        if {'date', 'time', 'duration', 'status'} & body.keys():
+            schedule_reminder(apt)
+        return jsonify({'message': 'Appointment updated successfully'})
 
     @app.route('/api/doctor/appointments/<appointment_id>/cancel', methods=['POST'])
     @auth_required
     def doctor_cancel_appointment(appointment_id):
         user_id = request.user['userId']
         if use_db:
-            try:
-                from bson import ObjectId
-                result = db['appointments'].update_one(
-                    {'$or': [{'_id': ObjectId(appointment_id)}, {'id': appointment_id}], 'doctorId': user_id},
-                    {'$set': {'status': 'cancelled'}}
-                )
-                if result.matched_count == 0:
-                    return jsonify({'error': 'Appointment not found'}), 404
-                return jsonify({'message': 'Appointment cancelled successfully'})
-            except Exception:
-                result = db['appointments'].update_one(
-                    {'id': appointment_id, 'doctorId': user_id},
-                    {'$set': {'status': 'cancelled'}}
-                )
-                if result.matched_count == 0:
-                    return jsonify({'error': 'Appointment not found'}), 404
-                return jsonify({'message': 'Appointment cancelled successfully'})
+            from pymongo import ReturnDocument
+            apt = db['appointments'].find_one_and_update(
+                dict(id_filter(appointment_id), doctorId=user_id),
+                {'$set': {'status': 'cancelled'}},
+                return_document=ReturnDocument.AFTER
+            )
+            if not apt:
+                return jsonify({'error': 'Appointment not found'}), 404
         else:
-            apt = next((a for a in appointments if a['id'] == appointment_id and a['doctorId'] == user_id), None)
+            apt = find_row(appointments, appointment_id, doctorId=user_id)
             if not apt:
                 return jsonify({'error': 'Appointment not found'}), 404
             apt['status'] = 'cancelled'
-            return jsonify({'message': 'Appointment cancelled successfully'})
+            record_change('update', 'appointments', (apt['id'], {'status': 'cancelled'}))
+        publish_appointment_event('appointment.cancelled', apt)
+        return jsonify({'message': 'Appointment cancelled successfully'})
+
+    # Recurring schedule rules. A rule ("every Friday 1-5 PM until June") is stored
+    # once and expanded only for the window a query asks about, instead of one
+    # blocked pseudo-appointment per occurrence. kind='block' rules take their
+    # hours out of availability; when a doctor has kind='availability' rules,
+    # only the hours they cover are bookable.
+    SCHEDULE_RULE_KINDS = ('block', 'availability')
+    SCHEDULE_WINDOW_DAYS = 7
+    MAX_SCHEDULE_WINDOW_DAYS = 366
+    SLOT_MINUTES = 60
+
+    if use_db:
+        try:
+            db['schedule_rules'].create_index([('doctorId', 1), ('kind', 1)])
+        except Exception:
+            pass
+
+    def schedule_window() -> tuple:
+        # ?from=YYYY-MM-DD&days=N, defaulting to the week starting today
+        start = appointment_window(request.args.get('from') or now_utc().date().isoformat()).get('startAt')
+        if start is None:
+            raise ValueError('from must be YYYY-MM-DD')
+        try:
+            days = int(request.args.get('days', SCHEDULE_WINDOW_DAYS))
+        except ValueError:
+            raise ValueError('days must be an integer')
+        days = min(max(days, 1), MAX_SCHEDULE_WINDOW_DAYS)
+        start = start_of_day(start)
+        return start, start + timedelta(days=days)
+
+    def schedule_sort_key(a: dict):
+        return (a.get('startAt') is not None, a.get('startAt') or now_utc())
+
+    def load_schedule_rules(doctor_id: str, kind: str | None = None) -> list:
+        filt = {'doctorId': doctor_id}
+        if kind:
+            filt['kind'] = kind
+        if use_db:
+            rules = list(db['schedule_rules'].find(filt))
+            for r in rules:
+                r['id'] = str(r.pop('_id'))
+            return rules
+        return [r for r in schedule_rules if all(r.get(k) == v for k, v in filt.items())]
+
+    def rule_slots(rules: list, start: datetime, end: datetime):
+        # (slot start, rule) for every SLOT_MINUTES grid slot an occurrence touches
+        for rule in rules:
+            for occ_start, occ_end in rule_occurrences(rule, start, end):
+                t = occ_start.replace(minute=0, second=0, microsecond=0)
+                while t < occ_end:
+                    if start <= t < end:
+                        yield t, rule
+                    t += timedelta(minutes=SLOT_MINUTES)
+
+    def rule_schedule_entries(doctor_id: str, start: datetime, end: datetime) -> list:
+        # Virtual blocked entries shaped like stored appointments; the id
+        # '<ruleId>@<date>' lets the dashboard lift a single occurrence.
+        entries = []
+        for slot_start, rule in rule_slots(load_schedule_rules(doctor_id, 'block'), start, end):
+            occurrence_id = f"{rule['id']}@{slot_start.date().isoformat()}"
+            entries.append({
+                '_id': occurrence_id,
+                'id': occurrence_id,
+                'ruleId': rule['id'],
+                'doctorId': doctor_id,
+                'patientName': 'Blocked',
+                'date': slot_start.date().isoformat(),
+                'time': slot_label(slot_start),
+                'type': 'Blocked',
+                'status': 'blocked',
+                'healthIssue': rule.get('notes') or 'N/A',
+                'startAt': slot_start,
+            })
+        return entries
+
+    def valid_time(value, fmt: str) -> bool:
+        try:
+            datetime.strptime(str(value).strip().upper(), fmt)
+            return True
+        except ValueError:
+            return False
+
+    def create_schedule_rule(user_id: str, body: dict, kind: str):
+        # Returns (rule, error message)
+        if kind not in SCHEDULE_RULE_KINDS:
+            return None, f"kind must be one of {', '.join(SCHEDULE_RULE_KINDS)}"
+        try:
+            parsed = parse_rrule(body.get('rrule'))
+        except ValueError as e:
+            return None, str(e)
+        dtstart = str(body.get('dtstart') or body.get('date') or '')[:10]
+        try:
+            start_date = datetime.strptime(dtstart, '%Y-%m-%d').date()
+        except ValueError:
+            return None, 'dtstart (or date) must be YYYY-MM-DD'
+        try:
+            check_rrule(parsed, start_date)
+        except ValueError as e:
+            return None, str(e)
+        start_time = body.get('startTime') or body.get('time')
+        if not start_time:
+            return None, 'startTime (or time) is required'
+        for value in (start_time, body.get('endTime')):
+            if value and not any(valid_time(value, fmt) for fmt in TIME_FORMATS):
+                return None, f'Invalid time: {value}'
+        rule = {
+            'doctorId': user_id,
+            'kind': kind,
+            'rrule': str(body['rrule']).upper().replace('RRULE:', ''),
+            'dtstart': dtstart,
+            'startTime': start_time,
+            'endTime': body.get('endTime'),
+            'duration': body.get('duration'),
+            'exdates': sorted({str(d)[:10] for d in body.get('exdates') or []}),
+            'notes': body.get('notes'),
+            'createdAt': now_utc(),
+        }
+        if use_db:
+            rule['_id'] = new_id('schedule_rule')
+            db['schedule_rules'].insert_one(rule)
+            rule['id'] = rule.pop('_id')
+        else:
+            rule['id'] = new_id('schedule_rule')
+            schedule_rules.append(rule)
+            record_change('insert', 'schedule_rules', rule)
+        event_bus.publish([f"doctor:{user_id}"], 'schedule.updated', {'rule': rule})
+        return rule, None
+
+    @app.get('/api/doctor/schedule-rules')
+    @auth_required
+    def doctor_schedule_rules():
+        kind = request.args.get('kind')
+        return jsonify(load_schedule_rules(request.user['userId'], kind))
+
+    @app.post('/api/doctor/schedule-rules')
+    @auth_required
+    @idempotent
+    def doctor_create_schedule_rule():
+        body = request.get_json(force=True, silent=True) or {}
+        rule, error = create_schedule_rule(request.user['userId'], body, body.get('kind', 'block'))
+        if error:
+            return jsonify({'error': error}), 400
+        return jsonify(rule), 201
+
+    # Deletes the whole rule, or with ?date=YYYY-MM-DD just that occurrence
+    @app.delete('/api/doctor/schedule-rules/<rule_id>')
+    @auth_required
+    def doctor_delete_schedule_rule(rule_id):
+        user_id = request.user['userId']
+        occurrence = (request.args.get('date') or '')[:10]
+        if use_db:
+            filt = dict(id_filter(rule_id), doctorId=user_id)
+            if occurrence:
+                result = db['schedule_rules'].update_one(filt, {'$addToSet': {'exdates': occurrence}})
+            else:
+                result = db['schedule_rules'].delete_one(filt)
+            found = (result.matched_count if occurrence else result.deleted_count) > 0
+        else:
+            rule = find_row(schedule_rules, rule_id, doctorId=user_id)
+            found = rule is not None
+            if rule and occurrence:
+                rule['exdates'] = sorted(set(rule.get('exdates') or []) | {occurrence})
+                record_change('update', 'schedule_rules', (rule_id, {'exdates': rule['exdates']}))
+            elif rule:
+                schedule_rules.remove(rule)
+                record_change('delete', 'schedule_rules', rule_id)
+        if not found:
+            return jsonify({'error': 'Rule not found'}), 404
+        event_bus.publish([f"doctor:{user_id}"], 'schedule.updated', {'ruleId': rule_id, 'date': occurrence or None})
+        return jsonify({'message': 'Occurrence removed' if occurrence else 'Rule deleted'})
 
     @app.post('/api/doctor/block-slot')
     @auth_required
+    @idempotent
     def doctor_block_slot():
         user_id = request.user['userId']
         body = request.get_json(force=True, silent=True) or {}
+        if body.get('rrule'):
+            rule, error = create_schedule_rule(user_id, body, 'block')
+            if error:
+                return jsonify({'error': error}), 400
+            return jsonify(rule), 201
+        body = {k: v for k, v in body.items() if k not in WINDOW_FIELDS}
         if use_db:
             doc = {
                 'doctorId': user_id,
@@ -1096,19 +3896,27 @@ def create_app() -> Flask:
                 'status': 'blocked'
             }
             doc.update(body)
-            result = db['appointments'].insert_one(doc)
-            doc['id'] = str(result.inserted_id)
+            doc.update(appointment_window(doc.get('date'), doc.get('time'), doc.get('duration')))
+            doc['_id'] = new_id('appointment')
+            db['appointments'].insert_one(doc)
+            doc['id'] = doc.pop('_id')
+            publish_appointment_event('slot.blocked', doc)
             return jsonify(doc), 201
         else:
             new_apt = {
-                'id': f"apt_{len(appointments)+1}",
+                'id': new_id('appointment'),
                 'doctorId': user_id,
                 'patientName': 'Blocked',
                 'type': 'Blocked',
                 'status': 'blocked'
             }
             new_apt.update(body)
-            appointments.append(new_apt)
+            new_apt.update(appointment_window(new_apt.get('date'), new_apt.get('time'), new_apt.get('duration')))
+            new_apt = compact('appointments', new_apt)
+            with appointments_lock:
+                appointments.append(new_apt)
+            record_change('insert', 'appointments', new_apt)
+            publish_appointment_event('slot.blocked', new_apt)
             return jsonify(new_apt), 201
 
     @app.post('/api/doctor/appointments/<appointment_id>/complete')
@@ -1116,34 +3924,537 @@ def create_app() -> Flask:
     def doctor_complete_appointment(appointment_id):
         user_id = request.user['userId']
         if use_db:
-            try:
-                from bson import ObjectId
-                result = db['appointments'].update_one(
-                    {'$or': [{'_id': ObjectId(appointment_id)}, {'id': appointment_id}], 'doctorId': user_id},
-                    {'$set': {'status': 'completed'}}
-                )
-                if result.matched_count == 0:
-                    return jsonify({'error': 'Appointment not found'}), 404
-                return jsonify({'message': 'Consultation marked as completed'})
-            except Exception:
-                result = db['appointments'].update_one(
-                    {'id': appointment_id, 'doctorId': user_id},
-                    {'$set': {'status': 'completed'}}
-                )
-                if result.matched_count == 0:
-                    return jsonify({'error': 'Appointment not found'}), 404
-                return jsonify({'message': 'Consultation marked as completed'})
+            from pymongo import ReturnDocument
+            apt = db['appointments'].find_one_and_update(
+                dict(id_filter(appointment_id), doctorId=user_id),
+                {'$set': {'status': 'completed'}},
+                return_document=ReturnDocument.AFTER
+            )
+            if not apt:
+                return jsonify({'error': 'Appointment not found'}), 404
         else:
-            apt = next((a for a in appointments if a['id'] == appointment_id and a['doctorId'] == user_id), None)
+            apt = find_row(appointments, appointment_id, doctorId=user_id)
             if not apt:
                 return jsonify({'error': 'Appointment not found'}), 404
             apt['status'] = 'completed'
-            return jsonify({'message': 'Consultation marked as completed'})
+            record_change('update', 'appointments', (apt['id'], {'status': 'completed'}))
+        publish_appointment_event('appointment.completed', apt)
+        return jsonify({'message': 'Consultation marked as completed'})
+
+    # Live updates (Server-Sent Events). Route handlers publish deltas to the
+    # in-process bus; with EVENTS_CHANGE_STREAMS=1 a Mongo change stream feeds it
+    # instead so that writes handled by other workers are delivered too.
+    event_bus = EventBus()
+    use_change_streams = use_db and os.environ.get('EVENTS_CHANGE_STREAMS', '').lower() in ('1', 'true', 'yes')
+    SSE_KEEPALIVE_SECONDS = 15
+    # Each open stream holds a worker thread for as long as the dashboard is
+    # open; past this many per process new streams get 503 and the client
+    # falls back to refreshing after its own actions until it reconnects
+    SSE_MAX_STREAMS = int(os.environ.get('SSE_MAX_STREAMS', '16'))
+    stream_stats = {'open': 0, 'rejected': 0}
+    stream_lock = threading.Lock()
+
+    def release_stream():
+        with stream_lock:
+            stream_stats['open'] -= 1
+
+    def appointment_summary(apt: dict) -> dict:
+        return {
+            'id': apt.get('id') or str(apt.get('_id')),
+            'patientId': apt.get('patientId'),
+            'doctorId': apt.get('doctorId'),
+            'patientName': apt.get('patientName'),
+            'doctorName': apt.get('doctorName'),
+            'date': apt.get('date'),
+            'time': apt.get('time'),
+            'type': apt.get('type'),
+            'status': apt.get('status'),
+        }
+
+    def appointment_channels(apt: dict) -> list:
+        channels = []
+        if apt.get('doctorId'):
+            channels.append(f"doctor:{apt['doctorId']}")
+        if apt.get('patientId'):
+            channels.append(f"patient:{apt['patientId']}")
+        return channels
+
+    def publish_appointment_event(event_type: str, apt: dict, changes: dict | None = None):
+        if use_change_streams:
+            return
+        data = {'appointment': appointment_summary(apt)}
+        if changes:
+            data['changes'] = changes
+        event_bus.publish(appointment_channels(apt), event_type, data)
+
+    def publish_prescription_event(p: dict, prescription_id: str):
+        channels = [f"doctor:{p['doctorId']}"] + ([f"patient:{p['patientId']}"] if p.get('patientId') else [])
+        event_bus.publish(channels, 'prescription.created', {'prescription': {
+            'id': prescription_id, 'patientId': p.get('patientId'), 'doctorId': p.get('doctorId'), 'date': p.get('date')
+        }})
+
+    def watch_appointment_changes(collection):
+        import time
+        status_events = {'cancelled': 'appointment.cancelled', 'completed': 'appointment.completed'}
+        while True:
+            try:
+                with collection.watch(full_document='updateLookup') as stream:
+                    for change in stream:
+                        apt = change.get('fullDocument')
+                        if not apt:
+                            continue
+                        updated = (change.get('updateDescription') or {}).get('updatedFields') or {}
+                        if change['operationType'] == 'insert':
+                            event_type = 'slot.blocked' if apt.get('status') == 'blocked' else 'appointment.booked'
+                        elif 'reminderSentAt' in updated:
+                            event_type = 'appointment.reminder'
+                        else:
+                            event_type = status_events.get(apt.get('status'), 'appointment.updated')
+                        event_bus.publish(appointment_channels(apt), event_type, {'appointment': appointment_summary(apt)})
+            except Exception:
+                # Change streams need a replica set; retry in case it was a transient error
+                time.sleep(5)
+
+    if use_change_streams:
+        # One stream per partition
+        for n, collection in enumerate(db.partition_collections('appointments')):
+            threading.Thread(target=watch_appointment_changes, args=(collection,),
+                             name=f'appointment-changes-{n}', daemon=True).start()
+
+    def event_stream(channel: str):
+        from flask import Response
+        with stream_lock:
+            if stream_stats['open'] >= SSE_MAX_STREAMS:
+                stream_stats['rejected'] += 1
+                return too_busy(503, 'Too many live update streams, please retry', 30)
+            stream_stats['open'] += 1
+        try:
+            last_event_id = int(request.headers.get('Last-Event-ID') or request.args.get('lastEventId') or '')
+        except ValueError:
+            last_event_id = None
+        q = event_bus.subscribe(channel, last_event_id)
+
+        def generate():
+            try:
+                yield 'retry: 3000\n\n'
+                while True:
+                    try:
+                        event = q.get(timeout=SSE_KEEPALIVE_SECONDS)
+                    except queue.Empty:
+                        yield ': keepalive\n\n'
+                        continue
+                    payload = json.dumps(event['data'], default=str)
+                    yield f"id: {event['id']}\nevent: {event['type']}\ndata: {payload}\n\n"
+            finally:
+                event_bus.unsubscribe(channel, q)
+
+        response = Response(generate(), mimetype='text/event-stream', headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        })
+        # Runs even if the client goes away before the first chunk is sent
+        response.call_on_close(release_stream)
+        return response
+
+    # AI symptom chat. The browser no longer talks to the model provider: this
+    # proxy holds the API key, streams the reply back as SSE, answers repeated
+    # FAQ-style prompts from an LRU cache (identical prompts in flight share one
+    # upstream call) and caps concurrent upstream calls per user.
+    CHAT_UPSTREAM_URL = os.environ.get('CHAT_UPSTREAM_URL', 'https://api.groq.com/openai/v1/chat/completions')
+    CHAT_API_KEY = os.environ.get('CHAT_API_KEY') or os.environ.get('GROQ_API_KEY')
+    CHAT_MODEL = os.environ.get('CHAT_MODEL', 'llama-3.1-8b-instant')
+    CHAT_TIMEOUT = float(os.environ.get('CHAT_TIMEOUT', '60'))
+    CHAT_MAX_CONCURRENT_PER_USER = int(os.environ.get('CHAT_MAX_CONCURRENT_PER_USER', '2'))
+    CHAT_MAX_PROMPT_CHARS = 2000
+    CHAT_SYSTEM_PROMPT = ('You are a helpful medical AI assistant. Provide health information and guidance, '
+                          'but always remind users to consult with healthcare professionals for serious concerns.')
+    chat_cache = ChatResponseCache(max_entries=int(os.environ.get('CHAT_CACHE_SIZE', '1000')),
+                                   ttl=float(os.environ.get('CHAT_CACHE_TTL', '86400')))
+    chat_slots = {}
+    chat_slots_lock = threading.Lock()
+
+    def acquire_chat_slot(user_id: str) -> bool:
+        with chat_slots_lock:
+            if chat_slots.get(user_id, 0) >= CHAT_MAX_CONCURRENT_PER_USER:
+                return False
+            chat_slots[user_id] = chat_slots.get(user_id, 0) + 1
+            return True
+
+    def release_chat_slot(user_id: str):
+        with chat_slots_lock:
+            chat_slots[user_id] -= 1
+            if not chat_slots[user_id]:
+                del chat_slots[user_id]
+
+    def sse_event(event_type: str, data: dict) -> str:
+        return f"event: {event_type}\ndata: {json.dumps(data)}\n\n"
+
+    @app.post('/api/chat')
+    @auth_required
+    def chat():
+        from flask import Response
+        body = request.get_json(force=True, silent=True) or {}
+        message = str(body.get('message') or '').strip()
+        if not message:
+            return jsonify({'error': 'message is required'}), 400
+        if len(message) > CHAT_MAX_PROMPT_CHARS:
+            return jsonify({'error': f'message too long (max {CHAT_MAX_PROMPT_CHARS} characters)'}), 400
+        if not CHAT_API_KEY and 'CHAT_UPSTREAM_URL' not in os.environ:
+            return jsonify({'error': 'AI assistant is not configured'}), 503
+        user_id = request.user['userId']
+        if not acquire_chat_slot(user_id):
+            return too_busy(429, 'Too many chat requests in progress', 1)
+        key = normalize_prompt(message)
+        payload = {
+            'model': CHAT_MODEL,
+            'messages': [{'role': 'system', 'content': CHAT_SYSTEM_PROMPT}, {'role': 'user', 'content': message}],
+            'max_tokens': 1000,
+            'temperature': 0.7,
+        }
+        released = []
+
+        def release():
+            # From the stream's finally, or on close if the stream never started
+            if not released:
+                released.append(True)
+                release_chat_slot(user_id)
+
+        def generate():
+            state = None
+            finished = False
+            try:
+                state, value = chat_cache.claim(key)
+                if state == 'wait':
+                    reply = chat_cache.wait(value, CHAT_TIMEOUT)
+                    if reply:
+                        state, value = 'hit', reply
+                    else:
+                        # The identical request failed; try on our own without caching
+                        state = 'solo'
+                if state == 'hit':
+                    yield sse_event('token', {'text': value})
+                    yield sse_event('done', {'cached': True})
+                    return
+                parts = []
+                for text in stream_chat_completion(CHAT_UPSTREAM_URL, CHAT_API_KEY, payload, timeout=CHAT_TIMEOUT):
+                    parts.append(text)
+                    yield sse_event('token', {'text': text})
+                if state == 'lead':
+                    chat_cache.finish(key, ''.join(parts) or None)
+                    finished = True
+                yield sse_event('done', {'cached': False})
+            except Exception:
+                yield sse_event('error', {'error': 'AI service unavailable'})
+            finally:
+                if state == 'lead' and not finished:
+                    chat_cache.finish(key, None)
+                release()
+
+        response = Response(generate(), mimetype='text/event-stream', headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        })
+        response.call_on_close(release)
+        return response
+
+    @app.get('/api/doctor/events')
+    @stream_auth_required
+    def doctor_events():
+        return event_stream(f"doctor:{request.user['userId']}")
+
+    @app.get('/api/patient/events')
+    @stream_auth_required
+    def patient_events():
+        return event_stream(f"patient:{request.user['userId']}")
+
+    # Background jobs. Time-based transitions (expired prescriptions, missed
+    # appointments, archiving) run as recurring sweeps, and reminders as one-off
+    # jobs keyed by due time, so read paths can trust the stored status.
+    JOBS_POLL_INTERVAL = float(os.environ.get('JOBS_POLL_INTERVAL', '5'))
+    SWEEP_INTERVAL = float(os.environ.get('SWEEP_INTERVAL', '300'))
+    MISSED_AFTER_MINUTES = int(os.environ.get('MISSED_AFTER_MINUTES', '60'))
+    REMINDER_LEAD_MINUTES = int(os.environ.get('REMINDER_LEAD_MINUTES', '60'))
+    TRANSITION_BATCH = 1000
+
+    if use_db:
+        job_queue = MongoJobQueue(db['jobs'])
+        try:
+            db['prescriptions'].create_index([('status', 1), ('validUntil', 1)])
+            db['appointments'].create_index([('status', 1), ('endAt', 1)])
+        except Exception:
+            pass
+    else:
+        jobs_path = os.path.join(os.environ.get('SNAPSHOT_DIR', DATA_DIR), 'jobs.log') if persistence else None
+        job_queue = MemoryJobQueue(jobs_path)
+    scheduler = JobScheduler(job_queue, poll_interval=JOBS_POLL_INTERVAL)
+
+    def expire_prescriptions() -> int:
+        # validUntil is a YYYY-MM-DD string, so it compares lexically
+        today = now_utc().date().isoformat()
+        if use_db:
+            return db['prescriptions'].update_many(
+                {'status': 'active', 'validUntil': {'$lt': today}}, {'$set': {'status': 'expired'}}
+            ).modified_count
+        expired = 0
+        for p in prescriptions:
+            if p.get('status') == 'active' and p.get('validUntil') and str(p['validUntil'])[:10] < today:
+                p['status'] = 'expired'
+                record_change('update', 'prescriptions', (p['id'], {'status': 'expired'}))
+                expired += 1
+        return expired
+
+    def mark_missed_appointments() -> int:
+        # Scheduled appointments that ended MISSED_AFTER_MINUTES ago without being
+        # completed or cancelled stop counting as upcoming/waiting
+        cutoff = now_utc() - timedelta(minutes=MISSED_AFTER_MINUTES)
+        marked = 0
+        if use_db:
+            while True:
+                batch = list(db['appointments'].find({'status': 'scheduled', 'endAt': {'$lt': cutoff}}).limit(TRANSITION_BATCH))
+                if not batch:
+                    return marked
+                db['appointments'].update_many({'_id': {'$in': [a['_id'] for a in batch]}, 'status': 'scheduled'},
+                                               {'$set': {'status': 'missed'}})
+                for a in batch:
+                    a['status'] = 'missed'
+                    publish_appointment_event('appointment.updated', a, changes={'status': 'missed'})
+                marked += len(batch)
+        for a in appointments[:]:
+            if a.get('status') == 'scheduled' and a.get('endAt') and a['endAt'] < cutoff:
+                a['status'] = 'missed'
+                record_change('update', 'appointments', (a['id'], {'status': 'missed'}))
+                publish_appointment_event('appointment.updated', a, changes={'status': 'missed'})
+                marked += 1
+        return marked
+
+    def schedule_reminder(apt: dict):
+        start = apt.get('startAt')
+        if start and start.tzinfo is None:
+            start = start.replace(tzinfo=timezone.utc)
+        if apt.get('status', 'scheduled') != 'scheduled' or not start or start <= now_utc():
+            return
+        apt_id = apt.get('id') or str(apt.get('_id'))
+        due = max(start - timedelta(minutes=REMINDER_LEAD_MINUTES), now_utc())
+        # One pending reminder per appointment; rescheduling replaces it
+        scheduler.schedule(due, 'appointments.remind', {'id': apt_id}, key=f'remind:{apt_id}')
+
+    def send_reminders(payloads: list):
+        ids = [p['id'] for p in payloads]
+        now = now_utc()
+        if use_db:
+            due = list(db['appointments'].find(dict(ids_filter(ids), status='scheduled', startAt={'$gt': now})))
+            if due:
+                db['appointments'].update_many({'_id': {'$in': [a['_id'] for a in due]}}, {'$set': {'reminderSentAt': now}})
+        else:
+            wanted = set(ids)
+            due = [a for a in appointments if (a.get('id') in wanted or a.get('legacyId') in wanted)
+                   and a.get('status') == 'scheduled' and a.get('startAt') and a['startAt'] > now]
+            for a in due:
+                a['reminderSentAt'] = now
+                record_change('update', 'appointments', (a['id'], {'reminderSentAt': now}))
+        for a in due:
+            publish_appointment_event('appointment.reminder', a)
+
+    scheduler.register('appointments.remind', send_reminders)
+    scheduler.every('prescriptions.expire', SWEEP_INTERVAL, expire_prescriptions)
+    scheduler.every('appointments.missed', SWEEP_INTERVAL, mark_missed_appointments)
+    if ARCHIVE_AFTER_DAYS > 0:
+        scheduler.every('appointments.archive', ARCHIVE_INTERVAL, archive_appointments)
+    scheduler.start()
+
+    # Practice reports (monthly summaries per doctor). Generation runs in a
+    # process pool so a request never computes one inline: a cache miss starts
+    # (or joins) a job and answers 202 with a job id to poll. Finished reports
+    # are cached per doctor and period until an event touches that doctor's
+    # appointments or prescriptions, or REPORT_CACHE_TTL passes. With MongoDB,
+    # jobs are also recorded in report_jobs so a poll that lands on another
+    # gunicorn worker still finds them; the cache stays per worker.
+    REPORT_WORKERS = int(os.environ.get('REPORT_WORKERS', '2'))
+    REPORT_CACHE_TTL = float(os.environ.get('REPORT_CACHE_TTL', '3600'))
+    report_lock = threading.Lock()
+    report_versions = {}
+    report_artifacts = {}
+    report_jobs = {}
+    report_pool = []
+
+    def invalidate_reports(event: dict):
+        doctors = [ch.split(':', 1)[1] for ch in event['channels'] if ch.startswith('doctor:')]
+        with report_lock:
+            for doctor_id in doctors:
+                report_versions[doctor_id] = report_versions.get(doctor_id, 0) + 1
+
+    event_bus.listen(invalidate_reports)
+
+    if use_db:
+        try:
+            db['report_jobs'].create_index('requestedAt', expireAfterSeconds=int(REPORT_CACHE_TTL))
+        except Exception:
+            pass
+
+    def report_executor():
+        # spawn, not fork: forking a threaded worker copies held locks and the
+        # Mongo client's sockets into the child
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        with report_lock:
+            if not report_pool:
+                report_pool.append(ProcessPoolExecutor(max_workers=REPORT_WORKERS,
+                                                       mp_context=multiprocessing.get_context('spawn')))
+            return report_pool[0]
+
+    def submit_report(doctor_id: str, period: str) -> dict:
+        import time
+        with report_lock:
+            version = report_versions.get(doctor_id, 0)
+            for job in report_jobs.values():
+                if (job['doctorId'], job['period'], job['version']) == (doctor_id, period, version) \
+                        and job['status'] == 'running':
+                    return job
+            # Forget finished jobs after a while
+            cutoff = time.monotonic() - REPORT_CACHE_TTL
+            for job_id in [k for k, j in report_jobs.items() if j['status'] != 'running' and j['started'] < cutoff]:
+                del report_jobs[job_id]
+            job = {'id': new_id('report_job'), 'doctorId': doctor_id, 'period': period, 'version': version,
+                   'status': 'running', 'started': time.monotonic(), 'requestedAt': now_utc()}
+            report_jobs[job['id']] = job
+        if use_db:
+            db['report_jobs'].insert_one({'_id': job['id'], 'doctorId': doctor_id, 'period': period,
+                                          'status': 'running', 'requestedAt': job['requestedAt']})
+            future = report_executor().submit(mongo_report, *db.partition_address(doctor_id), doctor_id, period)
+        else:
+            start, end = period_bounds(period)
+            rows = [{'status': a.get('status'), 'type': a.get('type'), 'patientId': a.get('patientId')}
+                    for a in itertools.chain(appointments, appointments_archive)
+                    if a.get('doctorId') == doctor_id and a.get('status') != 'blocked'
+                    and a.get('startAt') and start <= a['startAt'] < end]
+            rx_rows = [{'medications': p.get('medications'), 'medication': p.get('medication')}
+                       for p in prescriptions if p.get('doctorId') == doctor_id and str(p.get('date') or '')[:7] == period]
+            future = report_executor().submit(memory_report, rows, rx_rows)
+
+        def done(f):
+            with report_lock:
+                try:
+                    report = dict(f.result(), doctorId=doctor_id, period=period, generatedAt=now_utc())
+                    job.update(status='done', report=report)
+                    report_artifacts[(doctor_id, period)] = {'report': report, 'version': version,
+                                                             'started': job['started']}
+                except Exception as e:
+                    job.update(status='failed', error=str(e))
+                outcome = {k: job[k] for k in ('status', 'report', 'error') if k in job}
+            if use_db:
+                try:
+                    db['report_jobs'].update_one({'_id': job['id']}, {'$set': outcome})
+                except Exception:
+                    # Pollers on this worker still see the result
+                    pass
+
+        future.add_done_callback(done)
+        return job
+
+    def report_job_response(job: dict) -> dict:
+        resp = {'jobId': job['id'], 'status': job['status'], 'period': job['period'], 'requestedAt': job['requestedAt']}
+        if job['status'] == 'done':
+            resp['report'] = job['report']
+        elif job['status'] == 'failed':
+            resp['error'] = job.get('error')
+        return resp
+
+    # ?period=YYYY-MM (default: current month); ?refresh=1 forces regeneration
+    @app.get('/api/doctor/reports')
+    @auth_required
+    def doctor_report():
+        import time
+        user_id = request.user['userId']
+        period = request.args.get('period') or now_utc().strftime('%Y-%m')
+        try:
+            period_bounds(period)
+        except ValueError:
+            return jsonify({'error': 'period must be YYYY-MM'}), 400
+        if request.args.get('refresh', '').lower() not in ('1', 'true', 'yes'):
+            with report_lock:
+                artifact = report_artifacts.get((user_id, period))
+                fresh = artifact is not None and artifact['version'] == report_versions.get(user_id, 0) \
+                    and time.monotonic() - artifact['started'] < REPORT_CACHE_TTL
+            if fresh:
+                return jsonify(artifact['report'])
+        job = submit_report(user_id, period)
+        return jsonify(report_job_response(job)), 202, {'Location': f"/api/doctor/reports/jobs/{job['id']}"}
+
+    @app.get('/api/doctor/reports/jobs/<job_id>')
+    @auth_required
+    def doctor_report_job(job_id):
+        with report_lock:
+            job = report_jobs.get(job_id)
+        if job is None and use_db:
+            # Started by another worker
+            job = db['report_jobs'].find_one({'_id': job_id})
+            if job is not None:
+                job['id'] = job.pop('_id')
+        if job is None or job['doctorId'] != request.user['userId']:
+            return jsonify({'error': 'Report job not found'}), 404
+        with report_lock:
+            return jsonify(report_job_response(job))
+
+    # Change feed. Consumers keep the returned cursor and pass it back as
+    # ?since= to receive only newer changes (oldest first). With MongoDB the
+    # feed trails by CDC_SETTLE_SECONDS: other workers write their batches
+    # asynchronously, and an event must not appear after a cursor has passed it.
+    ADMIN_API_KEY = os.environ.get('ADMIN_API_KEY')
+    MAX_CHANGES_PAGE = 1000
+
+    def admin_required(fn):
+        from functools import wraps
+        import hmac
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not ADMIN_API_KEY:
+                return jsonify({'error': 'Admin API is disabled'}), 403
+            if not hmac.compare_digest(request.headers.get('X-Admin-Key', ''), ADMIN_API_KEY):
+                return jsonify({'error': 'Unauthorized'}), 401
+            return fn(*args, **kwargs)
+        return wrapper
+
+    @app.get('/api/admin/changes')
+    @admin_required
+    def admin_changes():
+        since = request.args.get('since') or ''
+        collection = request.args.get('collection') or None
+        if collection is not None and collection not in CAPTURED_COLLECTIONS:
+            return jsonify({'error': f"collection must be one of {', '.join(CAPTURED_COLLECTIONS)}"}), 400
+        try:
+            limit = min(max(int(request.args.get('limit', 100)), 1), MAX_CHANGES_PAGE)
+        except ValueError:
+            return jsonify({'error': 'limit must be a number'}), 400
+        if use_db and audit_store is not None:
+            until = id_floor('change', now_utc() - timedelta(seconds=CDC_SETTLE_SECONDS))
+            # Never move the cursor past an event this worker still has to write
+            # (e.g. re-queued while the store was down longer than the settle window)
+            oldest = change_capture.oldest_pending()
+            if oldest is not None:
+                until = min(until, oldest)
+            rows = audit_store.read(since, limit, collection, until)
+        else:
+            # Recent changes come from the ring; older ones from the segment files
+            rows, complete = change_capture.recent(since, limit, collection)
+            if not complete and audit_store is not None:
+                stored = audit_store.read(since, limit, collection)
+                if stored:
+                    rows = stored + [e for e in rows if e['id'] > stored[-1]['id']]
+                rows = rows[:limit]
+        return jsonify({
+            'changes': rows,
+            'cursor': rows[-1]['id'] if rows else since,
+            'hasMore': len(rows) == limit,
+        })
 
     return app
 
 
-app = create_app()
+# A spawned report worker re-imports this file as __mp_main__ when the server
+# was started with `python app.py`; it must not build a second application
+if __name__ != '__mp_main__':
+    app = create_app()
 
 
 if __name__ == '__main__':
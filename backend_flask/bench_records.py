@@ -0,0 +1,84 @@
+"""Memory benchmark: plain dict rows vs slotted records (records.py).
+
+Builds the same synthetic appointments, vitals and prescriptions both ways and
+reports the bytes each layout keeps alive per row. Strings are built per row,
+the way they arrive from JSON request bodies, so the dict layout pays for
+every duplicated name/status string just as the running store does.
+
+    python backend_flask/bench_records.py [rows]
+"""
+import gc
+import random
+import sys
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+from records import RECORD_TYPES
+
+DOCTORS = [(f'doctor_{i}', f'Dr. Doctor {i}', random.choice(['Cardiology', 'General Physician', 'Endocrinology']))
+           for i in range(50)]
+STATUSES = ['scheduled', 'completed', 'cancelled', 'missed']
+TYPES = ['Video Consultation', 'Initial', 'Follow-up']
+TIMES = ['9:00 AM', '10:00 AM', '11:00 AM', '12:00 PM', '2:00 PM', '3:00 PM', '4:00 PM', '5:00 PM']
+
+
+def fresh(text: str) -> str:
+    # A new string object with the same value (like json.loads produces per row)
+    return ''.join(list(text))
+
+
+def appointment(i: int) -> dict:
+    doctor_id, doctor_name, specialty = DOCTORS[i % len(DOCTORS)]
+    start = datetime(2025, 1, 1, 9, tzinfo=timezone.utc) + timedelta(hours=i % 5000)
+    return {
+        'id': f'apt_{i}', 'patientId': fresh(f'patient_{i % 5000}'), 'patientName': fresh(f'Patient {i % 5000}'),
+        'doctorId': fresh(doctor_id), 'doctorName': fresh(doctor_name), 'specialty': fresh(specialty),
+        'date': fresh(start.date().isoformat()), 'time': fresh(TIMES[i % len(TIMES)]), 'duration': 30,
+        'type': fresh(TYPES[i % len(TYPES)]), 'status': fresh(STATUSES[i % len(STATUSES)]), 'priority': fresh('normal'),
+        'symptoms': ['Headache'], 'notes': f'Visit {i}', 'meetingLink': fresh(f'https://meet.vaidya.com/{doctor_id}'),
+        'startAt': start, 'endAt': start + timedelta(minutes=30),
+    }
+
+
+def vital(i: int) -> dict:
+    return {
+        'id': f'v_{i}', 'patientId': fresh(f'patient_{i % 5000}'), 'label': fresh('Heart Rate'),
+        'value': f'{60 + i % 40} bpm', 'status': fresh('normal'), 'unit': fresh('bpm'),
+        'createdAt': f'2025-01-01T00:00:{i % 60:02d}Z',
+    }
+
+
+def prescription(i: int) -> dict:
+    doctor_id, _, _ = DOCTORS[i % len(DOCTORS)]
+    return {
+        'id': f'pr_{i}', 'patientId': fresh(f'patient_{i % 5000}'), 'patientName': fresh(f'Patient {i % 5000}'),
+        'doctorId': fresh(doctor_id), 'medications': [{'name': 'Lisinopril', 'dosage': '10mg'}],
+        'diagnosis': 'Hypertension', 'notes': f'Rx {i}', 'date': fresh('2025-01-15'),
+        'validUntil': fresh('2025-04-15'), 'status': fresh('active'),
+    }
+
+
+def measure(build) -> int:
+    gc.collect()
+    tracemalloc.start()
+    rows = build()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del rows
+    return size
+
+
+def main(n: int):
+    print(f'{n} rows per store')
+    print(f"{'store':<15}{'dict B/row':>12}{'record B/row':>14}{'saved':>8}")
+    for store, make in (('appointments', appointment), ('vitals', vital), ('prescriptions', prescription)):
+        record_type = RECORD_TYPES[store]
+        as_dicts = measure(lambda: [make(i) for i in range(n)])
+        as_records = measure(lambda: [record_type(make(i)) for i in range(n)])
+        print(f'{store:<15}{as_dicts / n:>12.0f}{as_records / n:>14.0f}{1 - as_records / as_dicts:>8.0%}')
+
+
+if __name__ == '__main__':
+    random.seed(1)
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
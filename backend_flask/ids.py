@@ -0,0 +1,115 @@
+"""Typed record ids.
+
+New ids look like ``apt_01JB8ZK3Q6W2V9D4T5N7M8P0RS``: a type prefix and 26
+Crockford base32 characters holding a 48-bit millisecond timestamp and 80
+random bits (the ULID layout). Ids of one type therefore sort by creation time
+as plain strings, reveal no row counts, and are minted without a counter.
+
+With MongoDB a typed id is the document's ``_id``, so every lookup is a
+primary-key match. ``id_filter`` routes any id a client may still hold to the
+one field that can contain it: typed ids and ObjectId hex strings (documents
+written before typed ids) to ``_id``, legacy counter ids such as ``apt_12``
+to ``legacyId``, which the startup migration fills when it re-keys them.
+"""
+import os
+import re
+import threading
+import time
+from datetime import datetime, timezone
+
+PREFIXES = {
+    'appointment': 'apt',
+    'vital': 'v',
+    'health_record': 'rec',
+    'prescription': 'pr',
+    'schedule_rule': 'rule',
+    'report_job': 'rpt',
+    'change': 'chg',
+}
+KINDS = {prefix: kind for kind, prefix in PREFIXES.items()}
+
+_ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+_DECODE = {c: i for i, c in enumerate(_ALPHABET)}
+_RANDOM_BITS = 80
+TYPED_ID = re.compile(r'^([a-z]+)_([0-9A-HJKMNP-TV-Z]{26})$')
+LEGACY_ID = re.compile(r'^[a-z]+_\d+$')
+OBJECT_ID = re.compile(r'^[0-9a-f]{24}$')
+
+_lock = threading.Lock()
+_last = [0, 0]
+
+
+def _encode(ms: int, rand: int) -> str:
+    value = (ms << _RANDOM_BITS) | rand
+    return ''.join(_ALPHABET[(value >> shift) & 31] for shift in range(125, -1, -5))
+
+
+def new_id(kind: str, at: datetime = None) -> str:
+    # `at` backdates the timestamp (migrations keep the original order)
+    prefix = PREFIXES[kind]
+    if at is not None:
+        return f"{prefix}_{_encode(int(at.timestamp() * 1000), int.from_bytes(os.urandom(10), 'big'))}"
+    with _lock:
+        ms = int(time.time() * 1000)
+        if ms <= _last[0]:
+            # Same millisecond (or clock stepped back): stay monotonic
+            ms, rand = _last[0], (_last[1] + 1) & ((1 << _RANDOM_BITS) - 1)
+        else:
+            rand = int.from_bytes(os.urandom(10), 'big')
+        _last[:] = [ms, rand]
+    return f'{prefix}_{_encode(ms, rand)}'
+
+
+def id_floor(kind: str, at: datetime) -> str:
+    # Smallest id of this kind minted at `at`; compare ids against it for time ranges
+    return f'{PREFIXES[kind]}_{_encode(int(at.timestamp() * 1000), 0)}'
+
+
+def id_kind(value) -> str:
+    # Record kind of a typed id, None for anything else
+    match = TYPED_ID.match(value) if isinstance(value, str) else None
+    return KINDS.get(match.group(1)) if match else None
+
+
+def id_time(value: str) -> datetime:
+    value = TYPED_ID.match(value).group(2)
+    number = 0
+    for char in value:
+        number = number * 32 + _DECODE[char]
+    return datetime.fromtimestamp((number >> _RANDOM_BITS) / 1000, tz=timezone.utc)
+
+
+def is_legacy_id(value) -> bool:
+    return isinstance(value, str) and bool(LEGACY_ID.match(value)) and not TYPED_ID.match(value)
+
+
+def id_field(value) -> str:
+    # Field of an in-memory row that holds this id
+    return 'legacyId' if is_legacy_id(value) else 'id'
+
+
+def storage_key(value):
+    # _id value for a MongoDB document with this id
+    if isinstance(value, str) and OBJECT_ID.match(value):
+        from bson import ObjectId
+        return ObjectId(value)
+    return value
+
+
+def id_filter(value) -> dict:
+    # Single-field MongoDB filter for one id
+    if is_legacy_id(value):
+        return {'legacyId': value}
+    return {'_id': storage_key(value)}
+
+
+def ids_filter(values) -> dict:
+    # Filter for many ids; one $in per field that actually occurs
+    by_field = {}
+    for value in values:
+        field = 'legacyId' if is_legacy_id(value) else '_id'
+        by_field.setdefault(field, []).append(value if field == 'legacyId' else storage_key(value))
+    clauses = [{field: {'$in': group}} for field, group in by_field.items()]
+    if not clauses:
+        return {'_id': {'$in': []}}
+    return clauses[0] if len(clauses) == 1 else {'$or': clauses}
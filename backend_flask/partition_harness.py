@@ -0,0 +1,125 @@
+"""Local multi-instance harness for partitioned storage.
+
+Starts N throwaway mongod processes (mongod must be on PATH), points the API
+at them through MONGODB_URI / PARTITION_URIS and exercises it in-process:
+it signs up doctors and a patient, books one appointment with every doctor, and
+checks that each appointment landed on its doctor's partition. It also checks
+that the patient's fanned-out list sees all of them and that cancelling by id
+finds the right partition. With --add, it then adds one more instance, runs
+rebalance.py and checks placement again.
+
+    python backend_flask/partition_harness.py [--instances 3] [--doctors 12] [--add] [--keep]
+
+--keep leaves the instances running and prints the environment to use them.
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BASE_PORT = 27201
+
+
+def start_mongod(port: int, root: str) -> subprocess.Popen:
+    path = os.path.join(root, f'db{port}')
+    os.makedirs(path, exist_ok=True)
+    return subprocess.Popen(['mongod', '--port', str(port), '--dbpath', path, '--bind_ip', '127.0.0.1', '--quiet'],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+
+
+def wait_ready(port: int, timeout: float = 30.0):
+    from pymongo import MongoClient
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            MongoClient(f'mongodb://127.0.0.1:{port}', serverSelectionTimeoutMS=500).admin.command('ping')
+            return
+        except Exception:
+            if time.monotonic() > deadline:
+                raise RuntimeError(f'mongod on port {port} did not start')
+            time.sleep(0.2)
+
+
+def check_placement(uris: list) -> int:
+    # Returns the number of appointments sitting on the wrong partition
+    from pymongo import MongoClient
+    from partitions import document_partition
+    misplaced = 0
+    for index, uri in enumerate(uris):
+        for doc in MongoClient(uri)['vaidya']['appointments'].find():
+            if document_partition(doc, len(uris)) != index:
+                misplaced += 1
+    return misplaced
+
+
+def exercise(instances: int, doctors: int) -> list:
+    uris = [f'mongodb://127.0.0.1:{BASE_PORT + i}/vaidya' for i in range(instances)]
+    os.environ['MONGODB_URI'] = uris[0]
+    os.environ['PARTITION_URIS'] = ','.join(uris)
+    os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+    import app as appmod
+    client = appmod.create_app().test_client()
+
+    def signup(role: str, n: int) -> dict:
+        body = {'name': f'{role.title()} {n}', 'email': f'{role}{n}@harness.test', 'password': 'password123',
+                'role': role}
+        client.post('/api/auth/signup', json=body)
+        r = client.post('/api/auth/signin', json=body)
+        data = r.get_json()
+        return {'headers': {'Authorization': f"Bearer {data['token']}"}, 'id': data['userId']}
+
+    patient = signup('patient', 1)
+    booked = []
+    for n in range(doctors):
+        doctor = signup('doctor', n)
+        r = client.post('/api/patient/appointments', headers=patient['headers'], json={
+            'doctorId': doctor['id'], 'doctorName': f'Doctor {n}', 'date': '2031-03-01', 'time': '10:00 AM'})
+        booked.append(r.get_json()['id'])
+    listed = {a['id'] for a in client.get('/api/patient/appointments', headers=patient['headers']).get_json()}
+    cancel = client.post(f'/api/patient/appointments/{booked[-1]}/cancel', headers=patient['headers'])
+    print(f'{instances} partitions: booked {len(booked)}, patient sees {len(listed & set(booked))}, '
+          f'cancel by id -> {cancel.status_code}, misplaced {check_placement(uris)}')
+    return uris
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--instances', type=int, default=3)
+    parser.add_argument('--doctors', type=int, default=12)
+    parser.add_argument('--add', action='store_true', help='add one instance and rebalance afterwards')
+    parser.add_argument('--keep', action='store_true', help='leave the instances running')
+    args = parser.parse_args(argv)
+    if not shutil.which('mongod'):
+        sys.exit('mongod not found on PATH')
+    root = tempfile.mkdtemp(prefix='vaidya-partitions-')
+    procs = [start_mongod(BASE_PORT + i, root) for i in range(args.instances)]
+    try:
+        for i in range(args.instances):
+            wait_ready(BASE_PORT + i)
+        uris = exercise(args.instances, args.doctors)
+        if args.add:
+            from rebalance import connect, rebalance
+            procs.append(start_mongod(BASE_PORT + args.instances, root))
+            wait_ready(BASE_PORT + args.instances)
+            uris.append(f'mongodb://127.0.0.1:{BASE_PORT + args.instances}/vaidya')
+            moved = rebalance(connect(uris, 'vaidya'), [])
+            print(f'added a partition: moved {sum(moved.values())} documents, misplaced {check_placement(uris)}')
+        if args.keep:
+            print(f"MONGODB_URI={uris[0]}\nPARTITION_URIS={','.join(uris)}\n(data in {root}; Ctrl+C to stop)")
+            while True:
+                time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            proc.wait()
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,370 @@
+"""Horizontal partitioning of the doctor-owned collections.
+
+Appointments (both tiers), prescriptions and health records can be spread over
+N MongoDB databases, on one server or on separate mongod instances
+(``PARTITION_URIS``). A document lives on ``partition_for(doctorId, N)``, or
+``partition_for(patientId, N)`` when it has no doctor (records a patient
+uploads). ``PartitionedDatabase`` stands in for the app's ``db``: other
+collections come from the main database unchanged, and partitioned ones are
+``PartitionedCollection`` routers. A query that names its doctor goes to one
+partition. Anything else (patient views, sweeps, lookups by id) fans out to
+every partition in parallel, and sorted results are merged lazily.
+
+Partitions are chosen with a jump consistent hash, so growing from N to N+1
+partitions moves only about 1/(N+1) of the doctors; rebalance.py moves their
+documents.
+"""
+import contextvars
+import functools
+import hashlib
+import heapq
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+PARTITIONED_COLLECTIONS = ('appointments', 'appointments_archive', 'prescriptions', 'health_records')
+PARTITION_KEY = 'doctorId'
+FALLBACK_KEY = 'patientId'
+
+_END = object()
+
+
+def jump_hash(key: int, buckets: int) -> int:
+    # Lamping & Veach jump consistent hash
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return b
+
+
+def partition_for(value, buckets: int) -> int:
+    if buckets <= 1:
+        return 0
+    digest = hashlib.blake2b(str(value).encode(), digest_size=8).digest()
+    return jump_hash(int.from_bytes(digest, 'big'), buckets)
+
+
+def document_partition(doc: dict, buckets: int) -> int:
+    return partition_for(doc.get(PARTITION_KEY) or doc.get(FALLBACK_KEY), buckets)
+
+
+def filter_partitions(filt: dict, buckets: int) -> list:
+    # Partitions that can hold documents matching filt
+    value = (filt or {}).get(PARTITION_KEY)
+    if isinstance(value, str):
+        return [partition_for(value, buckets)]
+    if isinstance(value, dict) and set(value) == {'$in'}:
+        return sorted({partition_for(v, buckets) for v in value['$in']})
+    return list(range(buckets))
+
+
+def pool_map(pool: ThreadPoolExecutor, fn, items: list) -> list:
+    # Pool threads don't inherit contextvars, so each task runs in a copy of the
+    # caller's context; that carries the request's pymongo.timeout() deadline.
+    # One copy per task, because a Context cannot be entered by two threads at once.
+    contexts = [contextvars.copy_context() for _ in items]
+    return list(pool.map(lambda ctx, item: ctx.run(fn, item), contexts, items))
+
+
+def _order(value):
+    # Rough BSON type order so missing and mixed values still compare
+    if value is None:
+        return (0, 0)
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    if isinstance(value, datetime):
+        return (3, value.replace(tzinfo=None))
+    return (4, str(value))
+
+
+def sort_key(spec: list):
+    # Python key matching a Mongo sort spec; {'$meta': 'textScore'} sorts descending
+    def compare(a, b):
+        for field, direction in spec:
+            descending = isinstance(direction, dict) or direction < 0
+            x, y = _order(a.get(field)), _order(b.get(field))
+            if x != y:
+                return (1 if x > y else -1) * (-1 if descending else 1)
+        return 0
+    return functools.cmp_to_key(compare)
+
+
+class FanOutResult:
+    # Sums the write results of several partitions
+    def __init__(self, results: list, inserted_ids: list = None):
+        self.results = [r for r in results if r is not None]
+        self.inserted_ids = inserted_ids or []
+        self.acknowledged = True
+
+    def _sum(self, attr: str) -> int:
+        return sum(getattr(r, attr, 0) or 0 for r in self.results)
+
+    matched_count = property(lambda self: self._sum('matched_count'))
+    modified_count = property(lambda self: self._sum('modified_count'))
+    deleted_count = property(lambda self: self._sum('deleted_count'))
+    inserted_count = property(lambda self: self._sum('inserted_count'))
+
+
+class FanOutCursor:
+    # The subset of pymongo's Cursor the app uses, over several partitions.
+    # Each partition is asked for skip+limit rows in the same order; the first
+    # batches are fetched in parallel and the streams merged as they are read.
+
+    def __init__(self, collections: list, pool: ThreadPoolExecutor, args: tuple, kwargs: dict):
+        self._collections = collections
+        self._pool = pool
+        self._args = args
+        self._kwargs = kwargs
+        self._sort = None
+        self._skip = 0
+        self._limit = 0
+        self._batch_size = 0
+        self._rows = None
+
+    def sort(self, key, direction=None):
+        self._sort = [(key, 1 if direction is None else direction)] if isinstance(key, str) else list(key)
+        return self
+
+    def skip(self, n: int):
+        self._skip = n
+        return self
+
+    def limit(self, n: int):
+        self._limit = n
+        return self
+
+    def batch_size(self, n: int):
+        self._batch_size = n
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._rows is None:
+            self._rows = self._open()
+        return next(self._rows)
+
+    def _open(self):
+        cursors = []
+        for coll in self._collections:
+            cur = coll.find(*self._args, **self._kwargs)
+            if self._sort:
+                cur = cur.sort(self._sort)
+            if self._limit:
+                cur = cur.limit(self._skip + self._limit)
+            if self._batch_size:
+                cur = cur.batch_size(self._batch_size)
+            cursors.append(cur)
+        heads = pool_map(self._pool, lambda c: next(c, _END), cursors)
+        streams = [itertools.chain([head], cur) for head, cur in zip(heads, cursors) if head is not _END]
+        merged = heapq.merge(*streams, key=sort_key(self._sort)) if self._sort else itertools.chain(*streams)
+        return itertools.islice(merged, self._skip, self._skip + self._limit if self._limit else None)
+
+
+class PartitionedCollection:
+    # Routes collection calls to the partitions that can hold the documents
+
+    def __init__(self, name: str, collections: list, pool: ThreadPoolExecutor):
+        self.name = name
+        self.collections = collections
+        self._pool = pool
+        self._lock = threading.Lock()
+        self._stats = {'routed': 0, 'fanOut': 0}
+
+    def _targets(self, filt) -> list:
+        targets = [self.collections[i] for i in filter_partitions(filt, len(self.collections))]
+        with self._lock:
+            self._stats['routed' if len(targets) == 1 else 'fanOut'] += 1
+        return targets
+
+    def _each(self, items: list, fn) -> list:
+        if len(items) == 1:
+            return [fn(items[0])]
+        return pool_map(self._pool, fn, items)
+
+    def _for_document(self, doc: dict):
+        return self.collections[document_partition(doc, len(self.collections))]
+
+    def _owner(self, filt):
+        # Partition holding the first document that matches (single-document writes)
+        targets = self._targets(filt)
+        if len(targets) == 1:
+            return targets[0]
+        hits = self._each(targets, lambda c: c.find_one(filt, {'_id': 1}))
+        return next((c for c, hit in zip(targets, hits) if hit is not None), None)
+
+    @staticmethod
+    def _check_update(update):
+        fields = update.get('$set', {}) if isinstance(update, dict) else {}
+        if PARTITION_KEY in fields or FALLBACK_KEY in fields:
+            raise ValueError(f'{PARTITION_KEY} and {FALLBACK_KEY} are partition keys and cannot be updated')
+
+    def find(self, filt=None, *args, **kwargs):
+        targets = self._targets(filt)
+        if len(targets) == 1:
+            return targets[0].find(filt, *args, **kwargs)
+        return FanOutCursor(targets, self._pool, (filt,) + args, kwargs)
+
+    def find_one(self, filt=None, *args, **kwargs):
+        for doc in self._each(self._targets(filt), lambda c: c.find_one(filt, *args, **kwargs)):
+            if doc is not None:
+                return doc
+        return None
+
+    def count_documents(self, filt: dict, **kwargs) -> int:
+        return sum(self._each(self._targets(filt), lambda c: c.count_documents(filt, **kwargs)))
+
+    def distinct(self, key: str, filt: dict = None, **kwargs) -> list:
+        values, seen = [], set()
+        for part in self._each(self._targets(filt), lambda c: c.distinct(key, filt, **kwargs)):
+            for value in part:
+                marker = repr(value)
+                if marker not in seen:
+                    seen.add(marker)
+                    values.append(value)
+        return values
+
+    def insert_one(self, doc: dict, **kwargs):
+        return self._for_document(doc).insert_one(doc, **kwargs)
+
+    def _grouped_write(self, groups: dict, write) -> tuple:
+        # Runs write(collection, positions) for each {partition: positions} in
+        # parallel; returns the results and every write error, indexed into the
+        # caller's list rather than the partition's slice
+        from pymongo.errors import BulkWriteError
+
+        def run(group):
+            part, positions = group
+            try:
+                return write(self.collections[part], positions), []
+            except BulkWriteError as e:
+                return None, [dict(err, index=positions[err['index']]) for err in e.details.get('writeErrors', [])]
+
+        outcomes = self._each(list(groups.items()), run)
+        errors = sorted((err for _, errs in outcomes for err in errs), key=lambda err: err['index'])
+        return [r for r, _ in outcomes], errors
+
+    def insert_many(self, docs, ordered: bool = True, **kwargs):
+        from pymongo.errors import BulkWriteError
+        docs = list(docs)
+        groups = {}
+        for pos, doc in enumerate(docs):
+            groups.setdefault(document_partition(doc, len(self.collections)), []).append(pos)
+        results, errors = self._grouped_write(
+            groups, lambda c, positions: c.insert_many([docs[p] for p in positions], ordered=ordered, **kwargs))
+        if errors:
+            raise BulkWriteError({'writeErrors': errors, 'nInserted': len(docs) - len(errors)})
+        return FanOutResult(results, [d.get('_id') for d in docs])
+
+    def find_one_and_update(self, filt: dict, update, **kwargs):
+        self._check_update(update)
+        owner = self._owner(filt)
+        return owner.find_one_and_update(filt, update, **kwargs) if owner is not None else None
+
+    def update_one(self, filt: dict, update, **kwargs):
+        self._check_update(update)
+        owner = self._owner(filt)
+        return owner.update_one(filt, update, **kwargs) if owner is not None else FanOutResult([])
+
+    def delete_one(self, filt: dict, **kwargs):
+        owner = self._owner(filt)
+        return owner.delete_one(filt, **kwargs) if owner is not None else FanOutResult([])
+
+    def update_many(self, filt: dict, update, **kwargs):
+        self._check_update(update)
+        return FanOutResult(self._each(self._targets(filt), lambda c: c.update_many(filt, update, **kwargs)))
+
+    def delete_many(self, filt: dict, **kwargs):
+        return FanOutResult(self._each(self._targets(filt), lambda c: c.delete_many(filt, **kwargs)))
+
+    def _route(self, op) -> list:
+        # Partitions a bulk_write request has to run on
+        from pymongo import DeleteMany, DeleteOne, InsertOne, ReplaceOne, UpdateMany, UpdateOne
+        if isinstance(op, InsertOne):
+            return [document_partition(op._doc, len(self.collections))]
+        if not isinstance(op, (UpdateOne, UpdateMany, ReplaceOne, DeleteOne, DeleteMany)):
+            raise TypeError(f'bulk_write cannot route {type(op).__name__} on {self.name}')
+        if isinstance(op, (UpdateOne, UpdateMany)):
+            self._check_update(op._doc)
+        parts = filter_partitions(op._filter, len(self.collections))
+        if len(parts) == 1 or isinstance(op, (UpdateMany, DeleteMany)):
+            return parts
+        if getattr(op, '_upsert', False):
+            raise ValueError(f'upserts on {self.name} must name their {PARTITION_KEY}')
+        if '_id' in op._filter and not isinstance(op._filter['_id'], dict):
+            # At most one partition holds the _id, so the others match nothing
+            return parts
+        # A single-document op must not hit one document per partition
+        owner = self._owner(op._filter)
+        return [self.collections.index(owner)] if owner is not None else []
+
+    def bulk_write(self, requests: list, ordered: bool = True, **kwargs):
+        # Each request goes only to the partitions that can hold its documents;
+        # order is kept within a partition, not across partitions
+        from pymongo.errors import BulkWriteError
+        requests = list(requests)
+        groups = {}
+        for pos, op in enumerate(requests):
+            for part in self._route(op):
+                groups.setdefault(part, []).append(pos)
+        results, errors = self._grouped_write(
+            groups, lambda c, positions: c.bulk_write([requests[p] for p in positions], ordered=ordered, **kwargs))
+        if errors:
+            raise BulkWriteError({'writeErrors': errors})
+        return FanOutResult(results)
+
+    def create_index(self, keys, **kwargs):
+        return self._each(self.collections, lambda c: c.create_index(keys, **kwargs))[0]
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
+
+
+class PartitionedDatabase:
+    # Drop-in for a pymongo Database: partitioned collections are routed,
+    # everything else (users, jobs, rate limits...) stays on the main database.
+
+    def __init__(self, main, partitions: list):
+        # partitions: [(uri, Database)], in partition order
+        self._main = main
+        self.partitions = partitions
+        self._pool = ThreadPoolExecutor(max_workers=max(4, 4 * len(partitions)), thread_name_prefix='partition')
+        self._collections = {}
+
+    def __getitem__(self, name: str):
+        if name not in PARTITIONED_COLLECTIONS:
+            return self._main[name]
+        if len(self.partitions) == 1:
+            return self.partitions[0][1][name]
+        coll = self._collections.get(name)
+        if coll is None:
+            coll = self._collections[name] = PartitionedCollection(
+                name, [database[name] for _, database in self.partitions], self._pool)
+        return coll
+
+    get_collection = __getitem__
+
+    def __getattr__(self, attr: str):
+        return getattr(self._main, attr)
+
+    def partition_collections(self, name: str) -> list:
+        return [database[name] for _, database in self.partitions]
+
+    def partition_address(self, key: str) -> tuple:
+        # (uri, database name) of the partition owning key
+        uri, database = self.partitions[partition_for(key, len(self.partitions))]
+        return uri, database.name
+
+    def snapshot(self) -> dict:
+        return {
+            'count': len(self.partitions),
+            'databases': [database.name for _, database in self.partitions],
+            'queries': {name: coll.snapshot() for name, coll in self._collections.items()},
+        }
@@ -0,0 +1,82 @@
+"""Move partitioned documents to the partition their key hashes to.
+
+Run after changing PARTITION_URIS (see partitions.py). Pass the new partition
+list in order; partitions being retired go in --drain so their documents are
+moved out too. Each misplaced document is copied to its target (an upsert on
+_id) before it is deleted from the source, so an interrupted run can simply be
+repeated. Stop the API or pause writes while it runs: until a doctor's rows
+have moved, routed queries look for them on the new partition only.
+
+    python backend_flask/rebalance.py --partitions URI1,URI2,URI3 [--drain URI4] [--dry-run]
+"""
+import argparse
+import os
+import sys
+from collections import Counter
+
+from partitions import PARTITIONED_COLLECTIONS, document_partition
+
+
+def connect(uris: list, default_db: str) -> list:
+    from pymongo import MongoClient
+    from pymongo.uri_parser import parse_uri
+    databases = []
+    for uri in uris:
+        client = MongoClient(uri, serverSelectionTimeoutMS=5000)
+        client.admin.command('ping')
+        databases.append(client.get_database(parse_uri(uri)['database'] or default_db))
+    return databases
+
+
+def rebalance(targets: list, drained: list, batch: int = 500, dry_run: bool = False) -> Counter:
+    # Returns moved-document counts per (collection, source index -> target index)
+    from pymongo import DeleteOne, ReplaceOne
+    moved = Counter()
+    sources = targets + drained
+    for name in PARTITIONED_COLLECTIONS:
+        for source_index, source in enumerate(sources):
+            pending = {}
+
+            def flush():
+                for target_index, docs in pending.items():
+                    if not dry_run:
+                        targets[target_index][name].bulk_write(
+                            [ReplaceOne({'_id': d['_id']}, d, upsert=True) for d in docs], ordered=False)
+                        source[name].bulk_write([DeleteOne({'_id': d['_id']}) for d in docs], ordered=False)
+                    moved[(name, source_index, target_index)] += len(docs)
+                pending.clear()
+
+            # Read ids first so deletes never race the cursor
+            ids = [d['_id'] for d in source[name].find({}, {'_id': 1})]
+            for start in range(0, len(ids), batch):
+                for doc in source[name].find({'_id': {'$in': ids[start:start + batch]}}):
+                    target_index = document_partition(doc, len(targets))
+                    if source_index != target_index:
+                        pending.setdefault(target_index, []).append(doc)
+                flush()
+    return moved
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--partitions', default=os.environ.get('PARTITION_URIS', ''),
+                        help='comma-separated partition URIs in order (default $PARTITION_URIS)')
+    parser.add_argument('--drain', default='', help='comma-separated URIs of partitions being removed')
+    parser.add_argument('--database', default='vaidya', help='database name for URIs without one')
+    parser.add_argument('--batch', type=int, default=500)
+    parser.add_argument('--dry-run', action='store_true', help='count misplaced documents without moving them')
+    args = parser.parse_args(argv)
+    target_uris = [u.strip() for u in args.partitions.split(',') if u.strip()]
+    if not target_uris:
+        parser.error('no partitions given')
+    targets = connect(target_uris, args.database)
+    drained = connect([u.strip() for u in args.drain.split(',') if u.strip()], args.database)
+    moved = rebalance(targets, drained, batch=args.batch, dry_run=args.dry_run)
+    verb = 'would move' if args.dry_run else 'moved'
+    for (name, src, dst), n in sorted(moved.items()):
+        print(f'{name}: {verb} {n} from partition {src} to {dst}')
+    print(f'{verb} {sum(moved.values())} documents in total')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
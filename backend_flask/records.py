@@ -0,0 +1,147 @@
+"""Compact row types for the in-memory store.
+
+A row keeps its known fields in ``__slots__`` instead of a per-row hash table,
+and low-cardinality strings (status/type/priority values, ids and the
+denormalized doctor/patient names) are interned so all rows share one copy.
+Records answer the same calls the handlers make on dicts (``get``, ``[]``,
+``in``, ``update``, ``setdefault``, ``pop``, ``items``); keys outside a type's
+fields land in a small overflow dict. They become plain dicts only at the
+response boundary (``to_dict``, used by the app's JSON provider).
+
+See bench_records.py for the memory comparison with the dict layout.
+"""
+import sys
+
+
+class Record:
+    __slots__ = ('_extra',)
+    FIELDS = frozenset()
+    INTERNED = frozenset()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.FIELDS = frozenset(cls.__slots__)
+
+    def __init__(self, data=None, **kwargs):
+        self._extra = None
+        self.update(data, **kwargs)
+
+    @classmethod
+    def from_dict(cls, data):
+        return data if isinstance(data, cls) else cls(data)
+
+    def __getitem__(self, key):
+        if key in self.FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self.FIELDS:
+            if key in self.INTERNED and type(value) is str:
+                value = sys.intern(value)
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self.FIELDS:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        elif self._extra is not None and key in self._extra:
+            del self._extra[key]
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        if key in self.FIELDS:
+            return hasattr(self, key)
+        return self._extra is not None and key in self._extra
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.to_dict()!r})'
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self) -> list:
+        keys = [k for k in self.__slots__ if hasattr(self, k)]
+        if self._extra:
+            keys.extend(self._extra)
+        return keys
+
+    def values(self) -> list:
+        return [self[k] for k in self.keys()]
+
+    def items(self) -> list:
+        return [(k, self[k]) for k in self.keys()]
+
+    def update(self, data=None, **kwargs):
+        for source in (data or {}, kwargs):
+            for key, value in (source.items() if hasattr(source, 'items') else source):
+                self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return value
+
+    def to_dict(self) -> dict:
+        return {k: self[k] for k in self.keys()}
+
+    copy = to_dict
+
+
+class AppointmentRecord(Record):
+    __slots__ = ('id', 'patientId', 'patientName', 'doctorId', 'doctorName', 'specialty', 'date', 'time',
+                 'duration', 'type', 'status', 'priority', 'healthIssue', 'symptoms', 'notes', 'meetingLink',
+                 'startAt', 'endAt', 'reminderSentAt', 'legacyId')
+    INTERNED = frozenset({'patientId', 'patientName', 'doctorId', 'doctorName', 'specialty', 'date', 'time',
+                          'type', 'status', 'priority', 'meetingLink'})
+
+
+class VitalRecord(Record):
+    __slots__ = ('id', 'patientId', 'label', 'value', 'status', 'unit', 'createdAt', 'legacyId')
+    INTERNED = frozenset({'patientId', 'label', 'status', 'unit'})
+
+
+class PrescriptionRecord(Record):
+    __slots__ = ('id', 'patientId', 'patientName', 'doctorId', 'medications', 'diagnosis', 'notes', 'date',
+                 'validUntil', 'status', 'legacyId')
+    INTERNED = frozenset({'patientId', 'patientName', 'doctorId', 'date', 'validUntil', 'status'})
+
+
+# Store name -> row type; stores not listed keep plain dicts
+RECORD_TYPES = {
+    'appointments': AppointmentRecord,
+    'appointments_archive': AppointmentRecord,
+    'vitals': VitalRecord,
+    'prescriptions': PrescriptionRecord,
+}
@@ -0,0 +1,85 @@
+"""Doctor practice reports.
+
+Runs inside report worker processes, so it only imports the standard library
+(and pymongo lazily): a spawned worker must not import app.py, which builds
+the whole application at import time.
+"""
+from collections import Counter
+from datetime import datetime, timezone
+
+
+def period_bounds(period: str) -> tuple:
+    # 'YYYY-MM' -> [start, end) in UTC; ValueError when malformed
+    start = datetime.strptime(period, '%Y-%m').replace(tzinfo=timezone.utc)
+    end = start.replace(year=start.year + (start.month == 12), month=start.month % 12 + 1)
+    return start, end
+
+
+def medication_names(prescription: dict) -> list:
+    names = [m.get('name') for m in prescription.get('medications') or [] if isinstance(m, dict) and m.get('name')]
+    if not names and prescription.get('medication'):
+        names = [prescription['medication']]
+    return names
+
+
+def summarize(by_status: Counter, by_type: Counter, patients: set, prescription_total: int,
+              by_medication: Counter) -> dict:
+    total = sum(by_status.values())
+    return {
+        'appointments': {'total': total, 'byStatus': dict(by_status)},
+        'consultationsByType': dict(by_type.most_common()),
+        'cancelRate': round(by_status.get('cancelled', 0) / total, 4) if total else 0.0,
+        'noShowRate': round(by_status.get('missed', 0) / total, 4) if total else 0.0,
+        'patients': len(patients),
+        'prescriptions': {
+            'total': prescription_total,
+            'byMedication': [{'name': name, 'count': n} for name, n in by_medication.most_common()],
+        },
+    }
+
+
+def memory_report(appointment_rows: list, prescription_rows: list) -> dict:
+    # One counting pass over rows already filtered to the doctor and period
+    by_status = Counter(a.get('status') or 'unknown' for a in appointment_rows)
+    by_type = Counter(a.get('type') or 'Other' for a in appointment_rows if a.get('status') == 'completed')
+    patients = {a['patientId'] for a in appointment_rows if a.get('patientId')}
+    by_medication = Counter(name for p in prescription_rows for name in medication_names(p))
+    return summarize(by_status, by_type, patients, len(prescription_rows), by_medication)
+
+
+def mongo_report(mongo_uri: str, database_name: str, doctor_id: str, period: str) -> dict:
+    # Aggregations run server-side over both appointment tiers; only the
+    # grouped counts come back to the worker.
+    from pymongo import MongoClient
+    start, end = period_bounds(period)
+    client = MongoClient(mongo_uri, serverSelectionTimeoutMS=2000)
+    try:
+        db = client.get_database(database_name)
+        pipeline = [
+            {'$match': {'doctorId': doctor_id, 'startAt': {'$gte': start, '$lt': end}, 'status': {'$ne': 'blocked'}}},
+            {'$facet': {
+                'byStatus': [{'$group': {'_id': '$status', 'n': {'$sum': 1}}}],
+                'byType': [{'$match': {'status': 'completed'}}, {'$group': {'_id': '$type', 'n': {'$sum': 1}}}],
+                'patients': [{'$group': {'_id': '$patientId'}}],
+            }},
+        ]
+        by_status, by_type, patients = Counter(), Counter(), set()
+        for coll_name in ('appointments', 'appointments_archive'):
+            for facet in db[coll_name].aggregate(pipeline):
+                by_status.update({row['_id'] or 'unknown': row['n'] for row in facet['byStatus']})
+                by_type.update({row['_id'] or 'Other': row['n'] for row in facet['byType']})
+                patients.update(row['_id'] for row in facet['patients'] if row['_id'])
+        # Prescription dates are stored as 'YYYY-MM-DD' strings
+        match = {'doctorId': doctor_id, 'date': {'$gte': start.strftime('%Y-%m-%d'), '$lt': end.strftime('%Y-%m-%d')}}
+        prescription_total = db['prescriptions'].count_documents(match)
+        by_medication = Counter()
+        for row in db['prescriptions'].aggregate([
+            {'$match': match},
+            {'$unwind': {'path': '$medications', 'preserveNullAndEmptyArrays': True}},
+            {'$group': {'_id': {'$ifNull': ['$medications.name', '$medication']}, 'n': {'$sum': 1}}},
+        ]):
+            if row['_id']:
+                by_medication[row['_id']] += row['n']
+        return summarize(by_status, by_type, patients, prescription_total, by_medication)
+    finally:
+        client.close()
@@ -41,7 +41,9 @@ const apiCall = async (endpoint, options = {}) => {
       } catch (e) {
         errorMsg = `Server error: ${response.status}`;
       }
-      throw new Error(errorMsg);
+      const httpError = new Error(errorMsg);
+      httpError.status = response.status;
+      throw httpError;
     }
 
     const contentType = response.headers.get('content-type');
@@ -55,6 +57,70 @@ const apiCall = async (endpoint, options = {}) => {
   }
 };
 
+// One key per user action so a retried create replays the original response
+// instead of writing a duplicate. Dashboards mint it when a form opens and pass
+// it with every submit of that form, so double clicks share it too.
+const newIdempotencyKey = () => (window.crypto && crypto.randomUUID)
+  ? crypto.randomUUID()
+  : `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+
+// Creates are retried with the same key when the request may not have reached
+// the server (network error), when it was shed (503) or when the original is
+// still in flight (409); the server then answers once and replays that answer.
+const IDEMPOTENT_ATTEMPTS = 3;
+const RETRYABLE_STATUSES = [409, 503];
+
+const idempotentCall = async (endpoint, options, idempotencyKey) => {
+  for (let attempt = 1; ; attempt++) {
+    try {
+      return await apiCall(endpoint, {
+        ...options,
+        headers: { ...options.headers, 'Idempotency-Key': idempotencyKey },
+      });
+    } catch (error) {
+      const retryable = error instanceof TypeError || RETRYABLE_STATUSES.includes(error.status);
+      if (!retryable || attempt >= IDEMPOTENT_ATTEMPTS) throw error;
+      await new Promise((resolve) => setTimeout(resolve, 500 * 2 ** (attempt - 1)));
+    }
+  }
+};
+
+// Live updates over Server-Sent Events; EventSource cannot send headers,
+// so the token travels as a query parameter. EventSource reconnects by itself
+// after network errors but gives up on an HTTP error (503 when the server's
+// stream limit is reached), so then we reopen after a pause and resume from the
+// last event seen. Returns { isLive(), close() }.
+const EVENT_TYPES = [
+  'appointment.booked', 'appointment.cancelled', 'appointment.updated', 'appointment.completed',
+  'appointment.reminder', 'slot.blocked', 'schedule.updated', 'prescription.created',
+];
+const EVENT_STREAM_REOPEN_MS = 30000;
+
+const openEventStream = (endpoint, onEvent) => {
+  let source = null;
+  let lastEventId = '';
+  let closed = false;
+  const connect = () => {
+    const params = new URLSearchParams({ token: getToken() || '' });
+    if (lastEventId) params.set('lastEventId', lastEventId);
+    source = new EventSource(`${API_BASE_URL}${endpoint}?${params}`);
+    EVENT_TYPES.forEach((type) => source.addEventListener(type, (e) => {
+      lastEventId = e.lastEventId || lastEventId;
+      onEvent(type, JSON.parse(e.data));
+    }));
+    source.onerror = () => {
+      if (source.readyState === EventSource.CLOSED && !closed) {
+        setTimeout(() => { if (!closed) connect(); }, EVENT_STREAM_REOPEN_MS);
+      }
+    };
+  };
+  connect();
+  return {
+    isLive: () => source.readyState === EventSource.OPEN,
+    close: () => { closed = true; source.close(); },
+  };
+};
+
 // Auth APIs
 const authAPI = {
   signup: (data) => apiCall('/auth/signup', {
@@ -74,19 +140,19 @@ const patientAPI = {
   
   getVitalsLatest: () => apiCall('/patient/vitals/latest'),
   
-  addVitals: (data) => apiCall('/patient/vitals', {
+  addVitals: (data, idempotencyKey = newIdempotencyKey()) => idempotentCall('/patient/vitals', {
     method: 'POST',
     body: JSON.stringify(data),
-  }),
+  }, idempotencyKey),
   
   getUpcomingAppointment: () => apiCall('/patient/appointments/upcoming'),
   
   getAppointments: () => apiCall('/patient/appointments'),
   
-  bookAppointment: (data) => apiCall('/patient/appointments', {
+  bookAppointment: (data, idempotencyKey = newIdempotencyKey()) => idempotentCall('/patient/appointments', {
     method: 'POST',
     body: JSON.stringify(data),
-  }),
+  }, idempotencyKey),
   
   getRecentRecords: () => apiCall('/patient/records/recent'),
   
@@ -104,6 +170,8 @@ const patientAPI = {
   }),
   
   getPrescriptions: () => apiCall('/patient/prescriptions'),
+  
+  subscribeEvents: (onEvent) => openEventStream('/patient/events', onEvent),
 };
 
 // Doctor APIs
@@ -124,14 +192,16 @@ const doctorAPI = {
   
   getPrescriptions: () => apiCall('/doctor/prescriptions'),
   
-  createPrescription: (data) => apiCall('/doctor/prescriptions', {
+  createPrescription: (data, idempotencyKey = newIdempotencyKey()) => idempotentCall('/doctor/prescriptions', {
     method: 'POST',
     body: JSON.stringify(data),
-  }),
+  }, idempotencyKey),
   
   getMessages: () => apiCall('/doctor/messages'),
   
   getPatients: () => apiCall('/doctor/patients'),
+  
+  subscribeEvents: (onEvent) => openEventStream('/doctor/events', onEvent),
 };
 
 // Common APIs
@@ -140,43 +210,55 @@ const commonAPI = {
 };
 
 // AI Assistant API
-// Add your Groq API key here: https://console.groq.com/keys
-const AI_API_KEY = 'YOUR_GROQ_API_KEY_HERE';
-
+// Requests go through the backend's /api/chat proxy, which holds the provider
+// key and streams the reply back as Server-Sent Events.
 const aiAPI = {
-  sendMessage: async (message) => {
+  // onToken (optional) is called with the reply so far as tokens arrive
+  sendMessage: async (message, onToken) => {
     try {
-      const response = await fetch('https://api.groq.com/openai/v1/chat/completions', {
+      const response = await fetch(`${API_BASE_URL}/chat`, {
         method: 'POST',
         headers: {
-          'Authorization': `Bearer ${AI_API_KEY}`,
+          'Authorization': `Bearer ${getToken()}`,
           'Content-Type': 'application/json',
+          'Accept': 'text/event-stream',
         },
-        body: JSON.stringify({
-          model: 'llama-3.1-8b-instant',
-          messages: [{
-            role: 'system',
-            content: 'You are a helpful medical AI assistant. Provide health information and guidance, but always remind users to consult with healthcare professionals for serious concerns.'
-          }, {
-            role: 'user',
-            content: message
-          }],
-          max_tokens: 1000,
-          temperature: 0.7
-        })
+        body: JSON.stringify({ message })
       });
-      
+
       if (!response.ok) {
         const errorData = await response.json().catch(() => ({}));
-        throw new Error(errorData.error?.message || `API error: ${response.status}`);
+        throw new Error(errorData.error || `API error: ${response.status}`);
       }
-      
-      const data = await response.json();
-      if (data.choices && data.choices[0] && data.choices[0].message) {
-        return data.choices[0].message.content;
-      } else {
+
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      let reply = '';
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        const events = buffer.split('\n\n');
+        buffer = events.pop();
+        for (const raw of events) {
+          const type = (raw.match(/^event: (.*)$/m) || [])[1];
+          const data = (raw.match(/^data: (.*)$/m) || [])[1];
+          if (!data) continue;
+          const payload = JSON.parse(data);
+          if (type === 'token') {
+            reply += payload.text;
+            if (onToken) onToken(reply);
+          } else if (type === 'error') {
+            throw new Error(payload.error);
+          }
+        }
+      }
+
+      if (!reply) {
         throw new Error('Invalid response from AI');
       }
+      return reply;
     } catch (error) {
       console.error('AI API Error:', error);
       throw new Error(error.message || 'AI service unavailable');
@@ -86,6 +86,31 @@ function debounce(func, wait) {
   };
 }
 
+// Live dashboard updates. `subscribe` is patientAPI/doctorAPI.subscribeEvents;
+// `handlers` maps an event type to the loaders it makes stale. Events arriving
+// together are coalesced, so each affected widget re-fetches once.
+function connectLiveUpdates(subscribe, handlers) {
+  const stale = new Set();
+  const refreshStale = debounce(() => {
+    const loaders = [...stale];
+    stale.clear();
+    loaders.forEach((load) => load());
+  }, 300);
+  const stream = subscribe((type, data) => {
+    const loaders = handlers[type] ? handlers[type](data) || [] : [];
+    loaders.forEach((load) => stale.add(load));
+    if (loaders.length) refreshStale();
+  });
+  window.addEventListener('beforeunload', () => stream.close());
+  return {
+    // After the user's own change: its event refreshes the page, so only
+    // re-fetch directly while the stream is down
+    afterChange: (...loaders) => {
+      if (!stream.isLive()) loaders.forEach((load) => load());
+    },
+  };
+}
+
 // Loading spinner helper
 function showLoading(elementId) {
   const element = document.getElementById(elementId);